@@ -1,3 +1,4 @@
 import calcora.core.ops
+import calcora.core.callbacks
 import calcora.core.constants
 import calcora.printing.printing
\ No newline at end of file
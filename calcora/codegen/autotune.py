@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from typing import TYPE_CHECKING
+
+import functools
+import hashlib
+import json
+import os
+import pathlib
+import platform
+import tempfile
+import threading
+import time
+
+from calcora.codegen.cache import default_cache_directory
+
+if TYPE_CHECKING:
+  from calcora.codegen.ccompiler import ClangProgram
+
+DEFAULT_BLOCKS = (1 << 10, 1 << 12, 1 << 14, 1 << 16, 1 << 18)
+DEFAULT_SAMPLE_SIZE = 1 << 18
+
+@functools.cache
+def cpu_model() -> str:
+  # Note: Tunings are only reused on the same kind of machine, the logical core count is part of the key since it bounds the useful thread count
+  model = ''
+  try:
+    with open('/proc/cpuinfo') as f:
+      for line in f:
+        if line.startswith('model name'):
+          model = line.split(':', 1)[1].strip()
+          break
+  except OSError: pass
+  return f'{model or platform.processor() or platform.machine()} x{os.cpu_count() or 1}'
+
+def program_key(program: ClangProgram) -> str:
+  return hashlib.sha256(f'{program.fxn_code}\0{" ".join(program.flags)}'.encode()).hexdigest()
+
+def default_threads() -> Tuple[int, ...]:
+  cores = os.cpu_count() or 1
+  return tuple(sorted({1, 2, max(cores // 2, 1), cores} & set(range(1, cores + 1))))
+
+class Tuning:
+  def __init__(self, block: int, threads: int, throughput: float, measurements: Optional[List[Tuple[int, int, float]]] = None) -> None:
+    self.block = block
+    self.threads = threads
+    self.throughput = throughput # Note: Elements per second of the best configuration on the sample
+    self.measurements = measurements or []
+
+  def to_json(self) -> Dict[str, Any]: return {'block': self.block, 'threads': self.threads, 'throughput': self.throughput}
+
+  @staticmethod
+  def from_json(data: Dict[str, Any]) -> Tuning: return Tuning(int(data['block']), int(data['threads']), float(data['throughput']))
+
+  def __repr__(self) -> str: return f'Tuning(block={self.block}, threads={self.threads}, throughput={self.throughput:.3g}/s)'
+
+class TuningStore:
+  # Note: One json file mapping program hash and cpu model to the best configuration, it is rewritten to a temporary file and renamed
+  # into place so concurrent processes never read a partial file, the last writer wins
+  def __init__(self, path: Optional[pathlib.Path] = None) -> None:
+    self.path = path if path is not None else default_cache_directory() / 'autotune.json'
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def key(program: ClangProgram) -> str: return f'{program_key(program)}:{cpu_model()}'
+
+  def load(self) -> Dict[str, Dict[str, Any]]:
+    try:
+      with open(self.path) as f: data = json.load(f)
+    except (OSError, ValueError): return {}
+    return data if isinstance(data, dict) else {}
+
+  def get(self, program: ClangProgram) -> Optional[Tuning]:
+    entry = self.load().get(self.key(program))
+    try: return Tuning.from_json(entry) if entry is not None else None
+    except (KeyError, TypeError, ValueError): return None
+
+  def put(self, program: ClangProgram, tuning: Tuning) -> None:
+    with self._lock:
+      data = self.load()
+      data[self.key(program)] = tuning.to_json()
+      self.path.parent.mkdir(parents=True, exist_ok=True)
+      fd, temporary = tempfile.mkstemp(dir=self.path.parent, prefix=f'.{self.path.name}.', suffix='.tmp')
+      try:
+        with os.fdopen(fd, 'w') as f: json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(temporary, self.path)
+      except BaseException:
+        pathlib.Path(temporary).unlink(missing_ok=True)
+        raise
+
+  def clear(self) -> None: self.path.unlink(missing_ok=True)
+
+_default_store : Optional[TuningStore] = None
+
+def default_store() -> TuningStore:
+  global _default_store
+  if _default_store is None: _default_store = TuningStore()
+  return _default_store
+
+def _sample(program: ClangProgram, size: int) -> List[Any]:
+  import numpy
+  rng = numpy.random.default_rng(0)
+  # Note: Values in (0.5, 1.5) stay inside the domain of logs, roots and divisions for most expressions
+  return [rng.uniform(0.5, 1.5, size) if program.real or var in program.real_vars else rng.uniform(0.5, 1.5, size) + 0.25j for var in program.fxn_vars]
+
+def measure(program: ClangProgram, block: int, threads: int, arrays: List[Any], out: Any, repeat: int = 3) -> float:
+  best = float('inf')
+  for _ in range(repeat):
+    start = time.perf_counter()
+    program.batch(*arrays, out=out, block=block, threads=threads)
+    best = min(best, time.perf_counter() - start)
+  return out.size / best if best > 0 else float('inf')
+
+def autotune(program: ClangProgram, blocks: Iterable[int] = DEFAULT_BLOCKS, threads: Optional[Iterable[int]] = None, sample_size: int = DEFAULT_SAMPLE_SIZE,
+             repeat: int = 3, store: Optional[TuningStore] = None, force: bool = False) -> Tuning:
+  # Note: Benchmarks every block size and thread count on a sample input, applies the fastest to the program and persists it per program and
+  # cpu model. A stored tuning is reused unless force is set, store=None uses the default store in the cache directory
+  import numpy
+  if not program.fxn_vars: raise ValueError("Cannot autotune a program without variables, its batch computes a single value")
+  store = store if store is not None else default_store()
+  if not force and (tuning := store.get(program)) is not None:
+    program.tuning = tuning
+    return tuning
+  if not program.compiled: program.compile()
+  arrays = _sample(program, sample_size)
+  out = numpy.empty(sample_size, dtype=numpy.float64 if program.real else numpy.complex128)
+  program.batch(*arrays, out=out) # Note: Warm up page faults and the thread pool before timing
+  measurements = [(block, n, measure(program, block, n, arrays, out, repeat)) for block in sorted(set(blocks)) for n in sorted(set(threads or default_threads()))]
+  block, n, throughput = max(measurements, key=lambda measurement: measurement[2])
+  program.tuning = tuning = Tuning(block, n, throughput, measurements)
+  store.put(program, tuning)
+  return tuning
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+from typing import Any, Callable, Dict, Iterable, List, Literal, Optional, Sequence, Tuple, Union
+from typing import TYPE_CHECKING
+
+import cmath
+import math
+import operator
+
+from calcora.globals import BaseOps
+from calcora.core.cse import ExprDAG, is_leaf
+from calcora.core.ops import Const, Constant, Var
+
+import mpmath
+
+if TYPE_CHECKING:
+  from calcora.core.expression import Expr
+
+type BytecodeMode = Literal['float', 'complex', 'mpmath']
+
+ADD, MUL, SQUARE, NEG, POW, SIN, COS, LN, LOG, INV, COMPLEX = range(11)
+OPNAMES = ('ADD', 'MUL', 'SQUARE', 'NEG', 'POW', 'SIN', 'COS', 'LN', 'LOG', 'INV', 'COMPLEX')
+
+MODE_LIBRARIES : Dict[str, Any] = {'float': math, 'complex': cmath, 'mpmath': mpmath}
+MODE_CASTS : Dict[str, Callable[[Any], Any]] = {'float': float, 'complex': complex, 'mpmath': mpmath.mpmathify}
+
+type Instruction = Tuple[int, int, int, int]
+
+UNARY = (NEG, SIN, COS, LN, INV)
+
+def op_functions(mode: BytecodeMode) -> Tuple[Callable[..., Any], ...]:
+  lib = MODE_LIBRARIES[mode]
+  log = mpmath.log if mode == 'mpmath' else lambda x, base: lib.log(x) / lib.log(base)
+  complex_fxn = mpmath.mpc if mode == 'mpmath' else lambda real, imag: real + 1j * imag
+  return (operator.add, operator.mul, operator.mul, operator.neg, operator.pow, lib.sin, lib.cos, lib.log, log, lambda x: 1 / x, complex_fxn)
+
+def _is_number(expression: Expr, value: float) -> bool: return isinstance(expression, Const) and expression.x == value
+
+def _depends_on_vars(dag: ExprDAG) -> List[bool]:
+  res : List[bool] = []
+  for node, children in zip(dag.nodes, dag.children): res.append(isinstance(node, Var) or any(res[child] for child in children))
+  return res
+
+class BytecodeProgram:
+  # Note: Compiles expressions to a register machine, every DAG node gets its own register so shared subexpressions are computed once.
+  # Registers start out as [vars..., constants..., temporaries...], an instruction (op, dst, a, b) stores op(reg[a], reg[b]) in reg[dst].
+  # Nothing is generated as source so variable names never reach eval, compiling is one pass over the DAG
+  def __init__(self, expressions: Union[Expr, Sequence[Expr]], mode: BytecodeMode = 'complex', vars: Optional[Iterable[str]] = None, fold: bool = True) -> None:
+    if mode not in MODE_LIBRARIES: raise ValueError(f"Invalid mode {mode}, must be float, complex or mpmath")
+    self.mode = mode
+    self.fold = fold
+    self.single = not isinstance(expressions, Sequence)
+    self.expressions : List[Expr] = list(expressions) if isinstance(expressions, Sequence) else [expressions]
+    dag = ExprDAG(self.expressions)
+    self.fxn_vars : List[str] = list(vars) if vars is not None else sorted(dag.var_names())
+    if missing := dag.var_names() - set(self.fxn_vars): raise ValueError(f"Variables {', '.join(sorted(missing))} are used but not in vars")
+    self.code : List[Instruction] = []
+    self.registers : List[Any] = [None] * len(self.fxn_vars)
+    cast = MODE_CASTS[mode]
+    slots : Dict[int, int] = {}
+    constants : Dict[Any, int] = {}
+    # Note: mpmath constants are kept lazy and nothing is folded in mpmath mode so results follow the precision at call time
+    dynamic = _depends_on_vars(dag) if fold and mode != 'mpmath' else [True] * len(dag)
+    def constant(value: Any) -> int:
+      key = (type(value), value)
+      if (slot := constants.get(key)) is None:
+        slot = constants[key] = len(self.registers)
+        self.registers.append(value)
+      return slot
+    for i, (node, children) in enumerate(zip(dag.nodes, dag.children)):
+      if isinstance(node, Var): slots[i] = self.fxn_vars.index(node.name)
+      elif not dynamic[i] or (is_leaf(node) and mode != 'mpmath'):
+        value = node._eval()
+        slots[i] = constant(complex(value) if value.imag else cast(value.real))
+      elif isinstance(node, Const): slots[i] = constant(node.x.value.real)
+      elif isinstance(node, Constant): slots[i] = constant(node.x)
+      else: slots[i] = self._emit(node, [slots[child] for child in children], [dag.nodes[child] for child in children])
+    self.outputs : List[int] = [slots[root] for root in dag.roots]
+    # Note: The interpreter runs over (function, dst, a, b) with b = -1 for unary ops, one call per instruction instead of a chain of comparisons
+    functions = op_functions(mode)
+    self.threaded : List[Tuple[Callable[..., Any], int, int, int]] = [(functions[op], dst, a, -1 if op in UNARY else b) for op, dst, a, b in self.code]
+
+  def _emit(self, node: Expr, args: List[int], nodes: List[Expr]) -> int:
+    dst = len(self.registers)
+    self.registers.append(None)
+    fxn = node.fxn
+    if fxn == BaseOps.Add: self.code.append((ADD, dst, args[0], args[1]))
+    elif fxn == BaseOps.Mul: self.code.append((MUL, dst, args[0], args[1]))
+    elif fxn == BaseOps.Neg: self.code.append((NEG, dst, args[0], args[0]))
+    elif fxn == BaseOps.Sin: self.code.append((SIN, dst, args[0], args[0]))
+    elif fxn == BaseOps.Cos: self.code.append((COS, dst, args[0], args[0]))
+    elif fxn == BaseOps.Pow and _is_number(nodes[1], 2): self.code.append((SQUARE, dst, args[0], args[0]))
+    elif fxn == BaseOps.Pow and nodes[1].fxn == BaseOps.Neg and _is_number(nodes[1].args[0], 1): self.code.append((INV, dst, args[0], args[0]))
+    elif fxn == BaseOps.Pow: self.code.append((POW, dst, args[0], args[1]))
+    elif fxn == BaseOps.Log and isinstance(nodes[1], Constant) and nodes[1].name == 'e': self.code.append((LN, dst, args[0], args[0]))
+    elif fxn == BaseOps.Log: self.code.append((LOG, dst, args[0], args[1]))
+    elif fxn == BaseOps.Complex: self.code.append((COMPLEX, dst, args[0], args[1]))
+    else: raise ValueError(f"Cannot compile op of type {fxn.name} to bytecode")
+    return dst
+
+  def disassemble(self) -> str:
+    lines = [f'r{i} = {name}' for i, name in enumerate(self.fxn_vars)]
+    lines += [f'r{i} = {value}' for i, value in enumerate(self.registers) if i >= len(self.fxn_vars) and value is not None]
+    lines += [f'{OPNAMES[op]:<8} r{dst}, r{a}' + (f', r{b}' if op in (ADD, MUL, POW, LOG, COMPLEX) else '') for op, dst, a, b in self.code]
+    lines.append('RETURN   ' + ', '.join(f'r{output}' for output in self.outputs))
+    return '\n'.join(lines)
+
+  def __call__(self, *args: Any, **kwargs: Any) -> Any:
+    if kwargs:
+      values = dict(zip(self.fxn_vars, args), **kwargs)
+      if sorted(values) != sorted(self.fxn_vars): raise TypeError(f"Function requires the arguments ({','.join(self.fxn_vars)}) but got ({','.join(sorted(values))})")
+      args = tuple(values[name] for name in self.fxn_vars)
+    elif len(args) != len(self.fxn_vars): raise TypeError(f"Function requires {len(self.fxn_vars)} arguments ({','.join(self.fxn_vars)}) but {len(args)} were given")
+    r = self.registers.copy()
+    cast = MODE_CASTS[self.mode]
+    for i, arg in enumerate(args): r[i] = cast(arg)
+    for fxn, dst, a, b in self.threaded: r[dst] = fxn(r[a]) if b < 0 else fxn(r[a], r[b])
+    # Note: In mpmath mode an output can be a register holding a lazy constant like mpmath.pi, unary plus evaluates it at the current precision
+    if self.mode == 'mpmath': return +r[self.outputs[0]] if self.single else tuple(+r[output] for output in self.outputs)
+    if self.single: return r[self.outputs[0]]
+    return tuple(r[output] for output in self.outputs)
+
+def bytecode_compile(expressions: Union[Expr, Sequence[Expr]], mode: BytecodeMode = 'complex', vars: Optional[Iterable[str]] = None, fold: bool = True) -> BytecodeProgram:
+  return BytecodeProgram(expressions, mode, vars, fold)
@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+import collections
+import functools
+import hashlib
+import marshal
+import os
+import pathlib
+import subprocess
+import tempfile
+import threading
+import time
+import types
+
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+STALE_TEMPORARY_AGE = 3600
+
+def default_cache_directory() -> pathlib.Path:
+  if directory := os.environ.get('CALCORA_CACHE_DIR'): return pathlib.Path(directory)
+  return pathlib.Path(os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache') / 'calcora'
+
+@functools.cache
+def compiler_version(compiler: str) -> str:
+  try: return subprocess.check_output([compiler, '--version'], stderr=subprocess.STDOUT).decode(errors='replace').strip()
+  except (OSError, subprocess.CalledProcessError): return compiler
+
+class SharedObjectCache:
+  # Note: Compiled shared objects are stored under a hash of everything that affects the output, so an entry never has to be invalidated.
+  # Files are written to a temporary name and renamed into place so concurrent processes only ever see complete files,
+  # the modification time is bumped on every hit and the least recently used files are removed when the size limit is exceeded
+  def __init__(self, directory: Optional[pathlib.Path] = None, max_size: int = DEFAULT_CACHE_SIZE) -> None:
+    self.directory = directory if directory is not None else default_cache_directory()
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self.writes = 0
+    self.evictions = 0
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def key(source: str, flags: Iterable[str], compiler: str) -> str:
+    digest = hashlib.sha256()
+    for part in (source, '\0'.join(flags), compiler_version(compiler)): digest.update(part.encode()); digest.update(b'\0\0')
+    return digest.hexdigest()
+
+  def path(self, key: str) -> pathlib.Path: return self.directory / f'{key}.so'
+
+  def get(self, key: str) -> Optional[pathlib.Path]:
+    path = self.path(key)
+    # Note: The access time drives eviction, a cache directory that can not be written (read only or owned by another user) is still
+    # used for lookups and its entries just keep their age
+    try: os.utime(path)
+    except FileNotFoundError: found = False
+    except OSError: found = path.is_file()
+    else: found = True
+    if not found:
+      with self._lock: self.misses += 1
+      return None
+    with self._lock: self.hits += 1
+    return path
+
+  def put(self, key: str, data: bytes) -> pathlib.Path:
+    self.directory.mkdir(parents=True, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=self.directory, prefix=f'.{key}.', suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f: f.write(data)
+      os.replace(temporary, self.path(key))
+    except BaseException:
+      pathlib.Path(temporary).unlink(missing_ok=True)
+      raise
+    with self._lock: self.writes += 1
+    self.evict(keep=key)
+    return self.path(key)
+
+  def entries(self) -> Dict[pathlib.Path, os.stat_result]:
+    res = {}
+    for path in self.directory.glob('*.so'):
+      try: res[path] = path.stat()
+      except FileNotFoundError: pass # Note: Removed by another process
+    return res
+
+  def evict(self, keep: Optional[str] = None) -> None:
+    for temporary in self.directory.glob('.*.tmp'):
+      try:
+        if time.time() - temporary.stat().st_mtime > STALE_TEMPORARY_AGE: temporary.unlink(missing_ok=True) # Note: Left behind by a process that died mid write
+      except FileNotFoundError: pass
+    entries = self.entries()
+    size = sum(stat.st_size for stat in entries.values())
+    for path, stat in sorted(entries.items(), key=lambda entry: entry[1].st_mtime):
+      if size <= self.max_size: break
+      if keep is not None and path == self.path(keep): continue
+      path.unlink(missing_ok=True) # Note: Processes that already loaded the file keep their mapping
+      size -= stat.st_size
+      with self._lock: self.evictions += 1
+
+  def clear(self) -> None:
+    for path in self.entries(): path.unlink(missing_ok=True)
+
+  def stats(self) -> Dict[str, int]:
+    entries = self.entries() if self.directory.exists() else {}
+    return {'hits': self.hits, 'misses': self.misses, 'writes': self.writes, 'evictions': self.evictions,
+            'entries': len(entries), 'size': sum(stat.st_size for stat in entries.values())}
+
+_default_cache : Optional[SharedObjectCache] = None
+
+def default_cache() -> Optional[SharedObjectCache]:
+  # Note: Setting CALCORA_DISABLE_CACHE turns the cache off for every program that does not pass its own
+  global _default_cache
+  if os.environ.get('CALCORA_DISABLE_CACHE'): return None
+  if _default_cache is None: _default_cache = SharedObjectCache()
+  return _default_cache
+
+
+DEFAULT_LAMBDIFY_ENTRIES = 1024
+
+class LambdifyCache:
+  # Note: An in memory LRU of lambdified functions and optionally a directory of marshalled entries that survive restarts. A disk entry holds
+  # the generated source, the source of every hoisted literal and the compiled code object, loading one skips generating and compiling.
+  # Disk keys include the bytecode magic number since marshalled code objects only load on the same python version
+  def __init__(self, max_entries: int = DEFAULT_LAMBDIFY_ENTRIES, directory: Optional[pathlib.Path] = None) -> None:
+    self.max_entries = max_entries
+    self.directory = directory
+    self.hits = 0
+    self.misses = 0
+    self.disk_hits = 0
+    self.disk_writes = 0
+    self.evictions = 0
+    self._entries : collections.OrderedDict[Hashable, Callable[..., Any]] = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key: Hashable) -> Optional[Callable[..., Any]]:
+    with self._lock:
+      if (fxn := self._entries.get(key)) is None:
+        self.misses += 1
+        return None
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return fxn
+
+  def put(self, key: Hashable, fxn: Callable[..., Any]) -> None:
+    with self._lock:
+      self._entries[key] = fxn
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+        self.evictions += 1
+
+  def path(self, key: str) -> pathlib.Path:
+    assert self.directory is not None
+    return self.directory / f'{key}.lambdify'
+
+  def load(self, key: str) -> Optional[Tuple[str, Dict[str, str], types.CodeType]]:
+    if self.directory is None: return None
+    try:
+      with open(self.path(key), 'rb') as f: source, hoisted, code = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError): return None
+    with self._lock: self.disk_hits += 1
+    return source, hoisted, code
+
+  def store(self, key: str, source: str, hoisted: Dict[str, str], code: types.CodeType) -> None:
+    if self.directory is None: return
+    self.directory.mkdir(parents=True, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=self.directory, prefix=f'.{key}.', suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f: marshal.dump((source, hoisted, code), f)
+      os.replace(temporary, self.path(key))
+    except BaseException:
+      pathlib.Path(temporary).unlink(missing_ok=True)
+      raise
+    with self._lock: self.disk_writes += 1
+
+  def clear(self, disk: bool = False) -> None:
+    # Note: Drops every function kept in memory, with disk the stored entries are removed as well
+    with self._lock: self._entries.clear()
+    if disk and self.directory is not None and self.directory.exists():
+      for path in self.directory.glob('*.lambdify'): path.unlink(missing_ok=True)
+
+  def stats(self) -> Dict[str, int]:
+    return {'hits': self.hits, 'misses': self.misses, 'disk_hits': self.disk_hits, 'disk_writes': self.disk_writes, 'evictions': self.evictions, 'entries': len(self._entries)}
+
+_default_lambdify_cache : Optional[LambdifyCache] = None
+
+def default_lambdify_cache() -> Optional[LambdifyCache]:
+  # Note: Memory only unless CALCORA_LAMBDIFY_DISK_CACHE is set, then entries are also stored under the cache directory
+  global _default_lambdify_cache
+  if os.environ.get('CALCORA_DISABLE_CACHE'): return None
+  if _default_lambdify_cache is None: _default_lambdify_cache = LambdifyCache(directory=default_cache_directory() / 'lambdify' if os.environ.get('CALCORA_LAMBDIFY_DISK_CACHE') else None)
+  return _default_lambdify_cache
@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from typing import Iterable, Optional
+from typing import Dict, Iterable, Optional
 from typing import TYPE_CHECKING
 
 import random
@@ -10,6 +10,8 @@ from calcora.core.stringops import *
 from calcora.utils import is_op_type
 from calcora.globals import BaseOps
 from calcora.codegen.lambdify import find_expression_vars
+from calcora.core.domain import Domain
+from calcora.codegen.optimize import special_power
 
 if TYPE_CHECKING:
   from calcora.core.expression import Expr
@@ -31,39 +33,50 @@ C_CONSTANTS_MAP = {
   'π': 'M_PI'
 }
 
-def generate_expression_string(expression: Expr) -> str:
+C_DOUBLE_FUNCTIONS_MAP = {'pow': 'pow', 'log': 'log', 'sin': 'sin', 'cos': 'cos', 'sqrt': 'sqrt'}
+C_LONG_DOUBLE_FUNCTIONS_MAP = {'pow': 'powl', 'log': 'logl', 'sin': 'sinl', 'cos': 'cosl', 'sqrt': 'sqrtl'}
+
+def generate_expression_string(expression: Expr, domains: Optional[Dict[int, Domain]] = None, real_functions: Dict[str, str] = C_LONG_DOUBLE_FUNCTIONS_MAP, optimized: bool = False) -> str:
+  # Note: Subexpressions that are provably real according to domains use the real math.h functions instead of the complex.h ones,
+  # optimized emits special powers as sqrt and division, it is meant for expressions that went through optimize_expression
+  real = domains is not None and Domain.Real in domains[id(expression)]
   if is_op_type(expression, Var): return f'{expression.name}'
   elif is_op_type(expression, Const): return f'{expression.x}'
   elif is_op_type(expression, Constant): return f'{C_CONSTANTS_MAP[expression.name]}'
   elif is_op_type(expression, Complex): 
-    real = generate_expression_string(expression.real)
-    imag = generate_expression_string(expression.imag)
-    return f'({real} + {imag}*I)'
+    real_part = generate_expression_string(expression.real, domains, real_functions, optimized)
+    if real: return real_part
+    imag = generate_expression_string(expression.imag, domains, real_functions, optimized)
+    return f'({real_part} + {imag}*I)'
   elif is_op_type(expression, Add):
-    x = generate_expression_string(expression.x)
-    y = generate_expression_string(expression.y)
+    x = generate_expression_string(expression.x, domains, real_functions, optimized)
+    y = generate_expression_string(expression.y, domains, real_functions, optimized)
     return f'({x}+{y})'
   elif is_op_type(expression, Neg):
-    x = generate_expression_string(expression.x)
+    x = generate_expression_string(expression.x, domains, real_functions, optimized)
     return f'(-{x})'
   elif is_op_type(expression, Mul):
-    x = generate_expression_string(expression.x)
-    y = generate_expression_string(expression.y)
+    x = generate_expression_string(expression.x, domains, real_functions, optimized)
+    y = generate_expression_string(expression.y, domains, real_functions, optimized)
     return f'({x}*{y})'
   elif is_op_type(expression, Log):
-    x = generate_expression_string(expression.x)
-    base = generate_expression_string(expression.base)
+    x = generate_expression_string(expression.x, domains, real_functions, optimized)
+    base = generate_expression_string(expression.base, domains, real_functions, optimized)
+    if real: return f'({real_functions["log"]}({x})/{real_functions["log"]}({base}))'
     return f'(clog({x})/clog({base}))'
   elif is_op_type(expression, Pow):
-    x = generate_expression_string(expression.x)
-    y = generate_expression_string(expression.y)
-    return f'cpow({x}, {y})'
+    x = generate_expression_string(expression.x, domains, real_functions, optimized)
+    kind = special_power(expression) if optimized else None
+    if kind == 'reciprocal': return f'(1.0/{x})'
+    if kind is not None: return f'{real_functions["sqrt"] if real else "csqrt"}({x})' if kind == 'sqrt' else f'(1.0/{real_functions["sqrt"] if real else "csqrt"}({x}))'
+    y = generate_expression_string(expression.y, domains, real_functions, optimized)
+    return f'{real_functions["pow"] if real else "cpow"}({x}, {y})'
   elif is_op_type(expression, Sin): 
-    x = generate_expression_string(expression.x)
-    return f'csin({x})'
+    x = generate_expression_string(expression.x, domains, real_functions, optimized)
+    return f'{real_functions["sin"] if real else "csin"}({x})'
   elif is_op_type(expression, Cos):
-    x = generate_expression_string(expression.x)
-    return f'ccos({x})'
+    x = generate_expression_string(expression.x, domains, real_functions, optimized)
+    return f'{real_functions["cos"] if real else "ccos"}({x})'
   else: raise TypeError(f'Invalid op {type(expression)} cannot be converted to c code!')
 
 def c_function(expression: Expr, name: Optional[str] = None, automatic_vars: bool = True, vars: Optional[Iterable[str]] = None, custom_type: Optional[str] = None) -> str:
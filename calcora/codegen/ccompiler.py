@@ -1,20 +1,27 @@
 from __future__ import annotations
 
-from typing import Any, List, Optional, TypeGuard, Union
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, TypeGuard, Union
 from typing import TYPE_CHECKING
 
+import concurrent.futures
 import ctypes
+import hashlib
+import os
 import pathlib
-import random
-import string
+import re
 import subprocess
 import tempfile
 
-from calcora.codegen.ccode import generate_expression_string, find_includes
-from calcora.codegen.lambdify import find_expression_vars
+from calcora.codegen.cache import default_cache, SharedObjectCache
+from calcora.codegen.ccode import C_DOUBLE_FUNCTIONS_MAP, generate_expression_string, find_includes
+from calcora.codegen.lambdify import find_expression_vars, lambdify
+from calcora.codegen.optimize import optimize_expression
+from calcora.core.domain import close_domain, Domain, infer_domains
 
 if TYPE_CHECKING:
+  from calcora.codegen.autotune import Tuning
   from calcora.core.expression import Expr
+  from numpy.typing import NDArray
 
 class LongDoubleComplex(ctypes.Structure):
   _fields_ = [("real", ctypes.c_longdouble),
@@ -26,53 +33,298 @@ class LongDoubleComplex(ctypes.Structure):
     elif isinstance(number, complex): return LongDoubleComplex(number.real, number.imag)
     else: raise TypeError(f"Cannot create LongDoubleComplex from type: {type(number)} only float or complex allowed!")
 
+class DoubleComplex(ctypes.Structure):
+  _fields_ = [("real", ctypes.c_double),
+              ("imag", ctypes.c_double)]
+
 def is_expr(val: Any) -> TypeGuard[Expr]:
   return hasattr(val, '_eval')
 
+BATCH_PARALLEL_THRESHOLD = 1 << 14
+
+def c_compiler() -> str: return os.environ.get('CC', 'clang')
+
+class CompilationError(RuntimeError):
+  def __init__(self, message: str, stderr: str = '') -> None:
+    super().__init__(message)
+    self.stderr = stderr
+
+def header_code(includes: Iterable[str], complex_type: bool) -> str:
+  code = ''.join(f'#include <{inc}>\n' for inc in sorted(includes)) + '\n'
+  if complex_type: code += 'typedef struct {\n  long double real;\n  long double imag;\n} LongDoubleComplex;\n\n'
+  if complex_type: code += 'typedef struct {\n  double real;\n  double imag;\n} DoubleComplex;\n\n'
+  return code
+
+def compile_shared_object(source: str, flags: List[str], cache: Optional[SharedObjectCache], name: str = 'calcora') -> Tuple[bytes, ctypes.CDLL]:
+  compiler = c_compiler()
+  key = SharedObjectCache.key(source, flags, compiler) if cache else None
+  if cache and key and (path := cache.get(key)): return path.read_bytes(), ctypes.CDLL(str(path))
+  with tempfile.TemporaryDirectory() as directory:
+    output_file = pathlib.Path(directory) / f'{name}.so'
+    arguments = [compiler, '-x', 'c', '-', '-shared', '-fPIC', *flags, '-o', str(output_file), '-lm']
+    try: subprocess.check_output(args=arguments, input=source.encode("utf-8"), stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e: raise CompilationError(f"Error during compilation: {e.stderr.decode()}", e.stderr.decode()) from e
+    except OSError as e: raise CompilationError(f"Could not run C compiler '{compiler}': {e}") from e
+    compiled = output_file.read_bytes()
+    if cache and key:
+      try: output_file = cache.put(key, compiled)
+      except OSError: pass # Note: An unwritable cache directory only means the result is not reused, the temporary file is loaded instead
+    return compiled, ctypes.CDLL(str(output_file))
+
 class ClangProgram:
-  def __init__(self, expression: Expr, name: Optional[str] = None) -> None:
-    self.fxn_name : str = name or ''.join(random.choices(string.ascii_letters + '_', k=16))
+  def __init__(self, expression: Expr, name: Optional[str] = None, assumptions: Optional[Mapping[str, Domain]] = None, optimize: bool = False, openmp: bool = False,
+               cache: Union[SharedObjectCache, bool] = True, autotune: bool = False) -> None:
+    self.expression = expression
+    self.assumptions = assumptions
+    self.optimize = optimize
+    if optimize: expression = optimize_expression(expression)
     self.fxn_vars : List[str] = sorted(find_expression_vars(expression))
-    self.includes : set[str] = find_includes(expression, assume_complex=True)
-    self.fxn_code : str = ''.join(f'#include <{inc}>\n' for inc in self.includes)
-    self.fxn_code += '\ntypedef struct {\n  long double real;\n  long double imag;\n} LongDoubleComplex;\n\n'
-    self.fxn_code += f'void {self.fxn_name}(' + ', '.join(f'{"LongDoubleComplex"} {var}s' for var in self.fxn_vars) + ', LongDoubleComplex* res) {\n'
-    for var in self.fxn_vars: self.fxn_code += f'  long double complex {var} = {var}s.real + {var}s.imag*I;\n'
-    self.fxn_code += f'  long double complex result = {generate_expression_string(expression)};\n\n'
-    self.fxn_code += f'  res->real = creal(result);\n'
-    self.fxn_code += f'  res->imag = cimag(result);\n'
-    self.fxn_code += '}'
+    self.openmp = openmp
+    self.flags : List[str] = ['-O2'] + (['-fopenmp'] if openmp else [])
+    self.cache : Optional[SharedObjectCache] = cache if isinstance(cache, SharedObjectCache) else default_cache() if cache else None
+    domains = infer_domains([expression], assumptions)
+    self.real_vars = {var for var, domain in (assumptions or {}).items() if Domain.Real in close_domain(domain)}
+    # Note: When every input and the result are provably real the whole function is generated with double and math.h
+    self.real : bool = all(var in self.real_vars for var in self.fxn_vars) and Domain.Real in domains[id(expression)]
+    self.expression_code = generate_expression_string(expression, domains, C_DOUBLE_FUNCTIONS_MAP, optimize) if self.real else generate_expression_string(expression, domains, optimized=optimize)
+    # Note: The default name is derived from the generated code so identical programs produce identical sources and share cache entries
+    self.fxn_name : str = name or 'calcora_' + hashlib.sha1(f'{self.fxn_vars}{sorted(self.real_vars)}{self.real}{self.expression_code}'.encode()).hexdigest()[:16]
+    self.includes : set[str] = find_includes(expression, assume_complex=False) - {'complex.h'} if self.real else find_includes(expression, assume_complex=True)
+    if self.real:
+      self.body_code = f'double {self.fxn_name}(' + ', '.join(f'double {var}' for var in self.fxn_vars) + ') {\n'
+      self.body_code += f'  return {self.expression_code};\n'
+      self.body_code += '}\n'
+    else:
+      self.body_code = f'void {self.fxn_name}(' + ', '.join(f'{"LongDoubleComplex"} calcora_{var}_in' for var in self.fxn_vars) + ', LongDoubleComplex* calcora_res) {\n'
+      for var in self.fxn_vars: self.body_code += f'  long double {var} = calcora_{var}_in.real;\n' if var in self.real_vars else f'  long double complex {var} = calcora_{var}_in.real + calcora_{var}_in.imag*I;\n'
+      self.body_code += f'  long double complex calcora_result = {self.expression_code};\n\n'
+      self.body_code += f'  calcora_res->real = creal(calcora_result);\n'
+      self.body_code += f'  calcora_res->imag = cimag(calcora_result);\n'
+      self.body_code += '}\n'
+      self.body_code += self._scalar_code()
+    self.body_code += self._batch_code()
+    self.fxn_code : str = header_code(self.includes, not self.real) + self.body_code
     self.compiled : Optional[bytes] = None
     self.function : Optional[ctypes.CDLL]
+    self.scalar : Optional[Callable[..., Union[float, complex]]] = None
+    # Note: Block size and thread count used by batch, with autotune the first batch call loads or measures them
+    self.autotune = autotune
+    self.tuning : Optional[Tuning] = None
+
+  def _scalar_code(self) -> str:
+    # Note: Entry point for scalar calls from python, takes plain doubles and returns the result by value so a call does not have to build any structs
+    params = ', '.join(f'double calcora_{var}_in' if var in self.real_vars else f'double calcora_{var}_real, double calcora_{var}_imag' for var in self.fxn_vars)
+    code = f'\nDoubleComplex {self.fxn_name}_scalar({params or "void"}) {{\n'
+    code += '  LongDoubleComplex calcora_res;\n'
+    args = ''.join(f'(LongDoubleComplex){{calcora_{var}_in, 0}}, ' if var in self.real_vars else f'(LongDoubleComplex){{calcora_{var}_real, calcora_{var}_imag}}, ' for var in self.fxn_vars)
+    code += f'  {self.fxn_name}({args}&calcora_res);\n'
+    code += '  return (DoubleComplex){(double)calcora_res.real, (double)calcora_res.imag};\n'
+    code += '}\n'
+    return code
+
+  def _batch_code(self) -> str:
+    # Note: Array kernel, inputs are double or double complex so numpy float64 and complex128 buffers can be passed without copying.
+    # Every iteration is independent and the pointers are restrict so the loop can be vectorized and split across threads.
+    # The kernel's own identifiers are prefixed with calcora_ so they cannot clash with the variables declared in the loop
+    in_types = {var: 'double' if self.real or var in self.real_vars else 'double complex' for var in self.fxn_vars}
+    out_type = 'double' if self.real else 'double complex'
+    code = f'\nvoid {self.fxn_name}_batch(' + ''.join(f'const {in_types[var]}* restrict calcora_{var}_in, ' for var in self.fxn_vars) + f'{out_type}* restrict calcora_out, long calcora_n) {{\n'
+    code += f'  #pragma omp parallel for schedule(static) if(calcora_n > {BATCH_PARALLEL_THRESHOLD})\n'
+    code += '  for (long calcora_i = 0; calcora_i < calcora_n; calcora_i++) {\n'
+    for var in self.fxn_vars: code += f'    {"double" if self.real else "long double" if var in self.real_vars else "long double complex"} {var} = calcora_{var}_in[calcora_i];\n'
+    code += f'    calcora_out[calcora_i] = {self.expression_code};\n'
+    code += '  }\n}\n'
+    return code
 
   def compile(self) -> None:
-    with tempfile.NamedTemporaryFile(delete=True) as output_file:
-      arguments = f"clang -x c - -shared -O2 -o {output_file.name}".split()
-      try: subprocess.check_output(args=arguments, input=self.fxn_code.encode("utf-8"), stderr=subprocess.PIPE)
-      except subprocess.CalledProcessError as e: print(f"Error during compilation: {e.stderr.decode()}")
-      self.compiled = pathlib.Path(output_file.name).read_bytes()
-      self.function = ctypes.CDLL(str(output_file.name))
+    self.compiled, function = compile_shared_object(self.fxn_code, self.flags, self.cache, self.fxn_name)
+    self._bind(function)
+
+  def _bind(self, function: ctypes.CDLL) -> None:
+    self.function = function
+    if self.real:
+      getattr(self.function, self.fxn_name).argtypes = [ctypes.c_double] * len(self.fxn_vars)
+      getattr(self.function, self.fxn_name).restype = ctypes.c_double
+      self.scalar = getattr(self.function, self.fxn_name)
+    else:
       getattr(self.function, self.fxn_name).argtypes = [LongDoubleComplex] * len(self.fxn_vars) + [ctypes.POINTER(LongDoubleComplex)]
       getattr(self.function, self.fxn_name).restype = None
+      scalar = getattr(self.function, f'{self.fxn_name}_scalar')
+      scalar.argtypes = [ctypes.c_double for var in self.fxn_vars for _ in range(1 if var in self.real_vars else 2)]
+      scalar.restype = DoubleComplex
+      self.scalar = self._scalar_stub(scalar)
+    getattr(self.function, f'{self.fxn_name}_batch').argtypes = [ctypes.c_void_p] * (len(self.fxn_vars) + 1) + [ctypes.c_long]
+    getattr(self.function, f'{self.fxn_name}_batch').restype = None
 
-  def _longdoublecomplexcast(self, *vals: Union[float, complex, Expr, LongDoubleComplex]) -> List[LongDoubleComplex]:
+  def batch(self, *args: Any, out: Optional[NDArray[Any]] = None, block: Optional[int] = None, threads: Optional[int] = None) -> NDArray[Any]:
+    import numpy
+    if len(args) != len(self.fxn_vars): raise TypeError(f"Function requires {len(self.fxn_vars)} arguments ({','.join(self.fxn_vars)}) but {len(args)} were given")
+    if not self.compiled: self.compile()
+    dtypes = [numpy.float64 if self.real or var in self.real_vars else numpy.complex128 for var in self.fxn_vars]
+    # Note: Arrays that already have the right dtype and are contiguous are passed to the kernel as is
+    arrays = [numpy.asarray(arg) for arg in args]
+    for i, (var, dtype) in enumerate(zip(self.fxn_vars, dtypes)):
+      if dtype is numpy.float64 and numpy.iscomplexobj(arrays[i]):
+        if numpy.any(arrays[i].imag): raise TypeError(f"Cannot pass a complex value to the real variable '{var}'")
+        arrays[i] = arrays[i].real
+    shape = numpy.broadcast_shapes(*(array.shape for array in arrays))
+    arrays = [numpy.ascontiguousarray(numpy.broadcast_to(array, shape) if array.shape != shape else array, dtype=dtype) for array, dtype in zip(arrays, dtypes)]
+    out_dtype = numpy.float64 if self.real else numpy.complex128
+    if out is None: out = numpy.empty(shape, dtype=out_dtype)
+    elif out.shape != shape or out.dtype != out_dtype or not out.flags.c_contiguous or not out.flags.writeable: raise ValueError(f"Output array must be a writeable C contiguous {numpy.dtype(out_dtype)} array of shape {shape}")
+    if self.autotune and self.tuning is None and self.fxn_vars: # Note: Without variables there is a single value and nothing to tune
+      from calcora.codegen.autotune import autotune
+      autotune(self)
+    if block is None and threads is None and self.tuning is not None: block, threads = self.tuning.block, self.tuning.threads
+    self._run_batch(arrays, out, block, threads)
+    return out
+
+  def _run_batch(self, arrays: List[NDArray[Any]], out: NDArray[Any], block: Optional[int], threads: Optional[int]) -> None:
+    if block is not None and block < 1: raise ValueError("Block size must be positive")
+    kernel = getattr(self.function, f'{self.fxn_name}_batch')
+    n = out.size
+    if block is None and threads is not None and threads > 1: block = -(-n // threads)
+    if block is None or block >= n:
+      kernel(*(array.ctypes.data for array in arrays), out.ctypes.data, n)
+      return
+    # Note: ctypes releases the GIL during the call so blocks handed to the pool run in parallel, each block is a contiguous slice of every array
+    def run(start: int) -> None:
+      count = min(block, n - start)
+      kernel(*(array.ctypes.data + start * array.itemsize for array in arrays), out.ctypes.data + start * out.itemsize, count)
+    starts = range(0, n, block)
+    if not threads or threads <= 1:
+      for start in starts: run(start)
+    else: list(batch_executor(threads).map(run, starts))
+
+  def _scalar_stub(self, scalar: Callable[..., DoubleComplex]) -> Callable[..., complex]:
+    # Note: Generated once per program so a call only splits the arguments into doubles and reads the result
+    params = [f'v{i}' for i in range(len(self.fxn_vars))]
+    args = ', '.join(param if var in self.real_vars else f'{param}.real, {param}.imag' for param, var in zip(params, self.fxn_vars))
+    namespace : Dict[str, Any] = {'scalar': scalar}
+    exec(f'def stub({", ".join(params)}):\n  res = scalar({args})\n  return complex(res.real, res.imag)\n', namespace)
+    stub : Callable[..., complex] = namespace['stub']
+    return stub
+
+  def _complexcast(self, *vals: Union[float, complex, Expr, LongDoubleComplex]) -> List[Union[float, complex]]:
+    res : List[Union[float, complex]] = []
+    for var, val in zip(self.fxn_vars, vals):
+      if is_expr(val):
+        value = val._eval()
+        res.append(complex(value) if value.imag else float(value.real))
+      elif isinstance(val, LongDoubleComplex): res.append(complex(val.real, val.imag))
+      elif isinstance(val, (int, float, complex)): res.append(val)
+      else: raise TypeError(f"Cannot create LongDoubleComplex from type: {type(val)}")
+      if var in self.real_vars:
+        if res[-1].imag: raise TypeError(f"Cannot pass a complex value to the real variable '{var}'")
+        res[-1] = res[-1].real
+    return res
+        
+  def _doublecast(self, *vals: Union[float, Expr]) -> List[float]:
     res = []
     for val in vals:
       if is_expr(val): 
         value = val._eval()
-        if value.imag: res.append(LongDoubleComplex.from_python(complex(value)))
-        else: res.append(LongDoubleComplex.from_python(float(value)))
-      elif isinstance(val, LongDoubleComplex): res.append(val)
-      elif isinstance(val, (int, float, complex)): res.append(LongDoubleComplex.from_python(val))
-      else: raise TypeError(f"Cannot create LongDoubleComplex from type: {type(val)}")
+        if value.imag: raise TypeError("Cannot pass a complex value to a real function")
+        res.append(float(value.real))
+      elif isinstance(val, (int, float)): res.append(float(val))
+      else: raise TypeError(f"Cannot create double from type: {type(val)}")
     return res
-        
-  def __call__(self, *args: Union[int, float, complex, Expr, LongDoubleComplex]) -> complex:
-    new_args = self._longdoublecomplexcast(*args)
+
+  def __call__(self, *args: Union[int, float, complex, Expr, LongDoubleComplex]) -> Union[float, complex]:
     if len(args) != len(self.fxn_vars): raise TypeError(f"Function requires {len(self.fxn_vars)} arguments ({','.join(self.fxn_vars)}) but {len(args)} were given")
-    if self.compiled:
-      res_var = LongDoubleComplex()
-      getattr(self.function, self.fxn_name)(*new_args, ctypes.byref(res_var))
-      print(type(self.function))
-      return complex(res_var.real, res_var.imag)
-    else: self.compile(); return self.__call__(*new_args)
+    if self.scalar is None: self.compile()
+    assert self.scalar is not None
+    # Note: Plain numbers go straight to the stub, anything else is converted first
+    try: return self.scalar(*args)
+    except (ctypes.ArgumentError, AttributeError): return self.scalar(*(self._doublecast(*args) if self.real else self._complexcast(*args))) # type: ignore[arg-type]
+
+C_IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+class ClangModule:
+  # Note: Compiles many expressions into a single shared object, each expression is exposed as a ClangProgram bound to the shared library
+  def __init__(self, expressions: Mapping[str, Expr], assumptions: Optional[Mapping[str, Domain]] = None, optimize: bool = False, openmp: bool = False,
+               cache: Union[SharedObjectCache, bool] = True, prefix: str = 'calcora_') -> None:
+    for name in expressions:
+      if not C_IDENTIFIER.fullmatch(name): raise ValueError(f"Function name '{name}' is not a valid C identifier")
+    self.programs : Dict[str, ClangProgram] = {name: ClangProgram(expression, f'{prefix}{name}', assumptions, optimize, openmp, cache) for name, expression in expressions.items()}
+    self.flags : List[str] = ['-O2'] + (['-fopenmp'] if openmp else [])
+    self.cache : Optional[SharedObjectCache] = cache if isinstance(cache, SharedObjectCache) else default_cache() if cache else None
+    includes = set().union(*(program.includes for program in self.programs.values()))
+    self.fxn_code : str = header_code(includes, any(not program.real for program in self.programs.values()))
+    self.fxn_code += '\n'.join(program.body_code for program in self.programs.values())
+    self.compiled : Optional[bytes] = None
+    self.function : Optional[ctypes.CDLL] = None
+
+  def compile(self) -> None:
+    self.compiled, self.function = compile_shared_object(self.fxn_code, self.flags, self.cache)
+    for program in self.programs.values():
+      program.compiled = self.compiled
+      program._bind(self.function)
+
+  def __getitem__(self, name: str) -> ClangProgram:
+    if not self.compiled: self.compile()
+    return self.programs[name]
+
+  def __getattr__(self, name: str) -> ClangProgram:
+    if name.startswith('_') or name not in self.__dict__.get('programs', {}): raise AttributeError(name)
+    return self[name]
+
+  def __contains__(self, name: str) -> bool: return name in self.programs
+  def __iter__(self) -> Iterator[str]: return iter(self.programs)
+  def __len__(self) -> int: return len(self.programs)
+
+_executor : Optional[concurrent.futures.Executor] = None
+_batch_executors : Dict[int, concurrent.futures.Executor] = {}
+
+def compile_executor() -> concurrent.futures.Executor:
+  global _executor
+  if _executor is None: _executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix='calcora-compile')
+  return _executor
+
+def batch_executor(threads: int) -> concurrent.futures.Executor:
+  if (executor := _batch_executors.get(threads)) is None: executor = _batch_executors[threads] = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix='calcora-batch')
+  return executor
+
+class AsyncClangProgram:
+  # Note: Compiles in the background and answers calls with lambdify until the native function is ready, then switches over.
+  # A failed compile never reaches the caller through __call__, the error is raised from result() and kept in error
+  def __init__(self, expression: Expr, name: Optional[str] = None, assumptions: Optional[Mapping[str, Domain]] = None, optimize: bool = False, openmp: bool = False,
+               cache: Union[SharedObjectCache, bool] = True, executor: Optional[concurrent.futures.Executor] = None) -> None:
+    self.program = ClangProgram(expression, name, assumptions, optimize, openmp, cache)
+    self.expression = expression
+    self.fallback = lambdify(expression, 'python', automatic_vars=False, vars=self.program.fxn_vars, assumptions=assumptions or {})
+    self._batch_fallback : Optional[Callable[..., Any]] = None
+    self._call : Callable[..., Any] = self._fallback_call
+    self._batch : Optional[Callable[..., Any]] = None
+    self.error : Optional[BaseException] = None
+    self.future = (executor or compile_executor()).submit(self.program.compile)
+    self.future.add_done_callback(self._switch)
+
+  def _switch(self, future: concurrent.futures.Future[None]) -> None:
+    if (error := future.exception()) is not None: self.error = error
+    else: self._call, self._batch = self.program, self.program.batch
+
+  @property
+  def ready(self) -> bool: return self._batch is not None
+
+  def result(self, timeout: Optional[float] = None) -> ClangProgram:
+    try: self.future.result(timeout)
+    finally:
+      if self.future.done(): self._switch(self.future) # Note: Waiters can wake up before the done callback has run
+    return self.program
+
+  def _fallback_call(self, *args: Any) -> Union[float, complex]:
+    # Note: Converted to what the native function returns so the result type does not change once it is ready
+    res = self.fallback(*args)
+    return float(res.real) if self.program.real else complex(res)
+
+  def __call__(self, *args: Any) -> Any: return self._call(*args)
+
+  def batch(self, *args: Any, out: Optional[NDArray[Any]] = None) -> NDArray[Any]:
+    if self._batch is not None: return self._batch(*args, out=out) # type: ignore[no-any-return]
+    if self._batch_fallback is None: self._batch_fallback = lambdify(self.expression, 'numpy', automatic_vars=False, vars=self.program.fxn_vars, assumptions={})
+    import numpy
+    res = numpy.asarray(self._batch_fallback(*args), dtype=numpy.float64 if self.program.real else numpy.complex128)
+    if out is None: return res
+    out[...] = res
+    return out
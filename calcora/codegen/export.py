@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+from typing import List, Mapping, Optional, Union
+from typing import TYPE_CHECKING
+
+import importlib.util
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import sysconfig
+import types
+
+from calcora.codegen.ccompiler import C_IDENTIFIER, c_compiler, ClangModule, ClangProgram, CompilationError
+from calcora.core.domain import Domain
+
+if TYPE_CHECKING:
+  from calcora.core.expression import Expr
+
+EXTENSION_HELPERS = r'''
+static int calcora_get_buffer(PyObject* object, Py_buffer* view, int flags, const char* format, Py_ssize_t itemsize) {
+  if (PyObject_GetBuffer(object, view, flags | PyBUF_FORMAT | PyBUF_C_CONTIGUOUS) < 0) return -1;
+  const char* actual = view->format ? view->format : "B";
+  while (*actual == '@' || *actual == '=' || (PY_LITTLE_ENDIAN && *actual == '<')) actual++;
+  if (view->itemsize != itemsize || strcmp(actual, format) != 0) {
+    PyErr_Format(PyExc_TypeError, "expected a C contiguous buffer of format '%s' but got '%s'", format, view->format ? view->format : "B");
+    PyBuffer_Release(view);
+    return -1;
+  }
+  return 0;
+}
+
+static PyObject* calcora_new_output(Py_ssize_t length) {
+  /* Note: A memoryview of doubles over a new bytearray, complex results are stored as interleaved real and imaginary parts */
+  PyObject* bytes = PyByteArray_FromStringAndSize(NULL, length * (Py_ssize_t)sizeof(double));
+  if (!bytes) return NULL;
+  PyObject* view = PyMemoryView_FromObject(bytes);
+  Py_DECREF(bytes);
+  if (!view) return NULL;
+  PyObject* res = PyObject_CallMethod(view, "cast", "s", "d");
+  Py_DECREF(view);
+  return res;
+}
+'''
+
+def _c_string(value: str) -> str: return json.dumps(value)
+
+def _scalar_wrapper(name: str, program: ClangProgram) -> str:
+  n = len(program.fxn_vars)
+  code = f'\nstatic PyObject* calcora_py_{name}(PyObject* self, PyObject* const* args, Py_ssize_t nargs) {{\n'
+  code += f'  if (nargs != {n}) {{ PyErr_Format(PyExc_TypeError, "{name}() takes {n} arguments ({", ".join(program.fxn_vars)}) but %zd were given", nargs); return NULL; }}\n'
+  call_args = []
+  for i, var in enumerate(program.fxn_vars):
+    if program.real or var in program.real_vars:
+      code += f'  double a{i} = PyFloat_AsDouble(args[{i}]);\n  if (a{i} == -1.0 && PyErr_Occurred()) return NULL;\n'
+      call_args.append(f'a{i}')
+    else:
+      code += f'  Py_complex a{i} = PyComplex_AsCComplex(args[{i}]);\n  if (a{i}.real == -1.0 && PyErr_Occurred()) return NULL;\n'
+      call_args.append(f'a{i}.real, a{i}.imag')
+  if program.real: code += f'  return PyFloat_FromDouble({program.fxn_name}({", ".join(call_args)}));\n}}\n'
+  else: code += f'  DoubleComplex res = {program.fxn_name}_scalar({", ".join(call_args)});\n  return PyComplex_FromDoubles(res.real, res.imag);\n}}\n'
+  return code
+
+def _batch_wrapper(name: str, program: ClangProgram) -> str:
+  n = len(program.fxn_vars)
+  formats = ['d' if program.real or var in program.real_vars else 'Zd' for var in program.fxn_vars]
+  out_format, out_size = ('d', 8) if program.real else ('Zd', 16)
+  code = f'\nstatic PyObject* calcora_py_{name}_batch(PyObject* self, PyObject* const* args, Py_ssize_t nargs) {{\n'
+  code += f'  if (nargs != {n} && nargs != {n + 1}) {{ PyErr_Format(PyExc_TypeError, "{name}_batch() takes {n} arrays ({", ".join(program.fxn_vars)}) and an optional output but %zd arguments were given", nargs); return NULL; }}\n'
+  if not n: code += f'  if (nargs == 0) {{ PyErr_SetString(PyExc_TypeError, "{name}_batch() has no inputs and needs an output buffer"); return NULL; }}\n'
+  code += f'  Py_buffer views[{n + 1}], out;\n  int acquired = 0, has_out = 0;\n  Py_ssize_t length = -1;\n  PyObject* res = NULL;\n'
+  for i, format in enumerate(formats):
+    code += f'  if (calcora_get_buffer(args[{i}], &views[{i}], PyBUF_SIMPLE, "{format}", {16 if format == "Zd" else 8}) < 0) goto done;\n  acquired++;\n'
+    code += f'  if (length >= 0 && views[{i}].len / views[{i}].itemsize != length) {{ PyErr_SetString(PyExc_ValueError, "all arrays must have the same number of elements"); goto done; }}\n'
+    code += f'  length = views[{i}].len / views[{i}].itemsize;\n'
+  code += f'  if (nargs == {n + 1}) {{\n    res = args[{n}];\n    Py_INCREF(res);\n'
+  code += f'    if (calcora_get_buffer(res, &out, PyBUF_WRITABLE, "{out_format}", {out_size}) < 0) {{ Py_CLEAR(res); goto done; }}\n  }}\n'
+  code += f'  else {{\n    if (!(res = calcora_new_output(length * {out_size // 8}))) goto done;\n'
+  code += '    if (calcora_get_buffer(res, &out, PyBUF_WRITABLE, "d", 8) < 0) { Py_CLEAR(res); goto done; }\n  }\n  has_out = 1;\n'
+  if n: code += f'  if (out.len / {out_size} != length) {{ PyErr_SetString(PyExc_ValueError, "output must have the same number of elements as the inputs"); Py_CLEAR(res); goto done; }}\n'
+  else: code += f'  length = out.len / {out_size};\n'
+  args = ''.join(f'views[{i}].buf, ' for i in range(n))
+  code += f'  Py_BEGIN_ALLOW_THREADS\n  {program.fxn_name}_batch({args}out.buf, (long)length);\n  Py_END_ALLOW_THREADS\n'
+  code += 'done:\n  for (int i = 0; i < acquired; i++) PyBuffer_Release(&views[i]);\n  if (has_out) PyBuffer_Release(&out);\n  return res;\n}\n'
+  return code
+
+def extension_source(expressions: Mapping[str, Expr], module_name: str, assumptions: Optional[Mapping[str, Domain]] = None, optimize: bool = False, openmp: bool = False) -> str:
+  # Note: A self contained CPython extension module, every expression name becomes a scalar function taking its sorted variables as floats or complex
+  # numbers and a name_batch function taking buffers (numpy arrays, array.array, memoryviews) of float64 or complex128 and an optional output buffer.
+  # Without an output a memoryview of doubles is returned, interleaved real and imaginary parts for complex results. The module has a variables dict
+  if not C_IDENTIFIER.fullmatch(module_name): raise ValueError(f"Module name '{module_name}' is not a valid C identifier")
+  names = set(expressions)
+  for name in expressions:
+    if f'{name}_batch' in names: raise ValueError(f"Function name '{name}_batch' clashes with the batch function of '{name}'")
+    if name == 'variables': raise ValueError("Function name 'variables' is reserved")
+  module = ClangModule(expressions, assumptions, optimize, openmp, cache=False, prefix=f'{module_name}_')
+  code = '#define PY_SSIZE_T_CLEAN\n#include <Python.h>\n#include <string.h>\n' + module.fxn_code + EXTENSION_HELPERS
+  methods = []
+  for name, program in module.programs.items():
+    code += _scalar_wrapper(name, program) + _batch_wrapper(name, program)
+    doc = f'{name}({", ".join(program.fxn_vars)}) = {expressions[name]}'
+    methods.append(f'  {{"{name}", (PyCFunction)(void(*)(void))calcora_py_{name}, METH_FASTCALL, {_c_string(doc)}}},\n')
+    methods.append(f'  {{"{name}_batch", (PyCFunction)(void(*)(void))calcora_py_{name}_batch, METH_FASTCALL, {_c_string(f"Evaluates {name} over buffers of its arguments")}}},\n')
+  code += f'\nstatic PyMethodDef calcora_methods[] = {{\n{"".join(methods)}  {{NULL, NULL, 0, NULL}}\n}};\n'
+  code += f'\nstatic struct PyModuleDef calcora_module = {{PyModuleDef_HEAD_INIT, "{module_name}", "Expressions compiled by calcora", -1, calcora_methods}};\n'
+  variables_format = '{' + ','.join(f's:({"s" * len(program.fxn_vars)})' for program in module.programs.values()) + '}'
+  variables_args = ''.join(', ' + ', '.join([_c_string(name)] + [_c_string(var) for var in program.fxn_vars]) for name, program in module.programs.items())
+  code += f'\nPyMODINIT_FUNC PyInit_{module_name}(void) {{\n  PyObject* module = PyModule_Create(&calcora_module);\n  if (!module) return NULL;\n'
+  code += f'  PyObject* variables = Py_BuildValue("{variables_format}"{variables_args});\n'
+  code += '  if (!variables || PyModule_AddObject(module, "variables", variables) < 0) { Py_XDECREF(variables); Py_DECREF(module); return NULL; }\n  return module;\n}\n'
+  return code
+
+def build_extension(expressions: Mapping[str, Expr], module_name: str, directory: Union[str, os.PathLike[str], None] = None, assumptions: Optional[Mapping[str, Domain]] = None,
+                    optimize: bool = False, openmp: bool = False) -> pathlib.Path:
+  # Note: Writes module_name.c to directory and builds it into an extension module for the running interpreter, the returned path can be
+  # shipped and imported without a C compiler
+  directory = pathlib.Path(directory) if directory is not None else pathlib.Path.cwd()
+  directory.mkdir(parents=True, exist_ok=True)
+  source = directory / f'{module_name}.c'
+  source.write_text(extension_source(expressions, module_name, assumptions, optimize, openmp))
+  output = directory / f'{module_name}{sysconfig.get_config_var("EXT_SUFFIX")}'
+  flags : List[str] = ['-O2'] + (['-fopenmp'] if openmp else []) + (['-undefined', 'dynamic_lookup'] if sys.platform == 'darwin' else [])
+  compiler = c_compiler()
+  arguments = [compiler, '-shared', '-fPIC', *flags, f'-I{sysconfig.get_paths()["include"]}', str(source), '-o', str(output), '-lm']
+  try: subprocess.check_output(arguments, stderr=subprocess.PIPE)
+  except subprocess.CalledProcessError as e: raise CompilationError(f"Error during compilation: {e.stderr.decode()}", e.stderr.decode()) from e
+  except OSError as e: raise CompilationError(f"Could not run C compiler '{compiler}': {e}") from e
+  return output
+
+def load_extension(path: Union[str, os.PathLike[str]]) -> types.ModuleType:
+  # Note: Imports a built extension from its path, the module name is the part of the file name before the first dot
+  path = pathlib.Path(path)
+  spec = importlib.util.spec_from_file_location(path.name.split('.')[0], path)
+  if spec is None or spec.loader is None: raise ImportError(f"Cannot load extension module from {path}")
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
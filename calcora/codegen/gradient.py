@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Tuple, Union
+from typing import TYPE_CHECKING
+
+import ctypes
+import hashlib
+
+from calcora.codegen.cache import default_cache, SharedObjectCache
+from calcora.codegen.ccode import C_DOUBLE_FUNCTIONS_MAP, C_LONG_DOUBLE_FUNCTIONS_MAP, find_includes, generate_expression_string
+from calcora.codegen.ccompiler import compile_shared_object, header_code
+from calcora.codegen.lambdify import backend_namespace, compile_function, domain_function_maps, find_expression_vars, generate_function_source
+from calcora.codegen.lambdify import mpmath_function_map, numpy_function_map, python_function_map
+from calcora.codegen.optimize import literal_value, Optimizer
+from calcora.core.cse import cse, ExprDAG, is_leaf, numbered_symbols
+from calcora.core.domain import close_domain, Domain, infer_domains
+from calcora.core.ops import Add, Complex, Const, Cos, Log, Mul, Neg, Pow, Sin, Var
+from calcora.core.constants import E, I, NegOne, One, Two, Zero
+from calcora.core.numeric import Numeric
+
+if TYPE_CHECKING:
+  from calcora.core.expression import Expr
+
+def _number(value: float) -> Expr:
+  magnitude = Const(Numeric(int(abs(value)) if value == int(value) else abs(value)))
+  return magnitude if value >= 0 else Neg(magnitude)
+
+def _mul(x: Expr, y: Expr) -> Expr:
+  if x is One: return y
+  if y is One: return x
+  if y is NegOne: return Neg(x)
+  return Mul(x, y)
+
+def _sum(terms: List[Expr]) -> Expr:
+  result = terms[0]
+  for term in terms[1:]: result = Add(result, term)
+  return result
+
+def _partials(node: Expr, args: Sequence[Expr], active: Sequence[bool]) -> List[Optional[Expr]]:
+  # Note: Local derivatives of node with respect to each of its args, None for args that do not depend on a differentiated variable
+  if isinstance(node, Add): partials : List[Optional[Expr]] = [One, One]
+  elif isinstance(node, Neg): partials = [NegOne]
+  elif isinstance(node, Mul): partials = [args[1], args[0]]
+  elif isinstance(node, Complex): partials = [One, I]
+  elif isinstance(node, Sin): partials = [Cos(args[0])]
+  elif isinstance(node, Cos): partials = [Neg(Sin(args[0]))]
+  elif isinstance(node, Pow):
+    x, y = args
+    n = literal_value(y)
+    if n == 0: dx : Optional[Expr] = None # Note: x^0 is constant, building 0*x^-1 would give nan at x = 0
+    elif n == 1: dx = One
+    elif n == 2: dx = Mul(Two, x)
+    else: dx = Mul(y, Pow(x, _number(n - 1) if n is not None else Add(y, NegOne)))
+    partials = [dx, Mul(node, Log(x, E)) if active[1] else None]
+  elif isinstance(node, Log):
+    x, base = args
+    ln_base = Log(base, E) if base != E else None
+    partials = [Pow(x if ln_base is None else Mul(x, ln_base), NegOne),
+                Neg(Mul(node, Pow(Mul(base, ln_base or One), NegOne))) if active[1] else None]
+  else: raise TypeError(f"Cannot differentiate op {type(node).__name__}")
+  return [partial if is_active else None for partial, is_active in zip(partials, active)]
+
+def gradient_expressions(expression: Expr, wrt: Sequence[str]) -> List[Expr]:
+  # Note: Reverse mode differentiation, the adjoint of every node is accumulated once from its parents so the partial derivatives
+  # share the intermediates of the expression and each other instead of differentiating the whole tree once per variable
+  dag = ExprDAG([expression])
+  active = [False] * len(dag)
+  for i, (node, children) in enumerate(zip(dag.nodes, dag.children)):
+    active[i] = (isinstance(node, Var) and node.name in wrt) or any(active[c] for c in children)
+  contributions : List[List[Expr]] = [[] for _ in range(len(dag))]
+  contributions[dag.roots[0]].append(One)
+  for i in reversed(range(len(dag))):
+    node, children = dag.nodes[i], dag.children[i]
+    if not active[i] or not contributions[i] or is_leaf(node): continue
+    adjoint = _sum(contributions[i])
+    for child, partial in zip(children, _partials(node, [dag.nodes[c] for c in children], [active[c] for c in children])):
+      if partial is not None: contributions[child].append(_mul(adjoint, partial))
+  index = {node.name: i for i, node in enumerate(dag.nodes) if isinstance(node, Var)}
+  return [_sum(contributions[index[name]]) if name in index and contributions[index[name]] else Zero for name in wrt]
+
+def lambdify_gradient(expression: Expr, backend: str = 'python', wrt: Optional[Sequence[str]] = None, assumptions: Optional[Mapping[str, Domain]] = None, optimize: bool = False) -> Callable[..., Any]:
+  # Note: Returns a function of the sorted variables that evaluates to (value, gradient), the value and every partial derivative are generated
+  # as one function so shared intermediates are only computed once. The gradient is written into grad instead when it is given
+  if backend not in ('mpmath', 'python', 'numpy'): raise ValueError(f"Invalid backend {backend}, must be mpmath, python or numpy")
+  var_names = sorted(find_expression_vars(expression))
+  wrt = list(wrt) if wrt is not None else var_names
+  roots = [expression, *gradient_expressions(expression, wrt)]
+  if optimize:
+    optimizer = Optimizer()
+    roots = [optimizer(root) for root in roots]
+  namespace = backend_namespace(backend)
+  lambda_map = {'mpmath': mpmath_function_map, 'python': python_function_map, 'numpy': numpy_function_map}[backend]
+  if assumptions is not None:
+    real_map, lambda_map = domain_function_maps[backend]
+    source, hoisted = generate_function_source(roots, lambda_map, var_names, namespace, domains=infer_domains(roots, assumptions), real_function_map=real_map, optimized=optimize)
+  else: source, hoisted = generate_function_source(roots, lambda_map, var_names, namespace, optimized=optimize)
+  fxn = compile_function(source, hoisted, namespace)
+  def value_and_gradient(*args: Any, grad: Optional[Any] = None) -> Tuple[Any, Any]:
+    value, *gradient = fxn(*args)
+    if grad is None: return value, tuple(gradient)
+    for i, partial in enumerate(gradient): grad[i] = partial
+    return value, grad
+  value_and_gradient.source = source # type: ignore[attr-defined]
+  return value_and_gradient
+
+class ClangGradientProgram:
+  # Note: Generates a single C function computing the value and the partial derivatives with respect to wrt, intermediates shared between them are
+  # assigned to locals once. Real programs have the signature double f(double x..., double* grad), complex ones take the real and imaginary part of every
+  # complex variable and write the value and gradient as interleaved real and imaginary parts
+  def __init__(self, expression: Expr, wrt: Optional[Sequence[str]] = None, name: Optional[str] = None, assumptions: Optional[Mapping[str, Domain]] = None,
+               optimize: bool = False, cache: Union[SharedObjectCache, bool] = True) -> None:
+    self.expression = expression
+    self.fxn_vars : List[str] = sorted(find_expression_vars(expression))
+    self.wrt : List[str] = list(wrt) if wrt is not None else self.fxn_vars
+    self.flags : List[str] = ['-O2']
+    self.cache : Optional[SharedObjectCache] = cache if isinstance(cache, SharedObjectCache) else default_cache() if cache else None
+    roots = [expression, *gradient_expressions(expression, self.wrt)]
+    if optimize:
+      optimizer = Optimizer()
+      roots = [optimizer(root) for root in roots]
+    replacements, reduced = cse(roots, symbols=numbered_symbols('_t', self.fxn_vars))
+    domains : Dict[str, Domain] = {var: close_domain(domain) for var, domain in (assumptions or {}).items()}
+    self.real_vars = {var for var, domain in domains.items() if Domain.Real in domain}
+    node_domains : List[Dict[int, Domain]] = []
+    for symbol, replacement in replacements:
+      node_domains.append(infer_domains([replacement], domains))
+      domains[symbol.name] = node_domains[-1][id(replacement)]
+    root_domains = infer_domains(reduced, domains)
+    self.real : bool = all(var in self.real_vars for var in self.fxn_vars) and all(Domain.Real in root_domains[id(root)] for root in reduced) \
+                       and all(Domain.Real in domains[symbol.name] for symbol, _ in replacements)
+    functions = C_DOUBLE_FUNCTIONS_MAP if self.real else C_LONG_DOUBLE_FUNCTIONS_MAP
+    real_type = 'double' if self.real else 'long double'
+    lines = []
+    for (symbol, replacement), replacement_domains in zip(replacements, node_domains):
+      lines.append(f'  {real_type if Domain.Real in domains[symbol.name] else "long double complex"} {symbol.name} = {generate_expression_string(replacement, replacement_domains, functions, optimize)};')
+    codes = [generate_expression_string(root, root_domains, functions, optimize) for root in reduced]
+    self.expression_code = '\n'.join(lines + codes)
+    self.fxn_name : str = name or 'calcora_grad_' + hashlib.sha1(f'{self.fxn_vars}{self.wrt}{sorted(self.real_vars)}{self.real}{self.expression_code}'.encode()).hexdigest()[:16]
+    self.includes : set[str] = set().union(*(find_includes(root, assume_complex=not self.real) for root in roots))
+    if self.real:
+      self.includes.discard('complex.h')
+      params = ''.join(f'double {var}, ' for var in self.fxn_vars)
+      body = f'double {self.fxn_name}({params}double* restrict calcora_grad) {{\n' + ''.join(line + '\n' for line in lines)
+      body += ''.join(f'  calcora_grad[{i}] = {code};\n' for i, code in enumerate(codes[1:]))
+      body += f'  return {codes[0]};\n}}\n'
+    else:
+      params = ''.join(f'double calcora_{var}_in, ' if var in self.real_vars else f'double calcora_{var}_real, double calcora_{var}_imag, ' for var in self.fxn_vars)
+      body = f'void {self.fxn_name}({params}double* restrict calcora_value, double* restrict calcora_grad) {{\n'
+      body += ''.join(f'  long double {var} = calcora_{var}_in;\n' if var in self.real_vars else f'  long double complex {var} = calcora_{var}_real + calcora_{var}_imag*I;\n' for var in self.fxn_vars)
+      body += ''.join(line + '\n' for line in lines)
+      body += f'  long double complex calcora_result = {codes[0]};\n  calcora_value[0] = creall(calcora_result);\n  calcora_value[1] = cimagl(calcora_result);\n'
+      for i, code in enumerate(codes[1:]): body += f'  calcora_result = {code};\n  calcora_grad[{2*i}] = creall(calcora_result);\n  calcora_grad[{2*i+1}] = cimagl(calcora_result);\n'
+      body += '}\n'
+    self.fxn_code : str = header_code(self.includes, False) + body
+    self.compiled : Optional[bytes] = None
+    self.function : Optional[Callable[..., Any]] = None
+    self._buffer_type : Any = None
+
+  def compile(self) -> None:
+    self.compiled, library = compile_shared_object(self.fxn_code, self.flags, self.cache, self.fxn_name)
+    function = getattr(library, self.fxn_name)
+    if self.real:
+      function.argtypes = [ctypes.c_double] * len(self.fxn_vars) + [ctypes.c_void_p]
+      function.restype = ctypes.c_double
+    else:
+      function.argtypes = [ctypes.c_double for var in self.fxn_vars for _ in range(1 if var in self.real_vars else 2)] + [ctypes.c_void_p] * 2
+      function.restype = None
+    self.function = function
+    self._buffer_type = ctypes.c_double * (len(self.wrt) if self.real else 2 * len(self.wrt))
+
+  def __call__(self, *args: Union[int, float, complex], grad: Optional[Any] = None) -> Tuple[Union[float, complex], Any]:
+    # Note: grad can be any writeable buffer of doubles, or of complex doubles for complex programs, such as a numpy array or array.array.
+    # Without it the gradient is returned as a list, ctypes double arrays are passed through without any conversion
+    if len(args) != len(self.fxn_vars): raise TypeError(f"Function requires {len(self.fxn_vars)} arguments ({','.join(self.fxn_vars)}) but {len(args)} were given")
+    if self.function is None: self.compile()
+    assert self.function is not None
+    buffer = self._buffer_type() if grad is None else grad if isinstance(grad, self._buffer_type) else self._buffer_type.from_buffer(grad)
+    if self.real:
+      value : Union[float, complex] = self.function(*args, buffer)
+      return value, list(buffer) if grad is None else grad
+    split = [part for var, arg in zip(self.fxn_vars, args) for part in ((arg.real,) if var in self.real_vars else (arg.real, arg.imag))]
+    result = (ctypes.c_double * 2)()
+    self.function(*split, result, buffer)
+    if grad is not None: return complex(result[0], result[1]), grad
+    return complex(result[0], result[1]), [complex(buffer[2*i], buffer[2*i+1]) for i in range(len(self.wrt))]
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple, Union
+from typing import TYPE_CHECKING
+
+from enum import Enum, auto
+
+import cmath
+import random
+import time
+
+from calcora.codegen.cache import SharedObjectCache
+from calcora.codegen.ccompiler import AsyncClangProgram
+from calcora.codegen.lambdify import find_expression_vars, lambdify
+from calcora.core.domain import Domain
+from calcora.core.registry import Dispatcher
+
+if TYPE_CHECKING:
+  from calcora.core.expression import Expr
+
+class Tier(Enum):
+  TreeWalk = auto()
+  Lambdify = auto()
+  Native = auto()
+
+class CrossCheckError(ArithmeticError): pass
+
+def _normalize(value: Any) -> Union[float, complex]:
+  res = complex(value)
+  return res.real if not res.imag else res
+
+class JitFunction:
+  # Note: Starts out evaluating the expression tree directly and is promoted to lambdify and then to a native ClangProgram once it
+  # has been called often enough or has used enough time, a threshold of None disables that tier. The native tier compiles in the
+  # background and calls keep being served by lambdify until it is ready
+  def __init__(self, expression: Expr, lambdify_calls: Optional[int] = 10, lambdify_time_ns: Optional[int] = 1_000_000,
+               native_calls: Optional[int] = 1000, native_time_ns: Optional[int] = 50_000_000, assumptions: Optional[Mapping[str, Domain]] = None,
+               cross_check: float = 0.0, tolerance: float = 1e-9, strict: bool = False, seed: Optional[int] = None,
+               cache: Union[SharedObjectCache, bool] = True) -> None:
+    self.expression = expression
+    self.fxn_vars : List[str] = sorted(find_expression_vars(expression))
+    self.thresholds = {Tier.Lambdify: (lambdify_calls, lambdify_time_ns), Tier.Native: (native_calls, native_time_ns)}
+    self.assumptions = assumptions
+    self.cross_check = cross_check
+    self.tolerance = tolerance
+    self.strict = strict
+    self.cache = cache
+    self.tier = Tier.TreeWalk
+    self.calls = {tier: 0 for tier in Tier}
+    self.time_ns = {tier: 0 for tier in Tier}
+    self.promotions : List[Tuple[Tier, int]] = []
+    self.checks = 0
+    self.mismatches : List[Dict[str, Any]] = []
+    self.error : Optional[BaseException] = None
+    self._lambdified : Optional[Callable[..., Any]] = None
+    self._native : Optional[AsyncClangProgram] = None
+    self._random = random.Random(seed)
+
+  def _tree_walk(self, *args: Any) -> Union[float, complex]:
+    return _normalize(self.expression._eval(**{name: Dispatcher.typecast(value) for name, value in zip(self.fxn_vars, args)}))
+
+  def _lambdify(self, *args: Any) -> Union[float, complex]:
+    assert self._lambdified is not None
+    return _normalize(self._lambdified(*args))
+
+  def _should_promote(self, tier: Tier) -> bool:
+    calls, time_ns = self.thresholds[tier]
+    total_calls, total_time = sum(self.calls.values()), sum(self.time_ns.values())
+    return (calls is not None and total_calls >= calls) or (time_ns is not None and total_time >= time_ns)
+
+  def _promote(self) -> None:
+    if self.tier == Tier.TreeWalk and self._should_promote(Tier.Lambdify):
+      self._lambdified = lambdify(self.expression, 'python', automatic_vars=False, vars=self.fxn_vars, assumptions=self.assumptions or {})
+      self.tier = Tier.Lambdify
+      self.promotions.append((Tier.Lambdify, sum(self.calls.values())))
+    if self.tier == Tier.Lambdify and self._native is None and self.error is None and self._should_promote(Tier.Native):
+      try: self._native = AsyncClangProgram(self.expression, assumptions=self.assumptions, cache=self.cache)
+      except Exception as e: self.error = e
+    if self._native is not None and self.tier == Tier.Lambdify:
+      if self._native.ready:
+        self.tier = Tier.Native
+        self.promotions.append((Tier.Native, sum(self.calls.values())))
+      elif self._native.error is not None: self.error, self._native = self._native.error, None
+
+  def _arguments(self, args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> Tuple[Any, ...]:
+    if not kwargs and len(args) == len(self.fxn_vars): return args
+    values = dict(zip(self.fxn_vars, args))
+    values.update(kwargs)
+    if sorted(values) != self.fxn_vars: raise TypeError(f"Function requires the arguments ({','.join(self.fxn_vars)}) but got ({','.join(sorted(values))})")
+    return tuple(values[name] for name in self.fxn_vars)
+
+  def __call__(self, *args: Any, **kwargs: Any) -> Union[float, complex]:
+    args = self._arguments(args, kwargs)
+    tier = self.tier
+    start = time.perf_counter_ns()
+    if tier == Tier.Native and self._native is not None: res = _normalize(self._native(*args))
+    elif tier == Tier.Lambdify: res = self._lambdify(*args)
+    else: res = self._tree_walk(*args)
+    self.time_ns[tier] += time.perf_counter_ns() - start
+    self.calls[tier] += 1
+    if self.cross_check and tier != Tier.TreeWalk and self._random.random() < self.cross_check: self._check(tier, args, res)
+    if tier != Tier.Native: self._promote()
+    return res
+
+  def _check(self, tier: Tier, args: Tuple[Any, ...], value: Union[float, complex]) -> None:
+    self.checks += 1
+    reference = self._tree_walk(*args)
+    if cmath.isclose(value, reference, rel_tol=self.tolerance, abs_tol=self.tolerance): return
+    mismatch = {'tier': tier, 'args': args, 'value': value, 'reference': reference}
+    self.mismatches.append(mismatch)
+    if self.strict: raise CrossCheckError(f"{tier.name} tier returned {value} but the tree walk returned {reference} for arguments {args}")
+
+  def stats(self) -> Dict[str, Any]:
+    return {'tier': self.tier.name, 'calls': {tier.name: n for tier, n in self.calls.items()}, 'time_ns': {tier.name: n for tier, n in self.time_ns.items()},
+            'promotions': [(tier.name, calls) for tier, calls in self.promotions], 'checks': self.checks, 'mismatches': len(self.mismatches),
+            'error': repr(self.error) if self.error is not None else None}
+
+class JitEvaluator:
+  # Note: Keeps one JitFunction per expression so callers can evaluate many expressions without managing them, options are passed to every JitFunction
+  def __init__(self, **options: Any) -> None:
+    self.options = options
+    self.functions : Dict[Expr, JitFunction] = {}
+
+  def function(self, expression: Expr) -> JitFunction:
+    if (fxn := self.functions.get(expression)) is None: fxn = self.functions[expression] = JitFunction(expression, **self.options)
+    return fxn
+
+  def __call__(self, expression: Expr, *args: Any, **kwargs: Any) -> Union[float, complex]: return self.function(expression)(*args, **kwargs)
+
+  def stats(self) -> Dict[str, Any]:
+    tiers = {tier.name: 0 for tier in Tier}
+    for fxn in self.functions.values():
+      for tier, n in fxn.calls.items(): tiers[tier.name] += n
+    return {'expressions': len(self.functions), 'calls': tiers, 'current': {tier.name: sum(1 for fxn in self.functions.values() if fxn.tier == tier) for tier in Tier}}
@@ -1,15 +1,29 @@
 from __future__ import annotations
 
-from typing import Any, Callable, Dict, Generic, Iterable, Literal, Optional, overload, Union, Protocol, TypeVar
+from typing import Any, Callable, cast, Dict, Generic, Iterable, List, Literal, Mapping, Optional, overload, Union, Protocol, Sequence, Tuple, TypeVar
 from typing import TYPE_CHECKING
 
 from enum import Enum, auto
 
+import cmath
+import hashlib
+import importlib.util
+import keyword
+import linecache
+import textwrap
+import types
+
+from calcora.codegen.cache import default_lambdify_cache, LambdifyCache
+from calcora.core.arena import ExprArena
+from calcora.core.cse import ExprDAG, is_literal, numbered_symbols
+from calcora.core.domain import Domain, infer_domains
+from calcora.codegen.optimize import optimize_expression, special_power
 from calcora.core.stringops import *
 from calcora.utils import is_op_type
 from calcora.types import CalcoraNumber
+from calcora.globals import ec
 
-from mpmath import mpf, mpc
+from mpmath import mp, mpf, mpc
 
 if TYPE_CHECKING:
   from calcora.core.expression import Expr
@@ -26,49 +40,107 @@ class Backend(Enum):
 
 def find_expression_vars(expression: Expr) -> set[str]:
   found_vars = set()
-  def inner(expression: Expr) -> None:
+  stack, seen = [expression], set()
+  while stack:
+    expression = stack.pop()
+    if id(expression) in seen: continue
+    seen.add(id(expression))
     if is_op_type(expression, Var): found_vars.add(expression.name)
-    elif not (is_op_type(expression, Const) or is_op_type(expression, Constant)):
-      for arg in expression.args: inner(arg)
-  inner(expression)
+    elif not (is_op_type(expression, Const) or is_op_type(expression, Constant)): stack.extend(expression.args)
   return found_vars
 
-def generate_lambda_string_wrapper(expression: Expr, function_map: Dict[str, str]) -> str:
+def format_op(expression: Expr, args: Sequence[str], function_map: Dict[str, str], optimized: bool = False) -> str:
+  # Note: Formats a single op given the already generated code for its arguments, optimized emits special powers as sqrt and division
   if is_op_type(expression, Var): return f'{expression.name}' if not "var" in function_map else f'{function_map["var"]}({expression.name})'
   elif is_op_type(expression, Const): return f'{function_map["const"]}({expression.x})'
   elif is_op_type(expression, Constant): return function_map[expression.name]
-  elif is_op_type(expression, Complex): 
-    real = generate_lambda_string_wrapper(expression.real, function_map)
-    imag = generate_lambda_string_wrapper(expression.imag, function_map)
-    return f'{function_map["complex"]}({real}, {imag})'
-  elif is_op_type(expression, Add):
-    x = generate_lambda_string_wrapper(expression.x, function_map)
-    y = generate_lambda_string_wrapper(expression.y, function_map)
-    return f'({x}+{y})'
-  elif is_op_type(expression, Neg):
-    x = generate_lambda_string_wrapper(expression.x, function_map)
-    return f'(-{x})'
-  elif is_op_type(expression, Mul):
-    x = generate_lambda_string_wrapper(expression.x, function_map)
-    y = generate_lambda_string_wrapper(expression.y, function_map)
-    return f'({x}*{y})'
+  elif is_op_type(expression, Complex): return f'{function_map["complex"]}({args[0]}, {args[1]})'
+  elif is_op_type(expression, Add): return f'({args[0]}+{args[1]})'
+  elif is_op_type(expression, Neg): return f'(-{args[0]})'
+  elif is_op_type(expression, Mul): return f'({args[0]}*{args[1]})'
   elif is_op_type(expression, Log):
-    x = generate_lambda_string_wrapper(expression.x, function_map)
-    base = generate_lambda_string_wrapper(expression.base, function_map)
-    if function_map['log'] == 'numpy.emath.logn': return f'{function_map["log"]}({base}, {x})' # Hack since numpy log takes arguments in different order
-    return f'{function_map["log"]}({x}, {base})'
+    if function_map['log'] == 'numpy.emath.logn': return f'{function_map["log"]}({args[1]}, {args[0]})' # Hack since numpy log takes arguments in different order
+    if function_map['log'] == 'numpy.log': return f'({function_map["log"]}({args[0]})/{function_map["log"]}({args[1]}))'
+    return f'{function_map["log"]}({args[0]}, {args[1]})'
   elif is_op_type(expression, Pow):
-    x = generate_lambda_string_wrapper(expression.x, function_map)
-    y = generate_lambda_string_wrapper(expression.y, function_map)
-    return f'({x}**{y})' if not "pow" in function_map else f'{function_map["pow"]}({x}, {y})'
-  elif is_op_type(expression, Sin): 
-    x = generate_lambda_string_wrapper(expression.x, function_map)
-    return f'{function_map["sin"]}({x})'
-  elif is_op_type(expression, Cos):
-    x = generate_lambda_string_wrapper(expression.x, function_map)
-    return f'{function_map["cos"]}({x})'
+    kind = special_power(expression) if optimized else None
+    if kind == 'reciprocal': return f'(1/{args[0]})'
+    if kind is not None and 'sqrt' in function_map: return f'{function_map["sqrt"]}({args[0]})' if kind == 'sqrt' else f'(1/{function_map["sqrt"]}({args[0]}))'
+    return f'({args[0]}**{args[1]})' if not "pow" in function_map else f'{function_map["pow"]}({args[0]}, {args[1]})'
+  elif is_op_type(expression, Sin): return f'{function_map["sin"]}({args[0]})'
+  elif is_op_type(expression, Cos): return f'{function_map["cos"]}({args[0]})'
   else: raise TypeError(f'Invalid op {type(expression)} cannot be lambdified!')
 
+def generate_lambda_string_wrapper(expression: Expr, function_map: Dict[str, str]) -> str:
+  if is_op_type(expression, Var) or is_op_type(expression, Const) or is_op_type(expression, Constant): return format_op(expression, (), function_map)
+  return format_op(expression, [generate_lambda_string_wrapper(arg, function_map) for arg in expression.args], function_map)
+
+def is_hoistable(expression: Expr) -> bool:
+  # Note: Complex numbers containing constants are not hoisted since mpmath evaluates constants lazily at the current precision
+  return is_literal(expression) and not (is_op_type(expression, Complex) and any(is_op_type(arg, Constant) for arg in expression.args))
+
+MAX_INLINE_DEPTH = 64
+
+def generate_function_source(expressions: Sequence[Expr], function_map: Dict[str, str], vars: Sequence[str], namespace: Dict[str, Any], conversion: Optional[str] = None, name: str = '_lambdified',
+                             domains: Optional[Dict[int, Domain]] = None, real_function_map: Optional[Dict[str, str]] = None, optimized: bool = False, tuple_result: bool = False,
+                             stack: bool = False, hoisted_sources: Optional[Dict[str, str]] = None) -> Tuple[str, Dict[str, Any]]:
+  # Note: Returns the source of a function evaluating the expressions, shared subexpressions are assigned to locals once
+  # and literals are evaluated here, the returned dict maps the names of the hoisted literals to their values.
+  # Nodes that are provably real according to domains are generated with real_function_map instead
+  for var in vars:
+    if not var.isidentifier() or keyword.iskeyword(var): raise ValueError(f"Variable name '{var}' is not a valid identifier")
+    if var in namespace or var == name: raise ValueError(f"Variable name '{var}' is reserved")
+  dag = ExprDAG(expressions)
+  reserved = set(vars) | set(namespace) | {name}
+  temporaries, constants = numbered_symbols('_t', reserved), numbered_symbols('_c', reserved)
+  needed = [False] * len(dag)
+  for root in dag.roots: needed[root] = True
+  for i in reversed(range(len(dag))):
+    if needed[i] and not is_hoistable(dag.nodes[i]):
+      for child in dag.children[i]: needed[child] = True
+  code : List[str] = [''] * len(dag)
+  depth : List[int] = [0] * len(dag)
+  hoisted : Dict[str, Any] = {}
+  lines = [f'  {var} = convert_type({var}, {conversion!r})' for var in vars] if conversion else []
+  for i, (node, children) in enumerate(zip(dag.nodes, dag.children)):
+    if not needed[i]: continue
+    if is_op_type(node, Var): code[i] = format_op(node, (), function_map)
+    elif is_hoistable(node):
+      code[i] = next(constants)
+      literal = generate_lambda_string_wrapper(node, function_map)
+      hoisted[code[i]] = eval(literal, namespace)
+      if hoisted_sources is not None: hoisted_sources[code[i]] = literal
+    else:
+      real = domains is not None and real_function_map is not None and Domain.Real in domains[id(node)]
+      code[i] = format_op(node, [code[c] for c in children], real_function_map if real and real_function_map else function_map, optimized)
+      depth[i] = 1 + max((depth[c] for c in children), default=0)
+      if dag.uses[i] > 1 or depth[i] >= MAX_INLINE_DEPTH: # Note: Deep chains are split up since the parser has a nesting limit
+        temporary = next(temporaries)
+        lines.append(f'  {temporary} = {code[i]}')
+        code[i], depth[i] = temporary, 0
+  # Note: Several roots are returned as a tuple, or stacked into one array along a new first axis with numpy
+  result = code[dag.roots[0]] if len(dag.roots) == 1 and not (tuple_result or stack) else f'({", ".join(code[root] for root in dag.roots)},)'
+  if stack: result = f'numpy.stack(numpy.broadcast_arrays(*{result}))'
+  lines.append(f'  return {result}')
+  return f'def {name}({", ".join(vars)}):\n' + '\n'.join(lines), hoisted
+
+def factory_code(source: str, hoisted: Iterable[str], name: str = '_lambdified') -> types.CodeType:
+  # Note: The function is created inside a factory so the hoisted literals become closure variables
+  factory_source = f'def _make({", ".join(hoisted)}):\n' + textwrap.indent(source, '  ') + f'\n  return {name}'
+  filename = f'<lambdify-{hashlib.sha1(factory_source.encode()).hexdigest()[:12]}>'
+  linecache.cache[filename] = (len(factory_source), None, factory_source.splitlines(True), filename) # Note: Makes tracebacks and inspect show the generated code
+  return compile(factory_source, filename, 'exec')
+
+def instantiate_function(code: types.CodeType, source: str, hoisted: Dict[str, Any], namespace: Dict[str, Any]) -> Callable[..., Any]:
+  scope = dict(namespace)
+  exec(code, scope)
+  fxn = scope['_make'](**hoisted)
+  fxn.source = source
+  return cast(Callable[..., Any], fxn)
+
+def compile_function(source: str, hoisted: Dict[str, Any], namespace: Dict[str, Any], name: str = '_lambdified') -> Callable[..., Any]:
+  return instantiate_function(factory_code(source, hoisted, name), source, hoisted, namespace)
+
 python_function_map = {
   'const': 'float',
   'complex': 'complex',
@@ -79,12 +151,26 @@ python_function_map = {
   'π': 'math.pi'
 }
 
+python_real_function_map = {
+  **python_function_map,
+  'sqrt': 'math.sqrt',
+}
+
+python_complex_function_map = {
+  **python_function_map,
+  'log': 'cmath.log',
+  'sin': 'cmath.sin',
+  'cos': 'cmath.cos',
+  'sqrt': 'cmath.sqrt',
+}
+
 mpmath_function_map = {
   'const': 'mpmath.mpf',
   'complex': 'mpmath.mpc',
   'log': 'mpmath.log',
   'sin': 'mpmath.sin',
   'cos': 'mpmath.cos',
+  'sqrt': 'mpmath.sqrt',
   'e': 'mpmath.e',
   'π': 'mpmath.pi'
 }
@@ -95,12 +181,40 @@ numpy_function_map = {
   'log': 'numpy.emath.logn',
   'sin': 'numpy.sin',
   'cos': 'numpy.cos',
+  'sqrt': 'numpy.sqrt',
   'e': 'numpy.e',
   'π': 'numpy.pi'
 }
 
+numpy_real_function_map = {
+  **numpy_function_map,
+  'log': 'numpy.log',
+}
+
+numpy_complex_function_map = {
+  **numpy_function_map,
+  'pow': 'numpy.emath.power',
+  'sqrt': 'numpy.emath.sqrt',
+}
+
+# Note: Function maps used for (real, possibly complex) values when domain assumptions are given
+domain_function_maps = {
+  'python': (python_real_function_map, python_complex_function_map),
+  'mpmath': (mpmath_function_map, mpmath_function_map),
+  'numpy': (numpy_real_function_map, numpy_complex_function_map),
+}
+
 def global_import(name: str) -> None: globals()[name] = __import__(name)
 
+backend_modules = {'mpmath': 'mpmath', 'python': 'math', 'numpy': 'numpy'}
+
+def backend_namespace(backend: str) -> Dict[str, Any]:
+  # Note: The names generated code is allowed to reference, variables cannot shadow these
+  global_import(backend_modules[backend])
+  namespace = {backend_modules[backend]: globals()[backend_modules[backend]], 'convert_type': convert_type}
+  if backend == 'python': namespace['cmath'] = cmath
+  return namespace
+
 @overload
 def convert_type(value: PYTHON_CONVERT_TYPES, to: Literal['python']) -> Union[float, complex]: ...
 @overload
@@ -144,21 +258,29 @@ class TypesafeNumpyCallable(Protocol):
   def __call__(self, *args: NUMPY_CONVERT_TYPES, **kwargs: NUMPY_CONVERT_TYPES) -> Union[numpy.float64, numpy.complex128, NDArray[numpy.float64 | numpy.complex128]]: ...
 
 @overload
-def lambdify(expression: Expr, backend: Literal["mpmath"], type_conversion: Literal[False] = ..., automatic_vars: bool = True, vars: Optional[Iterable[str]] = None) -> MpmathCallable: ... 
+def lambdify(expression: Sequence[Expr], backend: Literal["mpmath", "numpy", "python"] = ..., type_conversion: Literal[True, False] = ..., automatic_vars: bool = True, vars: Optional[Iterable[str]] = None, assumptions: Optional[Mapping[str, Domain]] = None, optimize: bool = False, stack: bool = False, *, cache: Union[LambdifyCache, bool] = True) -> Callable[..., Any]: ...
+
 @overload
-def lambdify(expression: Expr, backend: Literal["python"], type_conversion: Literal[False] = ..., automatic_vars: bool = True, vars: Optional[Iterable[str]] = None) -> PythonCallable: ... 
+def lambdify(expression: Expr, backend: Literal["mpmath"], type_conversion: Literal[False] = ..., automatic_vars: bool = True, vars: Optional[Iterable[str]] = None, assumptions: Optional[Mapping[str, Domain]] = None, optimize: bool = False, *, cache: Union[LambdifyCache, bool] = True) -> MpmathCallable: ... 
 @overload
-def lambdify(expression: Expr, backend: Literal["numpy"], type_conversion: Literal[False] = ..., automatic_vars: bool = True, vars: Optional[Iterable[str]] = None) -> NumpyCallable: ...
+def lambdify(expression: Expr, backend: Literal["python"], type_conversion: Literal[False] = ..., automatic_vars: bool = True, vars: Optional[Iterable[str]] = None, assumptions: Optional[Mapping[str, Domain]] = None, optimize: bool = False, *, cache: Union[LambdifyCache, bool] = True) -> PythonCallable: ... 
+@overload
+def lambdify(expression: Expr, backend: Literal["numpy"], type_conversion: Literal[False] = ..., automatic_vars: bool = True, vars: Optional[Iterable[str]] = None, assumptions: Optional[Mapping[str, Domain]] = None, optimize: bool = False, *, cache: Union[LambdifyCache, bool] = True) -> NumpyCallable: ...
 
 @overload
-def lambdify(expression: Expr, backend: Literal["mpmath"], type_conversion: Literal[True], automatic_vars: bool = True, vars: Optional[Iterable[str]] = None) -> TypesafeMpmathCallable: ... 
+def lambdify(expression: Expr, backend: Literal["mpmath"], type_conversion: Literal[True], automatic_vars: bool = True, vars: Optional[Iterable[str]] = None, assumptions: Optional[Mapping[str, Domain]] = None, optimize: bool = False, *, cache: Union[LambdifyCache, bool] = True) -> TypesafeMpmathCallable: ... 
 @overload
-def lambdify(expression: Expr, backend: Literal["python"], type_conversion: Literal[True], automatic_vars: bool = True, vars: Optional[Iterable[str]] = None) -> TypesafePythonCallable: ...
+def lambdify(expression: Expr, backend: Literal["python"], type_conversion: Literal[True], automatic_vars: bool = True, vars: Optional[Iterable[str]] = None, assumptions: Optional[Mapping[str, Domain]] = None, optimize: bool = False, *, cache: Union[LambdifyCache, bool] = True) -> TypesafePythonCallable: ...
 @overload
-def lambdify(expression: Expr, backend: Literal["numpy"], type_conversion: Literal[True], automatic_vars: bool = True, vars: Optional[Iterable[str]] = None) -> TypesafeNumpyCallable: ...
+def lambdify(expression: Expr, backend: Literal["numpy"], type_conversion: Literal[True], automatic_vars: bool = True, vars: Optional[Iterable[str]] = None, assumptions: Optional[Mapping[str, Domain]] = None, optimize: bool = False, *, cache: Union[LambdifyCache, bool] = True) -> TypesafeNumpyCallable: ...
 
-def lambdify(expression: Expr, backend: Literal["mpmath", "numpy", "python"] = "mpmath", type_conversion: Literal[True, False] = False, automatic_vars: bool = True, vars: Optional[Iterable[str]] = None) -> Union[MpmathCallable, PythonCallable, NumpyCallable, TypesafeMpmathCallable, TypesafePythonCallable, TypesafeNumpyCallable]:
+def lambdify(expression: Union[Expr, Sequence[Expr]], backend: Literal["mpmath", "numpy", "python"] = "mpmath", type_conversion: Literal[True, False] = False, automatic_vars: bool = True, vars: Optional[Iterable[str]] = None, assumptions: Optional[Mapping[str, Domain]] = None, optimize: bool = False, stack: bool = False, *, cache: Union[LambdifyCache, bool] = True) -> Union[MpmathCallable, PythonCallable, NumpyCallable, TypesafeMpmathCallable, TypesafePythonCallable, TypesafeNumpyCallable, Callable[..., Any]]:
+  # Note: A sequence of expressions gives one function returning a tuple with every subexpression shared between them computed once,
+  # with the numpy backend stack returns a single array with the outputs along the first axis instead
   if vars and automatic_vars: raise RuntimeError("Both automatic vars and specified vars cannot be selected!")
+  expressions = list(expression) if isinstance(expression, Sequence) else [expression]
+  if not expressions: raise ValueError("No expressions to lambdify")
+  if stack and (backend != 'numpy' or not isinstance(expression, Sequence)): raise ValueError("Only a sequence of expressions with the numpy backend can be stacked")
   if backend == "mpmath": 
     global_import('mpmath')
     lambda_map = mpmath_function_map
@@ -169,12 +291,60 @@ def lambdify(expression: Expr, backend: Literal["mpmath", "numpy", "python"] = "
     global_import('numpy')
     lambda_map = numpy_function_map
   else: raise ValueError(f"Invalid backend {backend}, must be mpmath, python or numpy")
-  lambda_string = generate_lambda_string_wrapper(expression, lambda_map)
-  if automatic_vars: vars = find_expression_vars(expression)
-  if vars: vars = ",".join(sorted(vars))
-  if type_conversion and vars: lambda_fxn : Callable[..., Union[MpmathCallable, PythonCallable, NumpyCallable]] = eval(f"lambda {vars}: (lambda {vars}: {lambda_string})(**{{var:convert_type(var_val, '{backend}') for var, var_val in zip('{vars}'.split(','), [{vars}])}})")
-  else: lambda_fxn = eval(f'lambda {vars}: {lambda_string}') if vars else eval(f'lambda: {lambda_string}')
-  return lambda_fxn
+  vars = list(vars) if vars is not None else None
+  options : Dict[str, Any] = {'backend': backend, 'type_conversion': type_conversion, 'assumptions': assumptions, 'optimize': optimize, 'stack': stack}
+  lambdify_cache = cache if isinstance(cache, LambdifyCache) else default_lambdify_cache() if cache else None
+  # Note: Expressions are keyed by their serialized arena which is built iteratively, hashing or comparing deep expressions would recurse.
+  # Expressions that cannot be stored in an arena bypass the cache. Hoisted mpmath literals are rounded to the working precision so it is part of the key
+  if lambdify_cache is not None and (expression_key := arena_key(expressions)) is None: lambdify_cache = None
+  key = (expression_key if lambdify_cache is not None else b'', backend, type_conversion, automatic_vars, tuple(sorted(vars)) if vars is not None else None, tuple(sorted(assumptions.items())) if assumptions is not None else None,
+         optimize, stack, isinstance(expression, Sequence), mp.prec, ec.precision)
+  if lambdify_cache is not None and (fxn := lambdify_cache.get(key)) is not None: return attach_options(fxn, expression, getattr(fxn, 'fxn_vars'), options)
+  if automatic_vars: vars = sorted(set().union(*(find_expression_vars(e) for e in expressions)))
+  var_names = sorted(vars) if vars else []
+  namespace = backend_namespace(backend)
+  disk_key = lambdify_disk_key(key) if lambdify_cache is not None and lambdify_cache.directory is not None else None
+  if lambdify_cache is not None and disk_key is not None and (entry := lambdify_cache.load(disk_key)) is not None:
+    source, literals, code = entry
+    fxn = instantiate_function(code, source, {name: eval(literal, namespace) for name, literal in literals.items()}, namespace)
+    fxn.fxn_vars = var_names # type: ignore[attr-defined]
+    lambdify_cache.put(key, fxn)
+    return attach_options(fxn, expression, var_names, options)
+  if optimize: expressions = [optimize_expression(e) for e in expressions]
+  hoisted_sources : Dict[str, str] = {}
+  source_options : Dict[str, Any] = {'conversion': backend if type_conversion else None, 'optimized': optimize, 'tuple_result': isinstance(expression, Sequence), 'stack': stack, 'hoisted_sources': hoisted_sources}
+  if assumptions is not None:
+    real_map, lambda_map = domain_function_maps[backend]
+    source, hoisted = generate_function_source(expressions, lambda_map, var_names, namespace, domains=infer_domains(expressions, assumptions), real_function_map=real_map, **source_options)
+  else: source, hoisted = generate_function_source(expressions, lambda_map, var_names, namespace, **source_options)
+  code = factory_code(source, hoisted)
+  fxn = instantiate_function(code, source, hoisted, namespace)
+  if lambdify_cache is not None:
+    fxn.fxn_vars = var_names # type: ignore[attr-defined]
+    lambdify_cache.put(key, fxn)
+    if disk_key is not None: lambdify_cache.store(disk_key, source, hoisted_sources, code)
+  return attach_options(fxn, expression, var_names, options)
+
+def arena_key(expressions: Sequence[Expr]) -> Optional[bytes]:
+  try: return ExprArena.from_expr(*expressions).to_bytes()
+  except ValueError: return None # Note: Ops such as AnyOp have no arena form
+
+def attach_options(fxn: Any, expression: Union[Expr, Sequence[Expr]], var_names: List[str], options: Dict[str, Any]) -> Callable[..., Any]:
+  # Note: Keeps what the function was generated from so it can be specialized or regenerated later. Every call gets its own function object
+  # sharing the code and hoisted values, so the cached function is never changed and callers cannot see each other's attributes
+  res = types.FunctionType(fxn.__code__, fxn.__globals__, fxn.__name__, fxn.__defaults__, fxn.__closure__)
+  res.source = fxn.source # type: ignore[attr-defined]
+  res.expression = expression # type: ignore[attr-defined]
+  res.fxn_vars = list(var_names) # type: ignore[attr-defined]
+  res.options = dict(options) # type: ignore[attr-defined]
+  return res
+
+def lambdify_disk_key(key: Tuple[Any, ...]) -> str:
+  # Note: Code objects are only valid for one bytecode version so the magic number is part of the file name
+  digest = hashlib.sha256(key[0])
+  digest.update(repr(key[1:]).encode())
+  digest.update(importlib.util.MAGIC_NUMBER)
+  return digest.hexdigest()
 
 def string_lambda(expression: Expr, backend: Literal["mpmath", "numpy", "python"] = "mpmath", automatic_vars: bool = True, vars: Optional[Iterable[str]] = None) -> str:
   if vars and automatic_vars: raise RuntimeError("Both automatic vars and specified vars cannot be selected!")
@@ -0,0 +1,413 @@
+from __future__ import annotations
+
+from typing import Any, Iterable, List, Optional, Union
+from typing import TYPE_CHECKING
+
+import ctypes
+import hashlib
+
+from mpmath import mp, mpf
+
+from calcora.globals import ec
+from calcora.codegen.cache import default_cache, SharedObjectCache
+from calcora.codegen.ccompiler import compile_shared_object
+from calcora.codegen.lambdify import find_expression_vars
+from calcora.codegen.optimize import literal_value
+from calcora.core.cse import ExprDAG
+from calcora.core.ops import Add, Complex, Const, Constant, Cos, Log, Mul, Neg, Pow, Sin, Var
+
+if TYPE_CHECKING:
+  from calcora.core.expression import Expr
+  from numpy.typing import NDArray
+
+MAX_PRECISION_TERMS = {2: 30, 4: 60} # Note: Decimal digits each number of double terms delivers reliably
+# Note: sin and cos reduce by pi/2 held to terms+3 doubles, that keeps the full precision for arguments up to 2^140 and larger ones give nan
+PI_2_EXTRA_TERMS = 3
+TRIG_MAX_EXPONENT = 140
+
+def precision_terms(precision: Optional[int] = None) -> int:
+  # Note: The number of doubles per value needed for precision decimal digits, ec.precision by default
+  precision = precision if precision is not None else ec.precision
+  for terms, digits in MAX_PRECISION_TERMS.items():
+    if precision <= digits: return terms
+  raise ValueError(f"Precision of {precision} digits is more than multi double code supports ({max(MAX_PRECISION_TERMS.values())}), use mpmath instead")
+
+def split(value: Union[int, float, str, mpf], terms: int) -> List[float]:
+  # Note: Splits a number into terms doubles of decreasing magnitude whose exact sum is the number rounded to 53*terms bits
+  parts = []
+  with mp.workprec(53 * terms + 64):
+    rest = mpf(value)
+    for _ in range(terms):
+      parts.append(float(rest))
+      rest -= parts[-1]
+  return parts
+
+def combine(parts: Iterable[float]) -> mpf:
+  with mp.workprec(53 * 8 + 64): return +mp.fsum(mpf(part) for part in parts)
+
+RUNTIME = r'''#include <math.h>
+
+#define MD_N {terms}
+#define MD_NEWTON {newton}
+#define MD_EXP_TERMS {exp_terms}
+#define MD_SIN_TERMS {sin_terms}
+#define MD_COS_TERMS {cos_terms}
+#define MD_PI_2_TERMS {pi_2_terms}
+#define MD_TRIG_MAX 0x1p{trig_max_exponent}
+
+typedef struct {{ double x[MD_N]; }} md;
+
+static const md MD_LN2 = {ln2};
+static const double MD_PI_2[MD_PI_2_TERMS] = {{{pi_2}}};
+static const md MD_EXP_COEFFICIENTS[MD_EXP_TERMS] = {{{exp_coefficients}}};
+static const md MD_SIN_COEFFICIENTS[MD_SIN_TERMS] = {{{sin_coefficients}}};
+static const md MD_COS_COEFFICIENTS[MD_COS_TERMS] = {{{cos_coefficients}}};
+
+static inline void two_sum(double a, double b, double* s, double* e) {{
+  double t = a + b, bb = t - a;
+  *e = (a - (t - bb)) + (b - bb);
+  *s = t;
+}}
+
+static inline void two_prod(double a, double b, double* p, double* e) {{
+  *p = a * b;
+#ifdef FP_FAST_FMA
+  *e = fma(a, b, -*p);
+#else
+  const double split = 134217729.0;
+  double t = split * a, ah = t - (t - a), al = a - ah;
+  t = split * b;
+  double bh = t - (t - b), bl = b - bh;
+  *e = ((ah * bh - *p) + ah * bl + al * bh) + al * bl;
+#endif
+}}
+
+static md md_renorm(double* t, int m) {{
+  /* Note: A bottom up pass of exact two sums followed by a top down pass that drops zero errors, the terms should be roughly in decreasing magnitude */
+  md r;
+  double s = t[m-1];
+  for (int i = m-2; i >= 0; i--) two_sum(t[i], s, &s, &t[i+1]);
+  t[0] = s;
+  int k = 0, i = 1;
+  for (; i < m && k < MD_N - 1; i++) {{
+    double e;
+    two_sum(s, t[i], &s, &e);
+    if (e != 0.0) {{ r.x[k++] = s; s = e; }}
+  }}
+  for (; i < m; i++) s += t[i];
+  r.x[k++] = s;
+  for (; k < MD_N; k++) r.x[k] = 0.0;
+  return r;
+}}
+
+static inline md md_from_double(double a) {{
+  md r;
+  r.x[0] = a;
+  for (int i = 1; i < MD_N; i++) r.x[i] = 0.0;
+  return r;
+}}
+
+static inline md md_neg(md a) {{
+  for (int i = 0; i < MD_N; i++) a.x[i] = -a.x[i];
+  return a;
+}}
+
+static inline md md_ldexp(md a, int k) {{
+  for (int i = 0; i < MD_N; i++) a.x[i] = ldexp(a.x[i], k);
+  return a;
+}}
+
+static inline void quick_two_sum(double a, double b, double* s, double* e) {{
+  double t = a + b;
+  *e = b - (t - a);
+  *s = t;
+}}
+
+static md md_add(md a, md b) {{
+#if MD_N == 2
+  /* Note: The usual double double algorithms are used for two terms, the general ones are exact for any number of terms but slower */
+  double s, e, t, f;
+  two_sum(a.x[0], b.x[0], &s, &e);
+  two_sum(a.x[1], b.x[1], &t, &f);
+  e += t;
+  quick_two_sum(s, e, &s, &e);
+  e += f;
+  quick_two_sum(s, e, &a.x[0], &a.x[1]);
+  return a;
+#else
+  double t[2*MD_N];
+  int i = 0, j = 0, k = 0;
+  while (i < MD_N && j < MD_N) t[k++] = fabs(a.x[i]) >= fabs(b.x[j]) ? a.x[i++] : b.x[j++];
+  while (i < MD_N) t[k++] = a.x[i++];
+  while (j < MD_N) t[k++] = b.x[j++];
+  return md_renorm(t, 2*MD_N);
+#endif
+}}
+
+static inline md md_sub(md a, md b) {{ return md_add(a, md_neg(b)); }}
+
+static md md_mul(md a, md b) {{
+#if MD_N == 2
+  double p, e;
+  two_prod(a.x[0], b.x[0], &p, &e);
+  e += a.x[0] * b.x[1] + a.x[1] * b.x[0];
+  quick_two_sum(p, e, &a.x[0], &a.x[1]);
+  return a;
+#else
+  /* Note: Products of order s < MD_N-1 are exact and their errors are stored next to the products of order s+1, the last order is rounded
+     and higher orders are dropped */
+  double t[MD_N*MD_N];
+  double e[MD_N];
+  int k = 0, errors = 0;
+  for (int s = 0; s < MD_N - 1; s++) {{
+    int new_errors = 0;
+    double new_e[MD_N];
+    for (int i = 0; i <= s; i++) {{ two_prod(a.x[i], b.x[s-i], &t[k], &new_e[new_errors]); k++; new_errors++; }}
+    for (int i = 0; i < errors; i++) t[k++] = e[i];
+    for (int i = 0; i < new_errors; i++) e[i] = new_e[i];
+    errors = new_errors;
+  }}
+  for (int i = 0; i < MD_N; i++) t[k++] = a.x[i] * b.x[MD_N-1-i];
+  for (int i = 0; i < errors; i++) t[k++] = e[i];
+  return md_renorm(t, k);
+#endif
+}}
+
+static md md_div(md a, md b) {{
+#if MD_N == 2
+  double q1 = a.x[0] / b.x[0];
+  md r = md_sub(a, md_mul(md_from_double(q1), b));
+  double q2 = r.x[0] / b.x[0];
+  r = md_sub(r, md_mul(md_from_double(q2), b));
+  double q3 = r.x[0] / b.x[0];
+  quick_two_sum(q1, q2, &q1, &q2);
+  return md_add((md){{{{q1, q2}}}}, md_from_double(q3));
+#else
+  double q[MD_N+1];
+  md r = a;
+  for (int i = 0; i <= MD_N; i++) {{
+    q[i] = r.x[0] / b.x[0];
+    if (i < MD_N) r = md_sub(r, md_mul(md_from_double(q[i]), b));
+  }}
+  return md_renorm(q, MD_N+1);
+#endif
+}}
+
+static md md_powi(md a, long n) {{
+  md r = md_from_double(1.0);
+  unsigned long m = n < 0 ? -(unsigned long)n : (unsigned long)n;
+  while (m) {{
+    if (m & 1) r = md_mul(r, a);
+    m >>= 1;
+    if (m) a = md_mul(a, a);
+  }}
+  return n < 0 ? md_div(md_from_double(1.0), r) : r;
+}}
+
+static md md_sqrt(md a) {{
+  if (a.x[0] <= 0.0) return md_from_double(a.x[0] == 0.0 ? 0.0 : NAN);
+  md s = md_from_double(sqrt(a.x[0]));
+  for (int i = 0; i < MD_NEWTON; i++) s = md_add(s, md_ldexp(md_div(md_sub(a, md_mul(s, s)), s), -1));
+  return s;
+}}
+
+static md md_exp(md a) {{
+  if (a.x[0] > 709.78) return md_from_double(INFINITY);
+  if (a.x[0] < -745.2) return md_from_double(0.0);
+  double k = nearbyint(a.x[0] / MD_LN2.x[0]);
+  /* Note: expm1 of the reduced argument is squared back up as p*(p+2) so the relative precision of the small result is kept */
+  md r = md_ldexp(md_sub(a, md_mul(MD_LN2, md_from_double(k))), -10);
+  md p = MD_EXP_COEFFICIENTS[MD_EXP_TERMS-1];
+  for (int n = MD_EXP_TERMS-2; n >= 0; n--) p = md_add(md_mul(p, r), MD_EXP_COEFFICIENTS[n]);
+  p = md_mul(p, r);
+  for (int i = 0; i < 10; i++) p = md_mul(p, md_add(p, md_from_double(2.0)));
+  return md_ldexp(md_add(p, md_from_double(1.0)), (int)k);
+}}
+
+static md md_log(md a) {{
+  if (a.x[0] <= 0.0) return md_from_double(a.x[0] == 0.0 ? -INFINITY : NAN);
+  md y = md_from_double(log(a.x[0]));
+  for (int i = 0; i < MD_NEWTON; i++) y = md_add(y, md_sub(md_mul(a, md_exp(md_neg(y))), md_from_double(1.0)));
+  return y;
+}}
+
+static inline md md_pow(md a, md b) {{ return md_exp(md_mul(b, md_log(a))); }}
+
+static int grow_expansion(double* e, int m, double b) {{
+  /* Note: Adds b exactly to the nonoverlapping expansion e[0..m) of increasing magnitude (Shewchuk), zero components are dropped */
+  int k = 0;
+  for (int i = 0; i < m; i++) {{
+    double h;
+    two_sum(b, e[i], &b, &h);
+    if (h != 0.0) e[k++] = h;
+  }}
+  if (b != 0.0) e[k++] = b;
+  return k;
+}}
+
+static md md_reduce_pi_2(md a, int* quadrant) {{
+  /* Note: Subtracts k*pi/2 for the nearest integer k with pi/2 held to MD_PI_2_TERMS doubles, the exact products of k with every part are
+     summed into an expansion so the cancellation against a loses nothing. A k above 2^53 is only a double so the remainder can still be
+     large, every pass takes 53 bits off and three passes cover arguments up to MD_TRIG_MAX */
+  double e[MD_N + 6*MD_PI_2_TERMS];
+  int m = 0, q = 0;
+  for (int i = MD_N-1; i >= 0; i--) m = grow_expansion(e, m, a.x[i]);
+  for (int pass = 0; pass < 3; pass++) {{
+    double approx = 0.0;
+    for (int i = 0; i < m; i++) approx += e[i];
+    double k = nearbyint(approx / MD_PI_2[0]);
+    if (k == 0.0) break;
+    q = (q + (int)fmod(k, 4.0) + 4) % 4;
+    for (int j = 0; j < MD_PI_2_TERMS; j++) {{
+      double p, err;
+      two_prod(-k, MD_PI_2[j], &p, &err);
+      m = grow_expansion(e, m, p);
+      m = grow_expansion(e, m, err);
+    }}
+  }}
+  *quadrant = q;
+  if (m == 0) return md_from_double(0.0);
+  double t[MD_N + 6*MD_PI_2_TERMS];
+  for (int i = 0; i < m; i++) t[i] = e[m-1-i];
+  return md_renorm(t, m);
+}}
+
+static void md_sincos(md a, md* sin_out, md* cos_out) {{
+  /* Note: Arguments above MD_TRIG_MAX (and nan or infinity) give nan, the reduction would need more digits of pi than are stored */
+  if (!(fabs(a.x[0]) <= MD_TRIG_MAX)) {{ *sin_out = *cos_out = md_from_double(NAN); return; }}
+  int quadrant;
+  /* Note: The series is evaluated at a eighth of the reduced argument and brought back with three double angle steps */
+  md r = md_ldexp(md_reduce_pi_2(a, &quadrant), -3);
+  md r2 = md_mul(r, r), s = MD_SIN_COEFFICIENTS[MD_SIN_TERMS-1], c = MD_COS_COEFFICIENTS[MD_COS_TERMS-1];
+  for (int n = MD_SIN_TERMS-2; n >= 0; n--) s = md_add(md_mul(s, r2), MD_SIN_COEFFICIENTS[n]);
+  for (int n = MD_COS_TERMS-2; n >= 0; n--) c = md_add(md_mul(c, r2), MD_COS_COEFFICIENTS[n]);
+  s = md_mul(s, r);
+  for (int i = 0; i < 3; i++) {{
+    md s2 = md_mul(s, s);
+    s = md_ldexp(md_mul(s, c), 1);
+    c = md_sub(md_from_double(1.0), md_ldexp(s2, 1));
+  }}
+  if (quadrant == 0) {{ *sin_out = s; *cos_out = c; }}
+  else if (quadrant == 1) {{ *sin_out = c; *cos_out = md_neg(s); }}
+  else if (quadrant == 2) {{ *sin_out = md_neg(s); *cos_out = md_neg(c); }}
+  else {{ *sin_out = md_neg(c); *cos_out = s; }}
+}}
+
+static inline md md_sin(md a) {{ md s, c; md_sincos(a, &s, &c); return s; }}
+static inline md md_cos(md a) {{ md s, c; md_sincos(a, &s, &c); return c; }}
+'''
+
+def _md_literal(value: Union[mpf, str], terms: int) -> str:
+  return '{{' + ', '.join(repr(part) for part in split(value, terms)) + '}}'
+
+def _series_length(bound: mpf, bits: int, first: int, step: int) -> int:
+  # Note: Number of terms bound**n/n! for n = first, first+step, ... until they drop below 2**-bits relative to the first term, plus one
+  n, limit = first, mpf(2) ** -bits * bound ** first / mp.factorial(first)
+  while bound ** n / mp.factorial(n) > limit: n += step
+  return (n - first) // step + 1
+
+def runtime_code(terms: int) -> str:
+  # Note: The series coefficients are computed here so the C code evaluates fixed length polynomials with Horner's rule, exp is evaluated at
+  # |r| <= ln(2)/2048 and sin and cos at |r| <= pi/32
+  bits = 53 * terms + 8
+  with mp.workprec(53 * terms + 64):
+    exp_terms = _series_length(mp.ln2 / 2048, bits, 1, 1)
+    sin_terms, cos_terms = _series_length(mp.pi / 32, bits, 1, 2), _series_length(mp.pi / 32, bits, 0, 2)
+    exp_coefficients = ', '.join(_md_literal(1 / mp.factorial(n + 1), terms) for n in range(exp_terms))
+    sin_coefficients = ', '.join(_md_literal((-1) ** n / mp.factorial(2 * n + 1), terms) for n in range(sin_terms))
+    cos_coefficients = ', '.join(_md_literal((-1) ** n / mp.factorial(2 * n), terms) for n in range(cos_terms))
+    ln2 = _md_literal(mp.ln2, terms)
+  with mp.workprec(53 * (terms + PI_2_EXTRA_TERMS) + 64): pi_2 = ', '.join(repr(part) for part in split(mp.pi / 2, terms + PI_2_EXTRA_TERMS))
+  return RUNTIME.format(terms=terms, newton=terms // 2, exp_terms=exp_terms, sin_terms=sin_terms, cos_terms=cos_terms, ln2=ln2,
+                        pi_2_terms=terms + PI_2_EXTRA_TERMS, trig_max_exponent=TRIG_MAX_EXPONENT, pi_2=pi_2, exp_coefficients=exp_coefficients, sin_coefficients=sin_coefficients, cos_coefficients=cos_coefficients)
+
+class MultiDoubleProgram:
+  # Note: Evaluates a real expression in double double (2 terms, about 30 digits) or quad double (4 terms, about 60 digits) arithmetic in plain C,
+  # the number of terms is chosen from ec.precision unless given. Values are unevaluated sums of doubles, call returns an mpf and batch works on
+  # arrays of the terms. Arguments outside the domain of a real function give nan like math.h does, so do sin and cos above 2^140
+  def __init__(self, expression: Expr, terms: Optional[int] = None, name: Optional[str] = None, cache: Union[SharedObjectCache, bool] = True) -> None:
+    self.expression = expression
+    self.terms = terms if terms is not None else precision_terms()
+    if self.terms not in MAX_PRECISION_TERMS: raise ValueError(f"Invalid number of terms {self.terms}, must be one of {', '.join(map(str, MAX_PRECISION_TERMS))}")
+    self.fxn_vars : List[str] = sorted(find_expression_vars(expression))
+    self.flags : List[str] = ['-O3', '-ffp-contract=off'] # Note: Contracting into fma would break the error free transformations
+    self.cache : Optional[SharedObjectCache] = cache if isinstance(cache, SharedObjectCache) else default_cache() if cache else None
+    self.expression_code = self._generate(expression)
+    self.fxn_name : str = name or 'calcora_md_' + hashlib.sha1(f'{self.fxn_vars}{self.terms}{self.expression_code}'.encode()).hexdigest()[:16]
+    # Note: Identifiers of the entry points are prefixed with calcora_ so they cannot clash with the variables loaded next to them
+    params = ''.join(f'const double* restrict calcora_{var}_in, ' for var in self.fxn_vars)
+    loads = ''.join(f'  md {var}; for (int calcora_k = 0; calcora_k < MD_N; calcora_k++) {var}.x[calcora_k] = calcora_{var}_in[calcora_k];\n' for var in self.fxn_vars)
+    body = f'\nstatic inline md {self.fxn_name}_eval({", ".join(f"md {var}" for var in self.fxn_vars) or "void"}) {{\n{self.expression_code}}}\n'
+    body += f'\nvoid {self.fxn_name}({params}double* restrict calcora_out) {{\n{loads}  md calcora_result = {self.fxn_name}_eval({", ".join(self.fxn_vars)});\n'
+    body += '  for (int calcora_k = 0; calcora_k < MD_N; calcora_k++) calcora_out[calcora_k] = calcora_result.x[calcora_k];\n}\n'
+    batch_loads = ''.join(f'    md {var}; for (int calcora_k = 0; calcora_k < MD_N; calcora_k++) {var}.x[calcora_k] = calcora_{var}_in[calcora_i*MD_N + calcora_k];\n' for var in self.fxn_vars)
+    body += f'\nvoid {self.fxn_name}_batch({params}double* restrict calcora_out, long calcora_n) {{\n  for (long calcora_i = 0; calcora_i < calcora_n; calcora_i++) {{\n{batch_loads}'
+    body += f'    md calcora_result = {self.fxn_name}_eval({", ".join(self.fxn_vars)});\n'
+    body += '    for (int calcora_k = 0; calcora_k < MD_N; calcora_k++) calcora_out[calcora_i*MD_N + calcora_k] = calcora_result.x[calcora_k];\n  }\n}\n'
+    self.fxn_code : str = runtime_code(self.terms) + body
+    self.compiled : Optional[bytes] = None
+    self.function : Optional[ctypes.CDLL] = None
+
+  def _generate(self, expression: Expr) -> str:
+    dag = ExprDAG([expression])
+    code : List[str] = []
+    lines : List[str] = []
+    for i, (node, children) in enumerate(zip(dag.nodes, dag.children)):
+      args = [code[c] for c in children]
+      if isinstance(node, Var): code.append(node.name); continue
+      if isinstance(node, Const): code.append(f'(md){_md_literal(node.x.value.real, self.terms)}'); continue
+      if isinstance(node, Constant):
+        with mp.workprec(53 * self.terms + 64): code.append(f'(md){_md_literal(node.x(), self.terms)}')
+        continue
+      if isinstance(node, Add): value = f'md_add({args[0]}, {args[1]})'
+      elif isinstance(node, Neg): value = f'md_neg({args[0]})'
+      elif isinstance(node, Mul): value = f'md_mul({args[0]}, {args[1]})'
+      elif isinstance(node, Sin): value = f'md_sin({args[0]})'
+      elif isinstance(node, Cos): value = f'md_cos({args[0]})'
+      elif isinstance(node, Log): value = f'md_log({args[0]})' if isinstance(node.base, Constant) and node.base.name == 'e' else f'md_div(md_log({args[0]}), md_log({args[1]}))'
+      elif isinstance(node, Pow):
+        exponent = literal_value(node.y)
+        if isinstance(node.x, Constant) and node.x.name == 'e': value = f'md_exp({args[1]})'
+        elif exponent == 0.5: value = f'md_sqrt({args[0]})'
+        elif exponent == -0.5: value = f'md_div(md_from_double(1.0), md_sqrt({args[0]}))'
+        elif exponent is not None and exponent == int(exponent) and abs(exponent) < 2**62: value = f'md_powi({args[0]}, {int(exponent)}L)'
+        else: value = f'md_pow({args[0]}, {args[1]})'
+      elif isinstance(node, Complex): raise ValueError("Multi double code only supports real expressions")
+      else: raise TypeError(f'Invalid op {type(node)} cannot be converted to multi double code!')
+      lines.append(f'  md calcora_t{i} = {value};\n')
+      code.append(f'calcora_t{i}')
+    return ''.join(lines) + f'  return {code[dag.roots[0]]};\n'
+
+  def compile(self) -> None:
+    self.compiled, self.function = compile_shared_object(self.fxn_code, self.flags, self.cache, self.fxn_name)
+    getattr(self.function, self.fxn_name).argtypes = [ctypes.c_void_p] * (len(self.fxn_vars) + 1)
+    getattr(self.function, self.fxn_name).restype = None
+    getattr(self.function, f'{self.fxn_name}_batch').argtypes = [ctypes.c_void_p] * (len(self.fxn_vars) + 1) + [ctypes.c_long]
+    getattr(self.function, f'{self.fxn_name}_batch').restype = None
+
+  def __call__(self, *args: Union[int, float, str, mpf]) -> mpf:
+    if len(args) != len(self.fxn_vars): raise TypeError(f"Function requires {len(self.fxn_vars)} arguments ({','.join(self.fxn_vars)}) but {len(args)} were given")
+    if self.function is None: self.compile()
+    buffer_type = ctypes.c_double * self.terms
+    out = buffer_type()
+    getattr(self.function, self.fxn_name)(*(buffer_type(*split(arg, self.terms)) for arg in args), out)
+    with mp.workprec(53 * self.terms + 64): return combine(out)
+
+  def batch(self, *args: Any, out: Optional[NDArray[Any]] = None, terms_axis: bool = False) -> NDArray[Any]:
+    # Note: Arguments are float64 arrays of plain values, with terms_axis they have a trailing axis holding the terms of each value instead
+    # (like the result of batch). The layout is never guessed from the shape. The result always has the trailing axis
+    import numpy
+    if len(args) != len(self.fxn_vars): raise TypeError(f"Function requires {len(self.fxn_vars)} arguments ({','.join(self.fxn_vars)}) but {len(args)} were given")
+    if self.function is None: self.compile()
+    arrays = []
+    for arg in args:
+      array = numpy.asarray(arg, dtype=numpy.float64)
+      if not terms_axis: array = numpy.concatenate([array[..., None], numpy.zeros(array.shape + (self.terms - 1,))], axis=-1)
+      elif array.ndim == 0 or array.shape[-1] != self.terms: raise ValueError(f"Arguments with a terms axis must have a trailing axis of length {self.terms}, got shape {array.shape}")
+      arrays.append(array)
+    shape = numpy.broadcast_shapes(*(array.shape for array in arrays)) if arrays else (self.terms,)
+    arrays = [numpy.ascontiguousarray(numpy.broadcast_to(array, shape)) for array in arrays]
+    if out is None: out = numpy.empty(shape, dtype=numpy.float64)
+    elif out.shape != shape or out.dtype != numpy.float64 or not out.flags.c_contiguous or not out.flags.writeable: raise ValueError(f"Output array must be a writeable C contiguous float64 array of shape {shape}")
+    getattr(self.function, f'{self.fxn_name}_batch')(*(array.ctypes.data for array in arrays), out.ctypes.data, out.size // self.terms)
+    return out
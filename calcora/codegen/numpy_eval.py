@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Tuple
+from typing import TYPE_CHECKING
+
+import math
+
+import numpy
+
+from calcora.core.cse import ExprDAG
+from calcora.core.domain import Domain, infer_domains
+from calcora.core.stringops import *
+from calcora.codegen.lambdify import backend_namespace, find_expression_vars, generate_lambda_string_wrapper, is_hoistable, numpy_function_map
+from calcora.utils import is_op_type
+
+if TYPE_CHECKING:
+  from calcora.core.expression import Expr
+  from calcora.core.ops import Add, Complex, Const, Constant, Cos, Log, Mul, Neg, Pow, Sin, Var
+  from numpy.typing import DTypeLike, NDArray
+
+DEFAULT_BLOCK_SIZE = 1 << 14 # Note: 128 KiB per float64 buffer, a handful of these should stay in L2
+
+def _logn(x: Any, base: Any, scratch: Any, out: Any) -> Any:
+  numpy.log(x, out=out, dtype=out.dtype)
+  numpy.log(base, out=scratch, dtype=scratch.dtype)
+  return numpy.divide(out, scratch, out=out)
+
+def _promoted(fxn: Callable[..., Any]) -> Callable[..., Any]:
+  # Note: Ufuncs pick their loop from the inputs, real inputs of a complex node are cast first so log(-1) is not evaluated as nan
+  def call(*args: Any, out: Any) -> Any: return fxn(*args, out=out, dtype=out.dtype)
+  return call
+
+def _complex(real: Any, imag: Any, out: Any) -> Any:
+  numpy.multiply(imag, 1j, out=out)
+  return numpy.add(out, real, out=out)
+
+# Note: Instructions are (function, argument slots, output slot), functions are called as function(*args, out=out)
+type Instruction = Tuple[Callable[..., Any], Tuple[int, ...], int]
+
+# Note: The real and complex dtype used for each precision, every explicit dtype selects one of these pairs
+DTYPE_PAIRS : Dict[str, Tuple[Any, Any]] = {'float32': (numpy.float32, numpy.complex64), 'complex64': (numpy.float32, numpy.complex64),
+                                            'float64': (numpy.float64, numpy.complex128), 'complex128': (numpy.float64, numpy.complex128)}
+
+class NumpyPlan:
+  # Note: Register allocation for one combination of real and complex inputs. Nodes only get complex registers when one of their inputs is complex,
+  # they build a complex number or they are a log or power that is not provably real, the rest of the expression is evaluated in the real dtype
+  def __init__(self, instructions: List[Instruction], constants: List[Any], real_registers: int, complex_registers: int, result_slot: int, result_complex: bool) -> None:
+    self.instructions = instructions
+    self.constants = constants
+    self.real_registers = real_registers
+    self.complex_registers = complex_registers
+    self.result_slot = result_slot
+    self.result_complex = result_complex
+
+class NumpyProgram:
+  # Note: Evaluates an expression over arrays block by block, every intermediate is written with out= into one of a few
+  # scratch registers of block_size elements so peak memory does not grow with the number of ops in the expression.
+  # Inputs of different shapes are broadcast inside the ufuncs and blocks are taken along the first axis, so grids made of
+  # orthogonal axis arrays are never expanded. dtype is float32, float64, complex64 or complex128, a real dtype is promoted
+  # to the complex dtype of the same precision only for the nodes that need it and a complex dtype makes every node complex.
+  # Logs and powers of real values are only kept real when assumptions prove it, as log(-1) is complex and not nan like in the real ufuncs
+  def __init__(self, expression: Expr, block_size: int = DEFAULT_BLOCK_SIZE, dtype: Optional[DTypeLike] = None, automatic_vars: bool = True, vars: Optional[Iterable[str]] = None,
+               assumptions: Optional[Mapping[str, Domain]] = None) -> None:
+    if vars and automatic_vars: raise RuntimeError("Both automatic vars and specified vars cannot be selected!")
+    if block_size < 1: raise ValueError("Block size must be positive")
+    self.expression = expression
+    self.block_size = block_size
+    self.dtype = numpy.dtype(dtype) if dtype is not None else None
+    self.assumptions = assumptions
+    if self.dtype is not None and self.dtype.name not in DTYPE_PAIRS: raise ValueError(f"Invalid dtype {self.dtype}, must be one of {', '.join(DTYPE_PAIRS)}")
+    self.fxn_vars : List[str] = sorted(find_expression_vars(expression) if automatic_vars else (vars or []))
+    self.dag = ExprDAG([expression])
+    namespace = backend_namespace('numpy')
+    self.values : Dict[int, Any] = {}
+    for i, node in enumerate(self.dag.nodes):
+      if is_op_type(node, Var):
+        if node.name not in self.fxn_vars: raise ValueError(f"Variable '{node.name}' is not among the function variables")
+      elif is_hoistable(node): self.values[i] = eval(generate_lambda_string_wrapper(node, numpy_function_map), namespace)
+    self.complex = any(numpy.iscomplexobj(value) for value in self.values.values()) or any(is_op_type(node, Complex) for node in self.dag.nodes)
+    self.plans : Dict[Tuple[bool, ...], NumpyPlan] = {}
+    plan = self.plan(tuple(self.dtype is not None and self.dtype.kind == 'c' for _ in self.fxn_vars))
+    self.instructions, self.constants, self.registers = plan.instructions, plan.constants, plan.real_registers + plan.complex_registers
+
+  def plan(self, complex_vars: Tuple[bool, ...]) -> NumpyPlan:
+    if (res := self.plans.get(complex_vars)) is None: res = self.plans[complex_vars] = self._compile(complex_vars)
+    return res
+
+  def _compile(self, complex_vars: Tuple[bool, ...]) -> NumpyPlan:
+    dag = self.dag
+    force = self.dtype is not None and self.dtype.kind == 'c'
+    # Note: Real inputs are known to be real, on top of that the caller's assumptions decide which logs and powers stay real
+    assumptions = {name: (self.assumptions or {}).get(name, Domain.Complex) | (Domain.Complex if complex_var else Domain.Real) for name, complex_var in zip(self.fxn_vars, complex_vars)}
+    domains = infer_domains([self.expression], assumptions)
+    last_use = list(range(len(dag)))
+    for i, children in enumerate(dag.children):
+      for child in children: last_use[child] = i
+    slots : Dict[int, Tuple[str, int]] = {} # Note: ('const', index), ('var', index), ('reg', index), ('creg', index) or ('out', 0)
+    is_complex : Dict[int, bool] = {}
+    constants : List[Any] = []
+    counts = {'reg': 0, 'creg': 0}
+    free : Dict[str, List[int]] = {'reg': [], 'creg': []}
+    def allocate(kind: str) -> Tuple[str, int]:
+      if free[kind]: return (kind, free[kind].pop())
+      counts[kind] += 1
+      return (kind, counts[kind] - 1)
+    def release(i: int, children: Tuple[int, ...]) -> None:
+      for child in set(children):
+        if last_use[child] == i and slots[child][0] in free: free[slots[child][0]].append(slots[child][1])
+    code : List[Tuple[Callable[..., Any], Tuple[Tuple[str, int], ...], Tuple[str, int]]] = []
+    root = dag.roots[0]
+    for i, (node, children) in enumerate(zip(dag.nodes, dag.children)):
+      if is_op_type(node, Var):
+        slots[i] = ('var', self.fxn_vars.index(node.name))
+        is_complex[i] = complex_vars[slots[i][1]]
+        continue
+      if i in self.values:
+        constants.append(self.values[i])
+        slots[i] = ('const', len(constants) - 1)
+        is_complex[i] = bool(numpy.iscomplexobj(self.values[i]))
+        continue
+      is_complex[i] = force or is_op_type(node, Complex) or any(is_complex[c] for c in children) or ((is_op_type(node, Log) or is_op_type(node, Pow)) and Domain.Real not in domains[id(node)])
+      kind = 'creg' if is_complex[i] else 'reg'
+      promote = is_complex[i] and not any(is_complex[c] for c in children)
+      args = tuple(slots[c] for c in children)
+      if is_op_type(node, Log) and args[1][0] == 'const':
+        out = slots[i] = allocate(kind) if i != root else ('out', 0)
+        constants.append(numpy.emath.log(constants[args[1][1]]))
+        code.append((_promoted(numpy.log) if promote else numpy.log, (args[0],), out))
+        code.append((numpy.divide, (out, ('const', len(constants) - 1)), out))
+        release(i, children)
+      elif is_op_type(node, Log) or is_op_type(node, Complex):
+        # Note: Ops made of several ufunc calls cannot write into a register that one of their inputs still lives in
+        out = slots[i] = allocate(kind) if i != root else ('out', 0)
+        if is_op_type(node, Log):
+          scratch = allocate(kind)
+          code.append((_logn, args + (scratch,), out))
+          free[scratch[0]].append(scratch[1])
+        else: code.append((_complex, args, out))
+        release(i, children)
+      else:
+        if is_op_type(node, Add): fxn : Callable[..., Any] = numpy.add
+        elif is_op_type(node, Mul): fxn = numpy.multiply
+        elif is_op_type(node, Neg): fxn = numpy.negative
+        elif is_op_type(node, Pow): fxn = numpy.power
+        elif is_op_type(node, Sin): fxn = numpy.sin
+        elif is_op_type(node, Cos): fxn = numpy.cos
+        else: raise TypeError(f'Invalid op {type(node)} cannot be evaluated with numpy!')
+        release(i, children)
+        slots[i] = allocate(kind) if i != root else ('out', 0)
+        code.append((_promoted(fxn) if promote else fxn, args, slots[i]))
+    # Note: Slots are flattened into one list per block: constants, then vars, then real and complex registers and lastly the output
+    bases = {'const': 0, 'var': len(constants), 'reg': len(constants) + len(self.fxn_vars), 'creg': len(constants) + len(self.fxn_vars) + counts['reg'],
+             'out': len(constants) + len(self.fxn_vars) + counts['reg'] + counts['creg']}
+    instructions = [(fxn, tuple(bases[kind] + idx for kind, idx in args), bases[out[0]] + out[1]) for fxn, args, out in code]
+    return NumpyPlan(instructions, constants, counts['reg'], counts['creg'], bases[slots[root][0]] + slots[root][1], force or is_complex[root])
+
+  def _inputs(self, args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> List[Any]:
+    if len(args) + len(kwargs) != len(self.fxn_vars): raise TypeError(f"Function requires {len(self.fxn_vars)} arguments ({','.join(self.fxn_vars)}) but {len(args) + len(kwargs)} were given")
+    values = dict(zip(self.fxn_vars, args))
+    for name, value in kwargs.items():
+      if name not in self.fxn_vars or name in values: raise TypeError(f"Unexpected or duplicate argument '{name}'")
+      values[name] = value
+    return [numpy.asarray(values[name]) for name in self.fxn_vars]
+
+  def dtypes(self, inputs: List[Any]) -> Tuple[Any, Any]:
+    if self.dtype is not None: return DTYPE_PAIRS[self.dtype.name]
+    real = numpy.result_type(numpy.float64, *(x.real.dtype if numpy.iscomplexobj(x) else x.dtype for x in inputs))
+    return real, numpy.result_type(real, numpy.complex64)
+
+  def grid(self, *axes: Any, out: Optional[NDArray[Any]] = None, **named_axes: Any) -> NDArray[Any]:
+    # Note: Evaluates over the outer product of one dimensional axes, in the order the arguments are given, without building a meshgrid
+    inputs = list(zip(self.fxn_vars, axes)) + list(named_axes.items())
+    shaped = {name: numpy.asarray(axis).reshape((1,) * i + (-1,) + (1,) * (len(inputs) - i - 1)) for i, (name, axis) in enumerate(inputs)}
+    return self(out=out, **shaped)
+
+  def __call__(self, *args: Any, out: Optional[NDArray[Any]] = None, **kwargs: Any) -> NDArray[Any]:
+    inputs = self._inputs(args, kwargs)
+    real_dtype, complex_dtype = self.dtypes(inputs)
+    complex_vars = tuple(self.dtype is not None and self.dtype.kind == 'c' or bool(numpy.iscomplexobj(x)) for x in inputs)
+    plan = self.plan(complex_vars)
+    shape = numpy.broadcast_shapes(*(x.shape for x in inputs))
+    dtype = complex_dtype if plan.result_complex else real_dtype
+    if out is None: out = numpy.empty(shape, dtype=dtype)
+    elif out.shape != shape: raise ValueError(f"Output array has shape {out.shape} but the result has shape {shape}")
+    elif not out.flags.c_contiguous or not out.flags.writeable: raise ValueError("Output array must be writeable and C contiguous")
+    # Note: Every input gets the full number of dimensions, inputs of length one along the first axis broadcast and are not sliced
+    work_shape = shape or (1,)
+    inputs = [x.astype(complex_dtype if is_complex else real_dtype, copy=False) for x, is_complex in zip(inputs, complex_vars)]
+    inputs = [x.reshape((1,) * (len(work_shape) - x.ndim) + x.shape) for x in inputs]
+    constants = [numpy.asarray(c, dtype=complex_dtype if numpy.iscomplexobj(c) else real_dtype)[()] for c in plan.constants]
+    result = out.reshape(work_shape)
+    row = math.prod(work_shape[1:])
+    rows = max(min(self.block_size // max(row, 1), work_shape[0]), 1)
+    scratch = [numpy.empty(rows * row, dtype=real_dtype) for _ in range(plan.real_registers)] + [numpy.empty(rows * row, dtype=complex_dtype) for _ in range(plan.complex_registers)]
+    slots : List[Any] = constants + [None] * len(inputs) + [None] * len(scratch) + [None]
+    var_base, reg_base = len(constants), len(constants) + len(inputs)
+    for start in range(0, work_shape[0], rows):
+      stop = min(start + rows, work_shape[0])
+      if start == 0 or stop - start != rows: slots[reg_base:reg_base + len(scratch)] = [register[:(stop - start) * row].reshape((stop - start,) + work_shape[1:]) for register in scratch]
+      for i, x in enumerate(inputs): slots[var_base + i] = x[start:stop] if x.shape[0] != 1 else x
+      slots[-1] = result[start:stop]
+      for fxn, arg_slots, out_slot in plan.instructions: fxn(*[slots[a] for a in arg_slots], out=slots[out_slot])
+      if plan.result_slot != len(slots) - 1: result[start:stop] = slots[plan.result_slot]
+    return out
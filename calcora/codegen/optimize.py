@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+from typing import Dict, List, Optional, Sequence, Tuple
+from typing import TYPE_CHECKING
+
+from calcora.utils import reconstruct_op
+
+from calcora.core.ops import Add, Const, Constant, Mul, Neg, Pow, Var
+from calcora.core.constants import NegOne, One
+from calcora.core.numeric import Numeric
+
+if TYPE_CHECKING:
+  from calcora.core.expression import Expr
+
+MAX_POWER_EXPANSION = 64
+
+def literal_value(expression: Expr) -> Optional[float]:
+  if isinstance(expression, Const): return float(expression.x.real)
+  if isinstance(expression, Neg) and isinstance(expression.x, Const): return -float(expression.x.x.real)
+  return None
+
+def integer_exponent(expression: Expr) -> Optional[int]:
+  value = literal_value(expression)
+  return int(value) if value is not None and value == int(value) else None
+
+def special_power(expression: Pow) -> Optional[str]:
+  # Note: Powers that code generators emit as sqrt and division instead of a call to pow
+  value = literal_value(expression.y)
+  return {0.5: 'sqrt', -1: 'reciprocal', -0.5: 'rsqrt'}.get(value) if value is not None else None
+
+def power_chain(x: Expr, n: int) -> Expr:
+  # Note: Binary exponentiation, the squares are shared nodes so they only get computed once by the DAG based generators
+  result : Optional[Expr] = None
+  while n:
+    if n & 1: result = x if result is None else Mul(result, x)
+    n >>= 1
+    if n: x = Mul(x, x)
+  assert result is not None
+  return result
+
+def _flatten_sum(expression: Expr) -> List[Expr]:
+  terms, stack = [], [expression]
+  while stack:
+    term = stack.pop()
+    if isinstance(term, Add): stack.extend((term.y, term.x))
+    else: terms.append(term)
+  return terms
+
+def _monomial(term: Expr, var: Var, variables: Dict[int, frozenset[str]]) -> Optional[Tuple[int, bool, List[Expr]]]:
+  # Note: Splits a term into (degree, negated, coefficient factors) with respect to var, None if it is not a monomial in var.
+  # variables holds the names of the vars in every op below the term
+  degree, negated, factors, stack = 0, False, [], [term]
+  while stack:
+    op = stack.pop()
+    if op == var: degree += 1
+    elif isinstance(op, Pow) and op.x == var and (n := integer_exponent(op.y)) is not None and n >= 0: degree += n
+    elif isinstance(op, Neg):
+      negated = not negated
+      stack.append(op.x)
+    elif isinstance(op, Mul): stack.extend((op.y, op.x))
+    elif var.name in variables[id(op)]: return None
+    else: factors.append(op)
+  return degree, negated, factors
+
+def _product(factors: List[Expr]) -> Optional[Expr]:
+  result : Optional[Expr] = None
+  for factor in factors: result = factor if result is None else Mul(result, factor)
+  return result
+
+class Optimizer:
+  # Note: Runs bottom up with an explicit stack so deep expressions do not hit the recursion limit. A sum is handled as a whole at its
+  # topmost Add, its terms are optimized first and the Adds inside it are only rebuilt, they hold a subset of the terms so they have no
+  # Horner form when the whole sum has none
+  def __init__(self, horner: bool = True, max_power: int = MAX_POWER_EXPANSION) -> None:
+    self.horner = horner
+    self.max_power = max_power
+    self.memo : Dict[int, Expr] = {}
+    self.sums : Dict[int, List[Expr]] = {}
+    self.variables : Dict[int, frozenset[str]] = {}
+
+  def __call__(self, expression: Expr) -> Expr:
+    stack : List[Tuple[Expr, bool]] = [(expression, False)]
+    while stack:
+      op, expanded = stack.pop()
+      if id(op) in self.memo: continue
+      if isinstance(op, Var) or isinstance(op, Const) or isinstance(op, Constant):
+        self.memo[id(op)] = op
+        self.variables[id(op)] = frozenset((op.name,)) if isinstance(op, Var) else frozenset()
+      elif not expanded:
+        stack.append((op, True))
+        stack.extend((dependency, False) for dependency in self._dependencies(op) if id(dependency) not in self.memo)
+      else:
+        self.variables[id(op)] = frozenset().union(*(self.variables[id(dependency)] for dependency in self._dependencies(op)))
+        self.memo[id(op)] = self._optimize(op)
+    return self.memo[id(expression)]
+
+  def _power(self, expression: Pow) -> Optional[int]:
+    n = integer_exponent(expression.y)
+    return n if n is not None and 2 <= abs(n) <= self.max_power else None
+
+  def _terms(self, expression: Add) -> List[Expr]:
+    if (terms := self.sums.get(id(expression))) is None: terms = self.sums[id(expression)] = _flatten_sum(expression)
+    return terms
+
+  def _dependencies(self, expression: Expr) -> Sequence[Expr]:
+    if isinstance(expression, Add) and self.horner: return self._terms(expression)
+    if isinstance(expression, Pow) and self._power(expression) is not None: return (expression.x,)
+    return expression.args
+
+  def _optimize(self, expression: Expr) -> Expr:
+    if isinstance(expression, Add) and self.horner:
+      horner = self._horner(expression)
+      return horner if horner is not None else self._sum(expression)
+    if isinstance(expression, Pow) and (n := self._power(expression)) is not None:
+      chain = power_chain(self.memo[id(expression.x)], abs(n))
+      return chain if n > 0 else Pow(chain, NegOne)
+    args = tuple(self.memo[id(arg)] for arg in expression.args)
+    return expression if all(a is b for a, b in zip(args, expression.args)) else reconstruct_op(expression, *args)
+
+  def _sum(self, expression: Add) -> Expr:
+    # Note: The terms are already optimized, only the Adds between them are rebuilt
+    stack : List[Tuple[Expr, bool]] = [(expression, False)]
+    while stack:
+      op, expanded = stack.pop()
+      if id(op) in self.memo: continue
+      if not expanded:
+        stack.append((op, True))
+        stack.extend((arg, False) for arg in op.args if id(arg) not in self.memo)
+      else:
+        args = tuple(self.memo[id(arg)] for arg in op.args)
+        self.variables[id(op)] = frozenset().union(*(self.variables[id(arg)] for arg in op.args))
+        self.memo[id(op)] = op if all(a is b for a, b in zip(args, op.args)) else reconstruct_op(op, *args)
+    return self.memo[id(expression)]
+
+  def _horner(self, expression: Add) -> Optional[Expr]:
+    terms = self._terms(expression)
+    best : Optional[Tuple[int, Dict[int, List[Expr]], List[Expr], Var]] = None
+    for name in sorted(self.variables[id(expression)]):
+      var = Var(name)
+      coefficients : Dict[int, List[Expr]] = {}
+      rest : List[Expr] = []
+      for term in terms:
+        monomial = _monomial(term, var, self.variables)
+        if monomial is None or (monomial[0] == 0 and not monomial[2]): rest.append(term); continue
+        degree, negated, factors = monomial
+        coefficient = _product([self.memo[id(f)] for f in factors])
+        if coefficient is None: coefficient = NegOne if negated else None
+        elif negated: coefficient = Neg(coefficient)
+        coefficients.setdefault(degree, []).append(coefficient if coefficient is not None else One)
+      score = sum(1 for degree in coefficients if degree > 0)
+      if max(coefficients, default=0) >= 2 and len(coefficients) >= 2 and (best is None or score > best[0]): best = (score, coefficients, rest, var)
+    if best is None: return None
+    _, coefficients, rest, var = best
+    def coefficient_sum(degree: int) -> Expr:
+      result = coefficients[degree][0]
+      for term in coefficients[degree][1:]: result = Add(result, term)
+      return result
+    degrees = sorted(coefficients, reverse=True)
+    result = coefficient_sum(degrees[0])
+    for high, low in zip(degrees, degrees[1:] + [0]):
+      if high == low: break
+      step = var if high - low == 1 else power_chain(var, high - low) if high - low <= self.max_power else Pow(var, Const(Numeric(high - low)))
+      result = step if result is One else Mul(result, step)
+      if low in coefficients: result = Add(result, coefficient_sum(low))
+    for term in rest: result = Add(result, self.memo[id(term)])
+    return result
+
+def optimize_expression(expression: Expr, horner: bool = True, max_power: int = MAX_POWER_EXPANSION) -> Expr:
+  return Optimizer(horner, max_power)(expression)
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+from typing import Any, Callable, cast, List, Literal, Mapping, Optional, overload, Sequence, Union
+from typing import TYPE_CHECKING
+
+from calcora.codegen.bytecode import BytecodeProgram
+from calcora.codegen.ccompiler import ClangProgram
+from calcora.codegen.lambdify import find_expression_vars, lambdify
+from calcora.core.callbacks import finite_value
+from calcora.core.cse import ExprDAG, is_literal
+from calcora.core.domain import Domain
+from calcora.core.ops import Var
+from calcora.core.registry import ExprArgTypes, is_expr
+from calcora.utils import reconstruct_op
+
+if TYPE_CHECKING:
+  from calcora.codegen.numpy_eval import NumpyProgram
+  from calcora.core.expression import Expr
+
+def fold_parameters(expressions: Sequence[Expr], bindings: Mapping[str, ExprArgTypes]) -> List[Expr]:
+  # Note: Substitutes the bound variables and evaluates every subexpression left without variables, including ones with named
+  # constants, so nothing that only depends on the bindings is computed per call. Folding goes bottom up over the DAG so every node
+  # is evaluated from already folded args and shared subexpressions once. Subexpressions that fail or are not finite (log(0)) are kept
+  if missing := set(bindings) - set().union(*(find_expression_vars(e) for e in expressions)): raise ValueError(f"Variables {', '.join(sorted(missing))} are bound but not used")
+  dag = ExprDAG([e.subs({Var(name): value for name, value in bindings.items()}) for e in expressions])
+  new : List[Expr] = []
+  dynamic : List[bool] = []
+  for node, children in zip(dag.nodes, dag.children):
+    dynamic.append(isinstance(node, Var) or any(dynamic[child] for child in children))
+    args = [new[child] for child in children]
+    if not all(a is b for a, b in zip(args, node.args)): node = reconstruct_op(node, *args)
+    if not dynamic[-1] and not is_literal(node): node = value if (value := finite_value(node)) is not None else node
+    new.append(node)
+  return [new[root] for root in dag.roots]
+
+def _roots(expression: Union[Expr, Sequence[Expr]]) -> List[Expr]:
+  if is_expr(expression): return [expression]
+  return list(cast('Sequence[Expr]', expression))
+
+def _remaining_vars(fxn_vars: Sequence[str], bindings: Mapping[str, ExprArgTypes], expressions: Sequence[Expr]) -> List[str]:
+  # Note: Keeps the order of the original variables, bindings that are expressions may bring in new ones which are appended sorted
+  remaining = [var for var in fxn_vars if var not in bindings]
+  return remaining + sorted(set().union(*(find_expression_vars(e) for e in expressions)) - set(remaining))
+
+def _remaining_assumptions(assumptions: Optional[Mapping[str, Domain]], bindings: Mapping[str, ExprArgTypes]) -> Optional[Mapping[str, Domain]]:
+  return {var: domain for var, domain in assumptions.items() if var not in bindings} if assumptions is not None else None
+
+@overload
+def specialize(target: ClangProgram, bindings: Mapping[str, ExprArgTypes], backend: Literal["mpmath", "numpy", "python"] = ...) -> ClangProgram: ...
+@overload
+def specialize(target: BytecodeProgram, bindings: Mapping[str, ExprArgTypes], backend: Literal["mpmath", "numpy", "python"] = ...) -> BytecodeProgram: ...
+@overload
+def specialize(target: NumpyProgram, bindings: Mapping[str, ExprArgTypes], backend: Literal["mpmath", "numpy", "python"] = ...) -> NumpyProgram: ...
+@overload
+def specialize(target: Union[Expr, Sequence[Expr], Callable[..., Any]], bindings: Mapping[str, ExprArgTypes], backend: Literal["mpmath", "numpy", "python"] = ...) -> Callable[..., Any]: ...
+
+def specialize(target: Union[Expr, Sequence[Expr], Callable[..., Any], ClangProgram, BytecodeProgram, NumpyProgram], bindings: Mapping[str, ExprArgTypes],
+               backend: Literal["mpmath", "numpy", "python"] = "python") -> Union[Callable[..., Any], ClangProgram, BytecodeProgram, NumpyProgram]:
+  # Note: Fixes some variables of an expression or a compiled function and returns the same kind of function over the remaining variables,
+  # everything that only depends on the bound variables is evaluated here once instead of on every call. Expressions are lambdified with
+  # backend, compiled functions keep their own backend and options. Specializing again with other bindings starts from the original expression
+  if isinstance(target, ClangProgram):
+    expression = fold_parameters([target.expression], bindings)[0]
+    return ClangProgram(expression, assumptions=_remaining_assumptions(target.assumptions, bindings), optimize=target.optimize, openmp=target.openmp,
+                        cache=target.cache if target.cache is not None else False, autotune=target.autotune)
+  if isinstance(target, BytecodeProgram):
+    expressions = fold_parameters(target.expressions, bindings)
+    return BytecodeProgram(expressions[0] if target.single else expressions, target.mode, _remaining_vars(target.fxn_vars, bindings, expressions), target.fold)
+  if is_expr(target) or isinstance(target, Sequence):
+    roots = _roots(target)
+    expressions = fold_parameters(roots, bindings)
+    fxn_vars = sorted(set().union(*(find_expression_vars(e) for e in roots)))
+    return lambdify(expressions[0] if is_expr(target) else expressions, backend, automatic_vars=False, vars=_remaining_vars(fxn_vars, bindings, expressions))
+  if callable(target) and hasattr(target, 'expression') and hasattr(target, 'options'):
+    # Note: A function returned by lambdify, it carries the expression and the options it was generated with
+    options = dict(target.options, assumptions=_remaining_assumptions(target.options['assumptions'], bindings))
+    single = is_expr(target.expression)
+    expressions = fold_parameters(_roots(target.expression), bindings)
+    return lambdify(expressions[0] if single else expressions, automatic_vars=False, vars=_remaining_vars(getattr(target, 'fxn_vars'), bindings, expressions), **options)
+  try: from calcora.codegen.numpy_eval import NumpyProgram
+  except ImportError: NumpyProgram = None # type: ignore
+  if NumpyProgram is not None and isinstance(target, NumpyProgram):
+    expression = fold_parameters([target.expression], bindings)[0]
+    return NumpyProgram(expression, target.block_size, target.dtype, automatic_vars=False, vars=_remaining_vars(target.fxn_vars, bindings, [expression]),
+                        assumptions=_remaining_assumptions(target.assumptions, bindings))
+  raise TypeError(f"Cannot specialize object of type {type(target).__name__}")
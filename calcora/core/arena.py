@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+from typing import Any, Dict, Hashable, Iterator, List, Literal, Mapping, Optional, Sequence, Tuple, Union
+from typing import TYPE_CHECKING
+
+from array import array
+
+import cmath
+import json
+import math
+import struct
+
+from calcora.globals import BaseOps
+
+from calcora.core.numeric import Numeric
+from calcora.core.ops import Complex, ComplexForm, Const, Constant, Var
+from calcora.core.registry import ConstantRegistry, FunctionRegistry
+
+import mpmath
+from mpmath import mpc, mpf, workprec
+
+if TYPE_CHECKING:
+  from calcora.core.expression import Expr
+
+OPCODES : Tuple[BaseOps, ...] = tuple(BaseOps)
+OPCODE : Dict[BaseOps, int] = {op: i for i, op in enumerate(OPCODES)}
+CONST, CONSTANT, COMPLEX, VAR, NEG, ADD, MUL, POW, LOG, SIN, COS = (OPCODE[op] for op in (BaseOps.Const, BaseOps.Constant, BaseOps.Complex, BaseOps.Var, BaseOps.Neg,
+                                                                                        BaseOps.Add, BaseOps.Mul, BaseOps.Pow, BaseOps.Log, BaseOps.Sin, BaseOps.Cos))
+COMPLEX_FORMS : Tuple[ComplexForm, ...] = tuple(ComplexForm)
+MAGIC = b'CALCARN1'
+HEADER = struct.Struct('<8sQQ')
+
+type ArenaMode = Literal['float', 'complex', 'mpmath']
+
+def _pack_mpf(x: mpf) -> Tuple[int, int, int]:
+  sign, man, exp, bc = x._mpf_
+  return (-man if sign else man), exp, bc
+
+def _unpack_mpf(man: int, exp: int, bc: int) -> mpf:
+  with workprec(max(bc, 1)): return mpf((man, exp)) # Note: Exact at the precision of the mantissa
+
+def _unpack_numeric(values: List[int]) -> Numeric:
+  precision, real, imag = values[0], _unpack_mpf(*values[1:4]), _unpack_mpf(*values[4:7])
+  with workprec(max(values[3], values[6], 1)): return Numeric(mpc(real, imag), precision=precision, skip_conversion=True)
+
+class _Hashed:
+  # Note: Stands in for an op inside tuples and frozensets so the combined hash is the same as for the ops themselves
+  __slots__ = ('value',)
+  def __init__(self, value: int) -> None: self.value = value
+  def __hash__(self) -> int: return self.value
+  def __eq__(self, other: object) -> bool: return isinstance(other, _Hashed) and self.value == other.value
+
+def _constant_value(name: str, mode: ArenaMode) -> Any:
+  value : Any = ConstantRegistry.get(name).x()
+  return value if mode == 'mpmath' else float(value)
+
+class ExprArena:
+  # Note: Struct of arrays form of an expression DAG. Node i has the opcode ops[i] (an index into BaseOps), children left[i] and right[i] (-1 when absent)
+  # and data[i], which is the index into the constant pool for Const, into the symbol pool for Var and Constant and the ComplexForm for Complex.
+  # Nodes are hash consed and stored with children before parents, so every walk is a single pass over the arrays. Indices are 32 bit
+  def __init__(self) -> None:
+    self.ops = array('B')
+    self.left = array('i')
+    self.right = array('i')
+    self.data = array('i')
+    self.roots = array('i')
+    self.constants : List[Numeric] = []
+    self.symbols : List[str] = []
+    self._index : Optional[Dict[Hashable, int]] = {}
+    self._constant_index : Dict[Tuple[Any, int], int] = {}
+    self._symbol_index : Dict[str, int] = {}
+
+  @classmethod
+  def from_expr(cls, *expressions: Expr) -> ExprArena:
+    arena = cls()
+    for expression in expressions: arena.add(expression)
+    arena._index = None # Note: The hash cons table is several times the size of the arrays, it is rebuilt on the next add
+    return arena
+
+  def __len__(self) -> int: return len(self.ops)
+
+  @property
+  def nbytes(self) -> int: return sum(buffer.itemsize * len(buffer) for buffer in (self.ops, self.left, self.right, self.data, self.roots))
+
+  def _constant(self, x: Numeric) -> int:
+    if (idx := self._constant_index.get((x.value, x.precision))) is None:
+      idx = self._constant_index[(x.value, x.precision)] = len(self.constants)
+      self.constants.append(x)
+    return idx
+
+  def _symbol(self, name: str) -> int:
+    if (idx := self._symbol_index.get(name)) is None:
+      idx = self._symbol_index[name] = len(self.symbols)
+      self.symbols.append(name)
+    return idx
+
+  def _node(self, opcode: int, left: int, right: int, data: int) -> int:
+    if self._index is None: self._index = {(op, l, r, d): i for i, (op, l, r, d) in enumerate(zip(self.ops, self.left, self.right, self.data))}
+    if (idx := self._index.get((opcode, left, right, data))) is None:
+      idx = self._index[(opcode, left, right, data)] = len(self.ops)
+      self.ops.append(opcode)
+      self.left.append(left)
+      self.right.append(right)
+      self.data.append(data)
+    return idx
+
+  def add(self, expression: Expr) -> int:
+    # Note: Appends the expression as a new root and returns its node index, subexpressions already in the arena are reused
+    seen : Dict[int, int] = {}
+    stack : List[Tuple[Expr, bool]] = [(expression, False)]
+    while stack:
+      node, expanded = stack.pop()
+      if id(node) in seen: continue
+      fxn = node.fxn
+      if isinstance(node, Const): seen[id(node)] = self._node(CONST, -1, -1, self._constant(node.x))
+      elif isinstance(node, (Var, Constant)): seen[id(node)] = self._node(OPCODE[fxn], -1, -1, self._symbol(node.name))
+      elif fxn in (BaseOps.AnyOp, BaseOps.NoOp): raise ValueError(f"Cannot store op of type {fxn.name} in an arena")
+      elif not expanded:
+        stack.append((node, True))
+        stack.extend((arg, False) for arg in reversed(node.args) if id(arg) not in seen)
+      else:
+        children = [seen[id(arg)] for arg in node.args] + [-1] * (2 - len(node.args))
+        data = COMPLEX_FORMS.index(node.representation) if isinstance(node, Complex) else 0
+        seen[id(node)] = self._node(OPCODE[fxn], children[0], children[1], data)
+    self.roots.append(seen[id(expression)])
+    return seen[id(expression)]
+
+  def children(self, idx: int) -> Tuple[int, ...]: return tuple(child for child in (self.left[idx], self.right[idx]) if child >= 0)
+
+  def reachable(self, roots: Optional[Sequence[int]] = None) -> bytearray:
+    # Note: Marks every node below the roots in one backwards sweep, parents always come after their children
+    mask = bytearray(len(self.ops))
+    for root in (self.roots if roots is None else roots): mask[root] = 1
+    left, right = self.left, self.right
+    for i in range(len(mask) - 1, -1, -1):
+      if mask[i]:
+        if (l := left[i]) >= 0: mask[l] = 1
+        if (r := right[i]) >= 0: mask[r] = 1
+    return mask
+
+  def postorder(self, root: Optional[int] = None) -> Iterator[int]:
+    mask = self.reachable(None if root is None else [root])
+    return (i for i in range(len(mask)) if mask[i])
+
+  def to_exprs(self) -> List[Expr]:
+    built : Dict[int, Expr] = {}
+    mask = self.reachable()
+    for i in range(len(mask)):
+      if not mask[i]: continue
+      op, data = self.ops[i], self.data[i]
+      if op == CONST: built[i] = Const(self.constants[data])
+      elif op == VAR: built[i] = Var(self.symbols[data])
+      elif op == CONSTANT: built[i] = ConstantRegistry.get(self.symbols[data])
+      elif op == COMPLEX: built[i] = Complex(built[self.left[i]], built[self.right[i]], representation=COMPLEX_FORMS[data])
+      else: built[i] = FunctionRegistry.get(OPCODES[op].value)(*(built[child] for child in self.children(i)))
+    return [built[root] for root in self.roots]
+
+  def to_expr(self, root: int = 0) -> Expr: return self.to_exprs()[root]
+
+  def hashes(self) -> List[int]:
+    # Note: Equal to hash() of the corresponding Expr, so arena nodes and ops can be mixed in dicts and sets
+    res : List[int] = []
+    for i in range(len(self.ops)):
+      op, l, r, data = self.ops[i], self.left[i], self.right[i], self.data[i]
+      if op == CONST: res.append(hash(('Const', (self.constants[data],))))
+      elif op == VAR: res.append(hash(('Var', (self.symbols[data],))))
+      elif op == CONSTANT: res.append(hash(ConstantRegistry.get(self.symbols[data])))
+      elif op in (ADD, MUL): res.append(hash((OPCODES[op].name, frozenset((_Hashed(res[l]), _Hashed(res[r]))))))
+      else: res.append(hash((OPCODES[op].name, tuple(_Hashed(res[child]) for child in (l, r) if child >= 0))))
+    return res
+
+  def hash(self, root: int = 0) -> int: return self.hashes()[self.roots[root]]
+
+  def evaluate(self, values: Optional[Mapping[str, Any]] = None, mode: ArenaMode = 'complex') -> List[Any]:
+    # Note: Evaluates every root in one pass, float uses math, complex uses cmath and mpmath matches Expr._eval at the current precision
+    values = values or {}
+    lib : Any = mpmath if mode == 'mpmath' else math if mode == 'float' else cmath
+    cast = float if mode == 'float' else complex if mode == 'complex' else None
+    sin, cos, log = lib.sin, lib.cos, lib.log
+    constants = [constant.value.real if mode == 'mpmath' else float(constant.value.real) for constant in self.constants]
+    mask = self.reachable()
+    res : List[Any] = [None] * len(mask)
+    ops, left, right, data = self.ops, self.left, self.right, self.data
+    for i in range(len(mask)):
+      if not mask[i]: continue
+      op = ops[i]
+      if op == CONST: res[i] = constants[data[i]]
+      elif op == VAR:
+        name = self.symbols[data[i]]
+        if name not in values: raise ValueError(f"Specified value for type var is required for evaluation, no value for var with name '{name}'")
+        res[i] = cast(values[name]) if cast is not None else values[name]
+      elif op == CONSTANT: res[i] = _constant_value(self.symbols[data[i]], mode)
+      elif op == ADD: res[i] = res[left[i]] + res[right[i]]
+      elif op == MUL: res[i] = res[left[i]] * res[right[i]]
+      elif op == NEG: res[i] = -res[left[i]]
+      elif op == POW: res[i] = res[left[i]] ** res[right[i]]
+      elif op == SIN: res[i] = sin(res[left[i]])
+      elif op == COS: res[i] = cos(res[left[i]])
+      elif op == LOG: res[i] = log(res[left[i]], res[right[i]]) if mode == 'mpmath' else log(res[left[i]]) / log(res[right[i]])
+      elif op == COMPLEX: res[i] = mpc(res[left[i]], res[right[i]]) if mode == 'mpmath' else complex(res[left[i]], 0) + 1j * res[right[i]]
+      else: raise ValueError(f"Cannot evaluate op of type {OPCODES[op].name}")
+    return [res[root] for root in self.roots]
+
+  def to_bytes(self) -> bytes:
+    # Note: Little endian header and arrays followed by the pools as json, constants are stored as exact (mantissa, exponent, bits) triples
+    pools = json.dumps({'symbols': self.symbols, 'constants': [[constant.precision, *_pack_mpf(constant.value.real), *_pack_mpf(constant.value.imag)] for constant in self.constants]}).encode()
+    buffers = [self.ops, self.left, self.right, self.data, self.roots]
+    if struct.pack('=H', 1) != struct.pack('<H', 1):
+      buffers = [array(buffer.typecode, buffer) for buffer in buffers]
+      for buffer in buffers: buffer.byteswap()
+    return HEADER.pack(MAGIC, len(self.ops), len(self.roots)) + b''.join(buffer.tobytes() for buffer in buffers) + pools
+
+  @classmethod
+  def from_bytes(cls, data: Union[bytes, bytearray, memoryview]) -> ExprArena:
+    data = memoryview(data)
+    magic, n, n_roots = HEADER.unpack_from(data)
+    if magic != MAGIC: raise ValueError("Data is not a serialized ExprArena")
+    arena = cls()
+    offset = HEADER.size
+    for name, length in (('ops', n), ('left', n), ('right', n), ('data', n), ('roots', n_roots)):
+      buffer = getattr(arena, name)
+      size = buffer.itemsize * length
+      buffer.frombytes(data[offset:offset + size])
+      if struct.pack('=H', 1) != struct.pack('<H', 1): buffer.byteswap()
+      offset += size
+    pools = json.loads(bytes(data[offset:]))
+    arena.symbols = pools['symbols']
+    arena.constants = [_unpack_numeric(values) for values in pools['constants']]
+    arena._symbol_index = {name: i for i, name in enumerate(arena.symbols)}
+    arena._constant_index = {(constant.value, constant.precision): i for i, constant in enumerate(arena.constants)}
+    arena._index = None # Note: Rebuilt on the first add
+    return arena
@@ -1,14 +1,131 @@
 from __future__ import annotations
 
+from typing import Callable, Dict, Iterable, List, Optional
 from typing import TYPE_CHECKING
 
-from calcora.core.registry import Dispatcher
+import time
+
+import mpmath
+
+from calcora.globals import BaseOps
+from calcora.utils import dprint
+
+from calcora.core.registry import Dispatcher, FunctionRegistry
 
 if TYPE_CHECKING:
   from calcora.core.expression import Expr
 
-def callback_dispatcher(expression: Expr) -> Expr:
-  # TODO: This function will handle calling the correct callbacks
+class Callback:
+  def __init__(self, name: str, fxn: Callable[[Expr], Expr], ops: Optional[Iterable[BaseOps]] = None, enabled: bool = True) -> None:
+    self.name = name
+    self.fxn = fxn
+    self.ops = frozenset(ops) if ops is not None else None
+    self.enabled = enabled
+    self.calls = 0
+    self.rewrites = 0
+    self.time_ns = 0
+
+  def applies_to(self, expression: Expr) -> bool: return self.enabled and (self.ops is None or expression.fxn in self.ops)
+
+  def __call__(self, expression: Expr) -> Expr:
+    start = time.perf_counter_ns()
+    new_expression = self.fxn(expression)
+    self.time_ns += time.perf_counter_ns() - start
+    self.calls += 1
+    if new_expression is not expression: self.rewrites += 1
+    return new_expression
+
+class CallbackPipeline:
+  # Note: Callbacks run in registration order on every op created through the Dispatcher, each one sees the result of the previous one
+  def __init__(self, callbacks: Optional[List[Callback]] = None) -> None:
+    self.callbacks = callbacks if callbacks else list()
+
+  def register(self, callback: Callback, index: Optional[int] = None) -> None:
+    if any(c.name == callback.name for c in self.callbacks): raise ValueError(f"Callback with name '{callback.name}' is already registered")
+    self.callbacks.insert(index if index is not None else len(self.callbacks), callback)
+
+  def unregister(self, name: str) -> None: self.callbacks.remove(self.get(name))
+
+  def get(self, name: str) -> Callback:
+    for callback in self.callbacks:
+      if callback.name == name: return callback
+    raise KeyError(f"No callback with name '{name}' registered")
+
+  def enable(self, *names: str) -> None:
+    for callback in (self.get(name) for name in names) if names else self.callbacks: callback.enabled = True
+  def disable(self, *names: str) -> None:
+    for callback in (self.get(name) for name in names) if names else self.callbacks: callback.enabled = False
+
+  def stats(self) -> Dict[str, Dict[str, int]]:
+    return {c.name: {'enabled': int(c.enabled), 'calls': c.calls, 'rewrites': c.rewrites, 'time_ns': c.time_ns} for c in self.callbacks}
+
+  def reset_stats(self) -> None:
+    for callback in self.callbacks: callback.calls, callback.rewrites, callback.time_ns = 0, 0, 0
+
+  def __call__(self, expression: Expr) -> Expr:
+    for callback in self.callbacks:
+      if callback.applies_to(expression):
+        new_expression = callback(expression)
+        if new_expression is not expression: dprint(f'Callback \'{callback.name}\' $ -> $', 4, 'cyan', expression, new_expression)
+        expression = new_expression
+    return expression
+
+def is_number(expression: Expr) -> bool:
+  if expression.fxn == BaseOps.Const: return True
+  if expression.fxn == BaseOps.Neg: return expression.args[0].fxn == BaseOps.Const
+  if expression.fxn == BaseOps.Complex: return all(is_number(arg) for arg in expression.args)
+  return False
+
+def is_value(expression: Expr, value: int) -> bool:
+  if value < 0: return expression.fxn == BaseOps.Neg and is_value(expression.args[0], -value)
+  return expression.fxn == BaseOps.Const and expression.args[0] == value
+
+def finite_value(expression: Expr) -> Optional[Expr]:
+  # Note: The value of an op as a number, None when evaluating it fails (1/0, log(0)) or is not finite so the op is kept unfolded
+  try: value = expression._eval()
+  except (ZeroDivisionError, ValueError, OverflowError): return None
+  return Dispatcher.typecast(value) if mpmath.isfinite(value) else None
+
+def fold_constants(expression: Expr) -> Expr:
+  if is_number(expression) or not all(is_number(arg) for arg in expression.args): return expression
+  folded = finite_value(expression)
+  return folded if folded is not None else expression
+
+def eliminate_identities(expression: Expr) -> Expr:
+  if expression.fxn == BaseOps.Add:
+    x, y = expression.args
+    if is_value(y, 0): return x
+    if is_value(x, 0): return y
+  elif expression.fxn == BaseOps.Mul:
+    x, y = expression.args
+    if is_value(y, 1): return x
+    if is_value(x, 1): return y
+    if is_value(x, 0): return x
+    if is_value(y, 0): return y
+  elif expression.fxn == BaseOps.Pow:
+    x, y = expression.args
+    if is_value(y, 1): return x
+  return expression
+
+def normalize_signs(expression: Expr) -> Expr:
+  if expression.fxn == BaseOps.Neg:
+    x, = expression.args
+    if x.fxn == BaseOps.Neg: return x.args[0]
+    if is_value(x, 0): return x
+  elif expression.fxn == BaseOps.Mul:
+    x, y = expression.args
+    if is_value(y, -1): return FunctionRegistry.get("Neg")(x)
+    if is_value(x, -1): return FunctionRegistry.get("Neg")(y)
+    if x.fxn == BaseOps.Neg and y.fxn == BaseOps.Neg: return FunctionRegistry.get("Mul")(x.args[0], y.args[0])
   return expression
 
-setattr(Dispatcher, '_callback_fxn', callback_dispatcher)
\ No newline at end of file
+# Note: These are disabled by default since they change the structure of the expressions that are built, enable them with Callbacks.enable()
+Callbacks = CallbackPipeline([
+  Callback('fold_constants', fold_constants, ops=(BaseOps.Neg, BaseOps.Add, BaseOps.Mul, BaseOps.Pow, BaseOps.Log, BaseOps.Sin, BaseOps.Cos), enabled=False),
+  Callback('eliminate_identities', eliminate_identities, ops=(BaseOps.Add, BaseOps.Mul, BaseOps.Pow), enabled=False),
+  Callback('normalize_signs', normalize_signs, ops=(BaseOps.Neg, BaseOps.Mul), enabled=False),
+])
+
+def callback_dispatcher(expression: Expr) -> Expr: return Callbacks(expression)
+
+setattr(Dispatcher, '_callback_fxn', callback_dispatcher)
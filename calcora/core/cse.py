@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+from typing import Dict, Hashable, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+from typing import TYPE_CHECKING
+
+from itertools import count
+
+from calcora.globals import BaseOps
+from calcora.utils import reconstruct_op
+
+from calcora.core.ops import Var
+
+if TYPE_CHECKING:
+  from calcora.core.expression import Expr
+
+LEAF_OPS = (BaseOps.Const, BaseOps.Var, BaseOps.Constant, BaseOps.AnyOp)
+
+def is_leaf(expression: Expr) -> bool: return expression.fxn in LEAF_OPS
+
+def is_literal(expression: Expr) -> bool:
+  if expression.fxn == BaseOps.Neg: return expression.args[0].fxn == BaseOps.Const
+  if expression.fxn == BaseOps.Complex: return all(is_literal(arg) for arg in expression.args)
+  return expression.fxn in (BaseOps.Const, BaseOps.Constant)
+
+def _leaf_key(expression: Expr) -> Hashable:
+  if expression.fxn == BaseOps.Const: return (expression.fxn, expression.args[0])
+  if expression.fxn == BaseOps.AnyOp: return (expression.fxn, id(expression))
+  if expression.fxn == BaseOps.Constant: return (expression.fxn, expression.args[1], expression.args[0]) # Note: The args of a Constant are its mpmath value and then its name
+  return (expression.fxn, expression.args[0]) # Note: The first arg of a Var is its name
+
+class ExprDAG:
+  # Note: Structurally equal subexpressions are merged into a single node (hash consing), nodes are stored with children before parents
+  def __init__(self, expressions: Iterable[Expr]) -> None:
+    self.nodes : List[Expr] = []
+    self.children : List[Tuple[int, ...]] = []
+    self.uses : List[int] = []
+    self.roots : List[int] = []
+    index : Dict[Hashable, int] = {}
+    seen : Dict[int, int] = {}
+    for root in expressions:
+      stack : List[Tuple[Expr, bool]] = [(root, False)]
+      while stack:
+        expression, expanded = stack.pop()
+        if id(expression) in seen: continue
+        if not expanded and not is_leaf(expression):
+          stack.append((expression, True))
+          stack.extend((arg, False) for arg in reversed(expression.args) if id(arg) not in seen)
+          continue
+        children = tuple(seen[id(arg)] for arg in expression.args) if not is_leaf(expression) else ()
+        key = (expression.fxn, tuple(sorted(children)) if expression.commutative else children) if children else _leaf_key(expression)
+        if (idx := index.get(key)) is None:
+          idx = index[key] = len(self.nodes)
+          self.nodes.append(expression)
+          self.children.append(children)
+          self.uses.append(0)
+          for child in children: self.uses[child] += 1
+        seen[id(expression)] = idx
+      self.roots.append(seen[id(root)])
+      self.uses[self.roots[-1]] += 1
+
+  def __len__(self) -> int: return len(self.nodes)
+
+  def costs(self) -> List[int]:
+    # Note: The cost of a node is the number of ops in its tree form, leaves are free
+    res : List[int] = []
+    for node, children in zip(self.nodes, self.children): res.append(0 if is_leaf(node) else 1 + sum(res[c] for c in children))
+    return res
+
+  def var_names(self) -> set[str]: return {node.name for node in self.nodes if isinstance(node, Var)}
+
+def numbered_symbols(prefix: str = 'x', exclude: Iterable[str] = ()) -> Iterator[str]:
+  excluded = set(exclude)
+  return (f'{prefix}{i}' for i in count() if f'{prefix}{i}' not in excluded)
+
+def cse(expressions: Union[Expr, Sequence[Expr]], min_cost: int = 1, symbols: Optional[Iterator[str]] = None) -> Tuple[List[Tuple[Var, Expr]], List[Expr]]:
+  dag = ExprDAG(list(expressions) if isinstance(expressions, Sequence) else [expressions])
+  costs = dag.costs()
+  symbols = symbols if symbols else numbered_symbols(exclude=dag.var_names())
+  replacements : List[Tuple[Var, Expr]] = []
+  built : List[Expr] = []
+  for i, (node, children) in enumerate(zip(dag.nodes, dag.children)):
+    args = tuple(built[c] for c in children)
+    new_node = node if all(a is b for a, b in zip(args, node.args)) else reconstruct_op(node, *args)
+    if dag.uses[i] > 1 and costs[i] >= min_cost and not is_leaf(node) and not is_literal(node):
+      symbol = Var(next(symbols))
+      replacements.append((symbol, new_node))
+      new_node = symbol
+    built.append(new_node)
+  return replacements, [built[root] for root in dag.roots]
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+from typing import TYPE_CHECKING
+
+from enum import Flag, auto
+
+from calcora.globals import BaseOps
+from calcora.core.stringops import *
+from calcora.utils import is_op_type
+
+if TYPE_CHECKING:
+  from calcora.core.expression import Expr
+  from calcora.core.ops import Const, Constant, Var
+
+class Domain(Flag):
+  # Note: A domain is the set of facts known to hold for every value an expression can take, no facts means possibly complex
+  Complex = 0
+  Real = auto()
+  NonNegative = auto()
+  NonZero = auto()
+  Positive = auto()
+  Integer = auto()
+
+def close_domain(domain: Domain) -> Domain:
+  # Note: Adds the facts that follow from the given ones
+  if Domain.Positive in domain: domain |= Domain.NonNegative | Domain.NonZero
+  if domain & (Domain.NonNegative | Domain.Integer): domain |= Domain.Real
+  return domain
+
+def _number_domain(value: complex) -> Domain:
+  if value.imag: return Domain.NonZero
+  domain = Domain.Real
+  if value.real >= 0: domain |= Domain.NonNegative
+  if value.real != 0: domain |= Domain.NonZero
+  if value.real > 0: domain |= Domain.Positive
+  if value.real == int(value.real): domain |= Domain.Integer
+  return domain
+
+def _is_even_integer(expression: Expr) -> bool:
+  if expression.fxn == BaseOps.Neg: return _is_even_integer(expression.args[0])
+  return is_op_type(expression, Const) and complex(expression.x.value).real % 2 == 0
+
+def _op_domain(expression: Expr, args: List[Domain]) -> Domain:
+  R, NN, NZ, P, Z = Domain.Real, Domain.NonNegative, Domain.NonZero, Domain.Positive, Domain.Integer
+  if expression.fxn == BaseOps.Complex:
+    real, imag = args
+    if expression.args[1].fxn == BaseOps.Const and expression.args[1].args[0] == 0: return real
+    return NZ if R in imag and NZ in imag else Domain.Complex
+  elif expression.fxn == BaseOps.Neg:
+    x, = args
+    return x & (R | NZ | Z)
+  elif expression.fxn == BaseOps.Add:
+    x, y = args
+    domain = x & y & (R | NN | Z)
+    if NN in domain and (P in x or P in y): domain |= P
+    return domain
+  elif expression.fxn == BaseOps.Mul:
+    x, y = args
+    return x & y & (R | NN | NZ | P | Z)
+  elif expression.fxn == BaseOps.Pow:
+    x, y = args
+    if P in x and R in y: return R | NN | NZ | P
+    if R in x and Z in y: # Note: 0 to a negative power is a division by zero rather than a complex value
+      domain = R | (x & NZ)
+      if NN in x or _is_even_integer(expression.args[1]): domain |= NN
+      if NN in domain and NZ in domain: domain |= P
+      if Z in x and NN in y: domain |= Z
+      return domain
+    if NN in x and R in y and P in y: return R | NN
+    return Domain.Complex
+  elif expression.fxn == BaseOps.Log:
+    x, base = args
+    return R if P in x and P in base else Domain.Complex
+  elif expression.fxn in (BaseOps.Sin, BaseOps.Cos):
+    x, = args
+    return R if R in x else Domain.Complex
+  return Domain.Complex
+
+def infer_domains(expressions: Iterable[Expr], assumptions: Optional[Mapping[str, Domain]] = None) -> Dict[int, Domain]:
+  # Note: Maps the id of every node to its inferred domain, variables without assumptions are treated as complex
+  assumptions = {name: close_domain(domain) for name, domain in (assumptions or {}).items()}
+  domains : Dict[int, Domain] = {}
+  for root in expressions:
+    stack : List[Tuple[Expr, bool]] = [(root, False)]
+    while stack:
+      expression, expanded = stack.pop()
+      if id(expression) in domains: continue
+      if is_op_type(expression, Var): domains[id(expression)] = assumptions.get(expression.name, Domain.Complex)
+      elif is_op_type(expression, Const): domains[id(expression)] = _number_domain(complex(expression.x.value))
+      elif is_op_type(expression, Constant): domains[id(expression)] = _number_domain(complex(expression._eval()))
+      elif expression.fxn == BaseOps.AnyOp: domains[id(expression)] = Domain.Complex
+      elif not expanded:
+        stack.append((expression, True))
+        stack.extend((arg, False) for arg in expression.args if id(arg) not in domains)
+      else: domains[id(expression)] = _op_domain(expression, [domains[id(arg)] for arg in expression.args])
+  return domains
+
+def infer_domain(expression: Expr, assumptions: Optional[Mapping[str, Domain]] = None) -> Domain:
+  return infer_domains([expression], assumptions)[id(expression)]
@@ -1,23 +1,29 @@
 from __future__ import annotations
 
 from itertools import permutations
-from typing import Any, Tuple, Union, Hashable
+from typing import Any, Dict, List, Mapping, Optional, Tuple, Union, Hashable
 from typing import TYPE_CHECKING
 import weakref
 
 from calcora.globals import BaseOps, GlobalCounter
 from calcora.types import CalcoraNumber, NumericType
 
+from calcora.core.callbacks import finite_value
 from calcora.core.numeric import Numeric
 from calcora.core.registry import FunctionRegistry, Dispatcher, ExprArgTypes
 
-from calcora.utils import dprint
+from calcora.utils import dprint, reconstruct_op
 
 from mpmath import mpc, mpf
 
 if TYPE_CHECKING:
   from calcora.core.ops import Var
 
+def is_numeric(op: Expr) -> bool:
+  if op.fxn == BaseOps.Const: return True
+  if op.fxn in (BaseOps.Var, BaseOps.Constant, BaseOps.AnyOp): return False
+  return all(is_numeric(arg) for arg in op.args)
+
 class Expr:
   _finalizer_refs : set[weakref.finalize] = set() # Static sets of all finalizers to make sure they don't get garbage collected before instance is deleted.
   _initialized_printing = False
@@ -28,16 +34,22 @@ class Expr:
     self.fxn: BaseOps = BaseOps(self.__class__.__name__)
     self.priority : int = 0 # higher equals higher priority, ex multiplication before addition, etc.
     self.commutative = commutative
+    self._hash : Optional[int] = None
+    self._normal_form : Optional[object] = None # Note: Set by simplify to the token of the rules this op is known to be simplified under
     GlobalCounter.num_ops += 1
     finalizer = weakref.finalize(self, GlobalCounter.decrement_ops)
     Expr._finalizer_refs.add(finalizer)
     dprint(f'Op \'{self.fxn.name}\' created with args $', 4, 'yellow', self.args)
 
   def __eq__(self, other: object) -> bool:
+    if self is other: return True
     return isinstance(other, Expr) and self.fxn == other.fxn and \
       (self.args == other.args if not self.commutative else any(other.args == op_args for op_args in permutations(self.args)))
   
-  def __hash__(self) -> int: return hash((self.fxn.name, frozenset(self.args) if self.commutative else self.args))
+  def __hash__(self) -> int:
+    # Note: Ops are never mutated after creation so the (recursive) hash only has to be computed once
+    if self._hash is None: self._hash = hash((self.fxn.name, frozenset(self.args) if self.commutative else self.args))
+    return self._hash
   
   def add(self, x: ExprArgTypes) -> Expr: return Dispatcher.add(self, x)
   def sub(self, x: ExprArgTypes) -> Expr: return Dispatcher.sub(self, x)
@@ -69,6 +81,39 @@ class Expr:
   
   def differentiate(self, var: Var) -> Expr: raise NotImplementedError()
 
+  def subs(self, substitutions: Mapping[Expr, ExprArgTypes], fold: bool = False) -> Expr:
+    # Note: Subtrees without any substitutions are shared with the original expression, not copied.
+    #       With fold set, every rebuilt node that ends up without vars or constants is evaluated into a number.
+    replacements = {k: Dispatcher.typecast(v) for k, v in substitutions.items()}
+    replacement_fxns = {k.fxn for k in replacements}
+    new : Dict[int, Expr] = {}
+    numeric : Dict[int, bool] = {}
+    stack : List[Tuple[Expr, bool]] = [(self, False)]
+    while stack:
+      op, expanded = stack.pop()
+      if id(op) in new: continue
+      if op.fxn in (BaseOps.Const, BaseOps.Var, BaseOps.Constant, BaseOps.AnyOp) or expanded:
+        # Note: Ops are only looked up after their args so hashes get computed (and cached) bottom up
+        if op.fxn in replacement_fxns and op in replacements:
+          new[id(op)] = replacements[op]
+          numeric[id(op)] = is_numeric(replacements[op])
+          continue
+      if op.fxn in (BaseOps.Const, BaseOps.Var, BaseOps.Constant, BaseOps.AnyOp):
+        new[id(op)] = op
+        numeric[id(op)] = op.fxn == BaseOps.Const
+      elif not expanded:
+        stack.append((op, True))
+        stack.extend((arg, False) for arg in op.args if id(arg) not in new)
+      else:
+        args = tuple(new[id(arg)] for arg in op.args)
+        numeric[id(op)] = all(numeric[id(arg)] for arg in op.args)
+        if all(a is b for a, b in zip(args, op.args)): new[id(op)] = op
+        else:
+          new[id(op)] = reconstruct_op(op, *args)
+          # Note: Ops that fail to evaluate or are not finite, such as 0^-1 or log(0), are kept unfolded
+          if fold and numeric[id(op)] and (value := finite_value(new[id(op)])) is not None: new[id(op)] = value
+    return new[id(self)]
+
   # Note: Might not be the best option?
   def evalf(self, **kwargs: Expr) -> Numeric:
     result = Numeric(self._eval(**kwargs))
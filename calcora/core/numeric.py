@@ -54,7 +54,7 @@ class Numeric:
     else: return False
   
   def __hash__(self) -> int:
-    return hash((str(self.real), str(self.imag)))
+    return hash(self.value)
 
   def __gt__(self, other: Union[Numeric, RealNumeric]) -> bool:
     if self.value.imag: raise ValueError("Complex numbers have no ordering!")
@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+from typing import Dict, List, Optional, Sequence, Union
+from typing import TYPE_CHECKING
+
+from calcora.core.stringops import *
+from calcora.globals import ec
+from calcora.types import CalcoraNumber, NumericType
+from calcora.utils import is_op_type, mpmathcast
+
+from calcora.core.numeric import Numeric
+from calcora.core.registry import is_expr
+
+from mpmath import mpc, exp, log, sin, cos, factorial, workdps
+
+if TYPE_CHECKING:
+  from calcora.core.expression import Expr
+  from calcora.core.ops import Add, Complex, Const, Constant, Cos, Log, Mul, Neg, Pow, Sin, Var
+
+type SeriesArgTypes = Union[TruncatedSeries, NumericType, Numeric]
+
+class TruncatedSeries:
+  # Note: Coefficients are stored as Taylor coefficients, c[k] = f^(k)(x0)/k!, everything above the order is dropped
+  def __init__(self, coefficients: Sequence[NumericType], order: int, precision: Optional[int] = None) -> None:
+    if order < 0: raise ValueError(f"Invalid order {order}, must be a non negative integer")
+    self.order = order
+    self.precision = precision if precision else ec.precision
+    with workdps(self.precision):
+      coeffs = [mpmathcast(c, precision=self.precision) for c in coefficients[:order+1]]
+      self.coeffs : List[CalcoraNumber] = coeffs + [mpc(0)] * (order + 1 - len(coeffs))
+
+  @staticmethod
+  def constant(value: NumericType, order: int, precision: Optional[int] = None) -> TruncatedSeries: return TruncatedSeries([value], order, precision=precision)
+  @staticmethod
+  def variable(x0: NumericType, order: int, precision: Optional[int] = None) -> TruncatedSeries: return TruncatedSeries([x0, 1], order, precision=precision)
+
+  def _new(self, coefficients: List[CalcoraNumber]) -> TruncatedSeries:
+    series = TruncatedSeries.__new__(TruncatedSeries)
+    series.order, series.precision, series.coeffs = self.order, self.precision, coefficients
+    return series
+
+  def _cast(self, other: SeriesArgTypes) -> TruncatedSeries:
+    if isinstance(other, TruncatedSeries):
+      if other.order != self.order: raise ValueError(f"Cannot combine series of order {self.order} and {other.order}")
+      return other
+    if isinstance(other, Numeric): other = other.value
+    return TruncatedSeries.constant(other, self.order, precision=self.precision)
+
+  @property
+  def coefficients(self) -> List[Numeric]: return [Numeric(c, precision=self.precision, skip_conversion=True) for c in self.coeffs]
+
+  def is_constant(self) -> bool: return not any(self.coeffs[1:])
+
+  def derivative(self, n: int) -> Numeric:
+    if not 0 <= n <= self.order: raise ValueError(f"Derivative of degree {n} is not available in a series of order {self.order}")
+    with workdps(self.precision): return Numeric(self.coeffs[n] * factorial(n), precision=self.precision, skip_conversion=True)
+
+  def derivatives(self) -> List[Numeric]: return [self.derivative(n) for n in range(self.order + 1)]
+
+  def __call__(self, x: NumericType) -> Numeric:
+    with workdps(self.precision):
+      # Note: This evaluates the polynomial in the offset x - x0, using horners method
+      h, res = mpmathcast(x, precision=self.precision), mpc(0)
+      for c in reversed(self.coeffs): res = res * h + c
+      return Numeric(res, precision=self.precision, skip_conversion=True)
+
+  def __repr__(self) -> str: return f'TruncatedSeries({", ".join(str(c) for c in self.coefficients)}; order={self.order})'
+
+  def __eq__(self, other: object) -> bool:
+    return isinstance(other, TruncatedSeries) and self.order == other.order and self.coeffs == other.coeffs
+
+  def __hash__(self) -> int: return hash((self.order, tuple(self.coeffs)))
+
+  def __pos__(self) -> TruncatedSeries: return self
+  def __neg__(self) -> TruncatedSeries:
+    with workdps(self.precision): return self._new([-c for c in self.coeffs])
+
+  def __add__(self, other: SeriesArgTypes) -> TruncatedSeries:
+    o = self._cast(other)
+    with workdps(self.precision): return self._new([a + b for a, b in zip(self.coeffs, o.coeffs)])
+  def __sub__(self, other: SeriesArgTypes) -> TruncatedSeries:
+    o = self._cast(other)
+    with workdps(self.precision): return self._new([a - b for a, b in zip(self.coeffs, o.coeffs)])
+
+  def __mul__(self, other: SeriesArgTypes) -> TruncatedSeries:
+    o = self._cast(other)
+    a, b = self.coeffs, o.coeffs
+    with workdps(self.precision):
+      if o.is_constant(): return self._new([c * b[0] for c in a])
+      if self.is_constant(): return self._new([a[0] * c for c in b])
+      return self._new([sum((a[j] * b[k-j] for j in range(k + 1)), mpc(0)) for k in range(self.order + 1)])
+
+  def __truediv__(self, other: SeriesArgTypes) -> TruncatedSeries:
+    o = self._cast(other)
+    a, b = self.coeffs, o.coeffs
+    if not b[0]: raise ZeroDivisionError("Cannot divide by a series with a zero constant term")
+    with workdps(self.precision):
+      if o.is_constant(): return self._new([c / b[0] for c in a])
+      res : List[CalcoraNumber] = []
+      for k in range(self.order + 1): res.append((a[k] - sum((b[j] * res[k-j] for j in range(1, k + 1)), mpc(0))) / b[0])
+      return self._new(res)
+
+  def __pow__(self, other: SeriesArgTypes) -> TruncatedSeries:
+    o = self._cast(other)
+    if not o.is_constant(): return (o * self.log()).exp()
+    a, alpha = self.coeffs, o.coeffs[0]
+    with workdps(self.precision):
+      if not a[0]:
+        # Note: The recurrence below divides by the constant term, positive integer powers of series without one are expanded by squaring
+        if alpha.imag or alpha.real < 0 or alpha.real != int(alpha.real): raise ValueError(f"Cannot raise a series with a zero constant term to the power {alpha}")
+        return self._int_pow(int(alpha.real))
+      res : List[CalcoraNumber] = [a[0] ** alpha]
+      for k in range(1, self.order + 1):
+        res.append(sum(((alpha * j - (k - j)) * a[j] * res[k-j] for j in range(1, k + 1)), mpc(0)) / (k * a[0]))
+      return self._new(res)
+
+  def __radd__(self, other: SeriesArgTypes) -> TruncatedSeries: return self._cast(other) + self
+  def __rsub__(self, other: SeriesArgTypes) -> TruncatedSeries: return self._cast(other) - self
+  def __rmul__(self, other: SeriesArgTypes) -> TruncatedSeries: return self._cast(other) * self
+  def __rtruediv__(self, other: SeriesArgTypes) -> TruncatedSeries: return self._cast(other) / self
+  def __rpow__(self, other: SeriesArgTypes) -> TruncatedSeries: return self._cast(other) ** self
+
+  def _int_pow(self, n: int) -> TruncatedSeries:
+    res, base = TruncatedSeries.constant(1, self.order, precision=self.precision), self
+    while n:
+      if n & 1: res = res * base
+      n >>= 1
+      if n: base = base * base
+    return res
+
+  def exp(self) -> TruncatedSeries:
+    a = self.coeffs
+    with workdps(self.precision):
+      res : List[CalcoraNumber] = [exp(a[0])]
+      for k in range(1, self.order + 1): res.append(sum((j * a[j] * res[k-j] for j in range(1, k + 1)), mpc(0)) / k)
+      return self._new(res)
+
+  def log(self) -> TruncatedSeries:
+    a = self.coeffs
+    if not a[0]: raise ValueError("Cannot take the logarithm of a series with a zero constant term")
+    with workdps(self.precision):
+      res : List[CalcoraNumber] = [log(a[0])]
+      for k in range(1, self.order + 1): res.append((a[k] - sum((j * res[j] * a[k-j] for j in range(1, k)), mpc(0)) / k) / a[0])
+      return self._new(res)
+
+  def sincos(self) -> tuple[TruncatedSeries, TruncatedSeries]:
+    a = self.coeffs
+    with workdps(self.precision):
+      s : List[CalcoraNumber] = [sin(a[0])]
+      c : List[CalcoraNumber] = [cos(a[0])]
+      for k in range(1, self.order + 1):
+        s.append(sum((j * a[j] * c[k-j] for j in range(1, k + 1)), mpc(0)) / k)
+        c.append(-sum((j * a[j] * s[k-j] for j in range(1, k + 1)), mpc(0)) / k)
+      return self._new(s), self._new(c)
+
+  def sin(self) -> TruncatedSeries: return self.sincos()[0]
+  def cos(self) -> TruncatedSeries: return self.sincos()[1]
+
+def _propagate(expression: Expr, var: Var, x0: CalcoraNumber, order: int, values: Dict[str, Expr], cache: Dict[int, TruncatedSeries]) -> TruncatedSeries:
+  if id(expression) in cache: return cache[id(expression)]
+  def inner(x: Expr) -> TruncatedSeries: return _propagate(x, var, x0, order, values, cache)
+  if is_op_type(expression, Var):
+    if expression.name == var.name: res = TruncatedSeries.variable(x0, order)
+    elif expression.name in values: res = TruncatedSeries.constant(values[expression.name]._eval(), order)
+    else: raise ValueError(f"Specified value for type var is required for evaluation, no value for var with name '{expression.name}'")
+  elif is_op_type(expression, Const) or is_op_type(expression, Constant): res = TruncatedSeries.constant(expression._eval(), order)
+  elif is_op_type(expression, Complex): res = inner(expression.real) + inner(expression.imag) * mpc(0, 1)
+  elif is_op_type(expression, Add): res = inner(expression.x) + inner(expression.y)
+  elif is_op_type(expression, Neg): res = -inner(expression.x)
+  elif is_op_type(expression, Mul): res = inner(expression.x) * inner(expression.y)
+  elif is_op_type(expression, Pow): res = inner(expression.x) ** inner(expression.y)
+  elif is_op_type(expression, Log):
+    base = inner(expression.base)
+    res = inner(expression.x).log() / (base.log() if not base.is_constant() else log(base.coeffs[0]))
+  elif is_op_type(expression, Sin): res = inner(expression.x).sin()
+  elif is_op_type(expression, Cos): res = inner(expression.x).cos()
+  else: raise TypeError(f'Invalid op {type(expression)} cannot be expanded into a series!')
+  cache[id(expression)] = res
+  return res
+
+def series(expression: Expr, var: Var, x0: Union[NumericType, Numeric, Expr], order: int, **kwargs: Expr) -> TruncatedSeries:
+  if order < 0: raise ValueError(f"Invalid order {order}, must be a non negative integer")
+  with workdps(ec.precision):
+    point = x0._eval() if is_expr(x0) else x0.value if isinstance(x0, Numeric) else mpmathcast(x0)
+    return _propagate(expression, var, point, order, kwargs, {})
@@ -16,15 +16,17 @@ if TYPE_CHECKING:
 class PatternMatcher:
   def __init__(self, patterns: Optional[List[Pattern]] = None) -> None:
     self.patterns = patterns if patterns else list()
+    self.token = object() # Note: Identifies the current rule set, ops simplified under older rules are not skipped
   
   def add_rules(self, patterns: List[Pattern]) -> None:
     self.patterns.extend(patterns)
+    self.token = object()
   
-  def match(self, expression: Expr, depth: int = 0, print_debug: bool = True) -> Expr:
+  def match(self, expression: Expr, depth: int = 0, print_debug: bool = True, skip: Optional[object] = None) -> Expr:
     simplified_expr: Expr = expression
     for pattern in self.patterns:
-      simplified_expr = pattern.match(simplified_expr)
-    if matched := (simplified_expr != expression): simplified_expr = self.match(simplified_expr, depth=depth+1, print_debug=print_debug)
+      simplified_expr = pattern.match(simplified_expr, skip=skip)
+    if matched := (simplified_expr != expression): simplified_expr = self.match(simplified_expr, depth=depth+1, print_debug=print_debug, skip=skip)
     if depth == 0 and matched and print_debug: dprint(f'$ -> $', 2, 'blue', expression, simplified_expr)
     return simplified_expr
   
@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from typing import Callable, Dict, Tuple
+from typing import Callable, Dict, Optional, Tuple
 from typing import TYPE_CHECKING
 
 from calcora.globals import BaseOps
@@ -25,22 +25,28 @@ Sub : Callable[[Expr, Expr], Expr] = lambda x,y: Add(x, Neg(y))
 Div : Callable[[Expr, Expr], Expr] = lambda x,y: Mul(x, Pow(y, NegOne))
 Ln : Callable[[Expr], Expr] = lambda x: Log(x, E)
 
-def partial_eval(x: Expr) -> Expr:
+def partial_eval(x: Expr, skip: Optional[object] = None) -> Expr:
+  if skip is not None and x._normal_form is skip: return x
   if not (x.fxn == BaseOps.Const or x.fxn == BaseOps.Var or x.fxn == BaseOps.Constant):
     is_sub = SubOpPattern(x) # keys: x, y
     is_div = DivOpPattern(x) # keys: x, y
     is_ln = LnOpPattern(x)   # keys: x
     if is_sub[0]: 
-      new_args = [partial_eval(arg) for arg in (is_sub[1]['x'], is_sub[1]['y'])]
-      x = Sub(new_args[0], new_args[1])
+      old_args : Tuple[Expr, ...] = (is_sub[1]['x'], is_sub[1]['y'])
+      new_args = [partial_eval(arg, skip) for arg in old_args]
+      if not all(a is b for a, b in zip(new_args, old_args)): x = Sub(new_args[0], new_args[1])
     elif is_div[0]: 
-      new_args = [partial_eval(arg) for arg in (is_div[1]['x'], is_div[1]['y'])]
-      x = Div(new_args[0], new_args[1])
+      old_args = (is_div[1]['x'], is_div[1]['y'])
+      new_args = [partial_eval(arg, skip) for arg in old_args]
+      if not all(a is b for a, b in zip(new_args, old_args)): x = Div(new_args[0], new_args[1])
     elif is_ln[0]: 
-      new_args = [partial_eval(arg) for arg in (is_ln[1]['x'],)]
-      x = Ln(new_args[0])
+      old_args = (is_ln[1]['x'],)
+      new_args = [partial_eval(arg, skip) for arg in old_args]
+      if new_args[0] is not old_args[0]: x = Ln(new_args[0])
     else: 
-      new_args = [partial_eval(arg) for arg in x.args]
-      x = reconstruct_op(x, *new_args)
-  if is_const_like(x) and not has_constant(x): return Dispatcher.typecast(x._eval())
+      new_args = [partial_eval(arg, skip) for arg in x.args]
+      if not all(a is b for a, b in zip(new_args, x.args)): x = reconstruct_op(x, *new_args)
+  if is_const_like(x) and not has_constant(x): 
+    folded = Dispatcher.typecast(x._eval())
+    return x if folded == x else folded
   return x
\ No newline at end of file
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from itertools import permutations
-from typing import Callable, Dict, Tuple
+from typing import Callable, Dict, Optional, Tuple
 from typing import TYPE_CHECKING
 
 from calcora.globals import BaseOps, GlobalCounter
@@ -19,18 +19,25 @@ class Pattern:
     self.replacement = replacement
     self._binding: Dict[str, Expr] = {}
 
-  def match(self, op: Expr) -> Expr:
+  def match(self, op: Expr, skip: Optional[object] = None) -> Expr:
+    # Note: Ops marked with the skip token are already simplified and are returned as is, unchanged ops are never rebuilt
+    return self._match_tree(op, skip, {})
+
+  def _match_tree(self, op: Expr, skip: Optional[object], memo: Dict[int, Expr]) -> Expr:
+    if op.fxn == BaseOps.Const or op.fxn == BaseOps.Constant or op.fxn == BaseOps.Var: return op
+    if skip is not None and op._normal_form is skip: return op
+    if id(op) in memo: return memo[id(op)]
+    new_args = [self._match_tree(arg, skip, memo) for arg in op.args]
+    new_op = op if all(a is b for a, b in zip(new_args, op.args)) else reconstruct_op(op, *new_args)
     self._binding = {}
-    new_args = [self.match(arg) for arg in op.args] if op.fxn != BaseOps.Const and op.fxn != BaseOps.Var and op.fxn != BaseOps.Constant else op.args
-    if op.fxn == BaseOps.Const or op.fxn == BaseOps.Constant: return op
-    op = reconstruct_op(op, *new_args)
-    if op.fxn == self.pattern.fxn and len(op.args) == len(self.pattern.args):
-      if self._match(op, self.pattern):
+    if new_op.fxn == self.pattern.fxn and len(new_op.args) == len(self.pattern.args):
+      if self._match(new_op, self.pattern):
         GlobalCounter.matches += 1
-        new_op = self.replacement(**self._binding)
-        if not dc.in_debug: dprint(f'$ -> $', 3, 'magenta', op, new_op)
-        return new_op
-    return reconstruct_op(op, *new_args)
+        replaced = self.replacement(**self._binding)
+        if not dc.in_debug: dprint(f'$ -> $', 3, 'magenta', new_op, replaced)
+        new_op = replaced
+    memo[id(op)] = new_op
+    return new_op
   
   def _match(self, op: Expr, subpattern: Expr) -> bool:
     if not (len(op.args) == len(subpattern.args)) and not subpattern.fxn == BaseOps.AnyOp: return False
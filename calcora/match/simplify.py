@@ -2,16 +2,38 @@ from __future__ import annotations
 
 from typing import TYPE_CHECKING
 
+from calcora.globals import BaseOps
+
 from calcora.match.match import SymbolicPatternMatcher
-from calcora.match.partial_eval import partial_eval
+from calcora.match.partial_eval import DivOpPattern, LnOpPattern, partial_eval, SubOpPattern
 
 if TYPE_CHECKING:
   from calcora.core.expression import Expr
 
+def is_simplified(expression: Expr) -> bool: return expression._normal_form is SymbolicPatternMatcher.token
+
+def mark_simplified(expression: Expr) -> None:
+  # Note: Marks the ops of a simplified expression that partial_eval folded on their own, already marked subtrees are not walked again.
+  # The Neg of a subtraction and the Pow of a division are only matched as part of their parent and never folded by themselves
+  # (x * 2^-1 keeps 2^-1) so they are walked through but left unmarked, they get simplified if a later edit takes them out of that context
+  token, stack = SymbolicPatternMatcher.token, [expression]
+  while stack:
+    op = stack.pop()
+    if op._normal_form is token: continue
+    op._normal_form = token
+    if op.fxn == BaseOps.Const or op.fxn == BaseOps.Var or op.fxn == BaseOps.Constant: continue
+    if (is_sub := SubOpPattern(op))[0]: stack.extend((is_sub[1]['x'], is_sub[1]['y']))
+    elif (is_div := DivOpPattern(op))[0]: stack.extend((is_div[1]['x'], is_div[1]['y']))
+    elif (is_ln := LnOpPattern(op))[0]: stack.append(is_ln[1]['x'])
+    else: stack.extend(op.args)
+
 def simplify(expression: Expr) -> Expr:
+  if is_simplified(expression): return expression
+  token = SymbolicPatternMatcher.token
   simplified_expr: Expr = expression
-  simplified_expr = SymbolicPatternMatcher.match(expression)
-  simplified_expr = partial_eval(simplified_expr)
-  if simplified_expr != expression: simplified_expr = simplify(simplified_expr)
+  simplified_expr = SymbolicPatternMatcher.match(expression, skip=token)
+  simplified_expr = partial_eval(simplified_expr, skip=token)
+  if simplified_expr != expression: return simplify(simplified_expr)
+  mark_simplified(simplified_expr)
   return simplified_expr
 
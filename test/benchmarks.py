@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+from typing import Any, Callable
+
+import shutil
+import timeit
+
+from calcora.codegen.bytecode import bytecode_compile
+from calcora.codegen.ccompiler import c_compiler, ClangProgram
+from calcora.codegen.lambdify import lambdify
+from calcora.core.domain import Domain
+from calcora.core.ops import Add, Cos, Log, Mul, Pow, Sin, Var
+from calcora.core.constants import E, Two
+from calcora.core.registry import Dispatcher
+
+# Note: Not collected by the test runner, run with `PYTHONPATH=. python test/benchmarks.py`
+
+def per_call(fxn: Callable[..., Any], *args: Any, number: int = 200_000) -> float:
+  return min(timeit.repeat(lambda: fxn(*args), number=number, repeat=5)) / number * 1e9
+
+def scalar_call_overhead() -> None:
+  x, y = Var('x'), Var('y')
+  expression = Add(Mul(Sin(x), Two), Pow(y, Two))
+  print(f"{'lambdify python':<24}{per_call(lambdify(expression, 'python'), 0.5, 1.5):8.1f} ns/call")
+  if not shutil.which(c_compiler()): return print("No C compiler available, skipping ClangProgram")
+  for label, assumptions in (('ClangProgram real', {'x': Domain.Real, 'y': Domain.Real}), ('ClangProgram complex', None)):
+    program = ClangProgram(expression, assumptions=assumptions)
+    program.compile()
+    print(f"{label:<24}{per_call(program, 0.5, 1.5):8.1f} ns/call")
+    assert program.scalar is not None
+    print(f"{label + ' stub':<24}{per_call(program.scalar, 0.5, 1.5):8.1f} ns/call")
+
+def compile_time(fxn: Callable[[], Any], number: int = 200) -> float:
+  return min(timeit.repeat(fxn, number=number, repeat=3)) / number * 1e6
+
+def bytecode_evaluation() -> None:
+  x, y = Var('x'), Var('y')
+  expression = Add(Mul(Sin(Mul(x, y)), Cos(y)), Add(Log(Pow(x, Two), E), Mul(Sin(Mul(x, y)), x)))
+  args = {'x': Dispatcher.typecast(0.5), 'y': Dispatcher.typecast(1.5)}
+  print(f"{'tree walk':<24}{per_call(lambda: expression._eval(**args), number=2000):10.1f} ns/call")
+  print(f"{'lambdify python':<24}{per_call(lambdify(expression, 'python'), 0.5, 1.5):10.1f} ns/call{compile_time(lambda: lambdify(expression, 'python')):10.1f} us/compile")
+  for mode in ('float', 'complex', 'mpmath'):
+    number = 2000 if mode == 'mpmath' else 200_000
+    print(f"{'bytecode ' + mode:<24}{per_call(bytecode_compile(expression, mode), 0.5, 1.5, number=number):10.1f} ns/call{compile_time(lambda: bytecode_compile(expression, mode)):10.1f} us/compile") # type: ignore[arg-type]
+  print(f"{'lambdify mpmath':<24}{per_call(lambdify(expression, 'mpmath'), 0.5, 1.5, number=2000):10.1f} ns/call")
+
+if __name__ == '__main__':
+  scalar_call_overhead()
+  bytecode_evaluation()
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import cmath
+import math
+import unittest
+
+from calcora.core.arena import ExprArena
+from calcora.core.ops import Add, Complex, ComplexForm, Const, Cos, Log, Mul, Neg, Pow, Sin, Var
+from calcora.core.constants import E, PI, One, Two, Three
+from calcora.core.numeric import Numeric
+
+import mpmath
+from mpmath import almosteq, mpf, workdps
+
+x = Var('x')
+y = Var('y')
+
+class TestExprArena(unittest.TestCase):
+  def setUp(self) -> None:
+    self.expressions = [Add(Mul(Sin(x), Cos(x)), Pow(Sin(x), Two)), Log(Add(x, Three), E), Mul(Neg(y), Complex(One, Two)), Mul(PI, Const(Numeric('0.1')))]
+
+  def test_round_trip(self) -> None:
+    arena = ExprArena.from_expr(*self.expressions)
+    self.assertEqual(arena.to_exprs(), self.expressions)
+    self.assertEqual(arena.to_expr(2), self.expressions[2])
+
+  def test_sharing(self) -> None:
+    arena = ExprArena.from_expr(Add(Sin(x), Sin(x)))
+    self.assertEqual(len(arena), 3)
+    self.assertEqual(list(arena.postorder()), [0, 1, 2])
+    self.assertIsNone(arena._index) # Note: Only kept while adding, the next add rebuilds it and still shares sin(x)
+    root = arena.add(Mul(Sin(x), y))
+    self.assertEqual(len(arena), 5)
+    self.assertEqual(arena.children(root), (1, 3))
+
+  def test_complex_form(self) -> None:
+    number = Complex(One, One, representation=ComplexForm.Polar)
+    res = ExprArena.from_expr(number).to_expr()
+    self.assertIsInstance(res, Complex)
+    self.assertEqual(res.representation, ComplexForm.Polar) # type: ignore[attr-defined]
+
+  def test_hash(self) -> None:
+    arena = ExprArena.from_expr(*self.expressions)
+    for i, expression in enumerate(self.expressions): self.assertEqual(arena.hash(i), hash(expression))
+    self.assertEqual(ExprArena.from_expr(Add(x, y)).hash(), ExprArena.from_expr(Add(y, x)).hash())
+
+  def test_evaluate(self) -> None:
+    arena = ExprArena.from_expr(*self.expressions)
+    values = arena.evaluate({'x': 0.5, 'y': 2.0})
+    self.assertAlmostEqual(values[0], math.sin(0.5) * math.cos(0.5) + math.sin(0.5)**2)
+    self.assertAlmostEqual(values[1], math.log(3.5))
+    self.assertAlmostEqual(values[2], -2 * (1 + 2j))
+    self.assertAlmostEqual(values[3], math.pi / 10)
+    self.assertAlmostEqual(ExprArena.from_expr(self.expressions[0]).evaluate({'x': 0.5}, 'float')[0], values[0].real)
+    self.assertAlmostEqual(ExprArena.from_expr(Log(x, E)).evaluate({'x': -1.0})[0], cmath.log(-1))
+    self.assertRaises(ValueError, ExprArena.from_expr(Sin(x)).evaluate, {})
+
+  def test_evaluate_mpmath(self) -> None:
+    with workdps(40):
+      expression = Add(Mul(Sin(x), E), Log(x, Two))
+      reference = mpmath.sin(mpf('0.3')) * mpmath.e + mpmath.log(mpf('0.3'), 2)
+      res = ExprArena.from_expr(expression).evaluate({'x': mpf('0.3')}, 'mpmath')[0]
+      self.assertTrue(almosteq(res, reference, rel_eps=mpf(10)**-38))
+
+  def test_serialization(self) -> None:
+    arena = ExprArena.from_expr(*self.expressions)
+    data = arena.to_bytes()
+    res = ExprArena.from_bytes(data)
+    self.assertEqual(res.to_exprs(), self.expressions)
+    self.assertEqual([c.value for c in res.constants], [c.value for c in arena.constants])
+    self.assertEqual(res.hash(3), hash(self.expressions[3]))
+    n = len(res)
+    res.add(Mul(Sin(x), Cos(x)))
+    self.assertEqual(len(res), n)
+    self.assertRaises(ValueError, ExprArena.from_bytes, b'not an arena' + bytes(16))
+
+  def test_large(self) -> None:
+    # Note: Deeper than the recursion limit, everything on the arena is iterative
+    expression = x
+    for i in range(20000): expression = Add(Mul(expression, Const(Numeric((i % 2 + 1) / 2))), Sin(x))
+    arena = ExprArena.from_expr(expression)
+    self.assertEqual(len(arena), 2 * 20000 + 4)
+    self.assertLess(arena.nbytes, 14 * len(arena))
+    value = 0.25
+    for i in range(20000): value = value * (i % 2 + 1) / 2 + math.sin(0.25)
+    self.assertAlmostEqual(arena.evaluate({'x': 0.25}, 'float')[0] / value, 1.0)
+    self.assertEqual(len(arena.to_exprs()), 1)
@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import unittest
+
+from calcora.core.callbacks import Callback, CallbackPipeline, Callbacks
+from calcora.core.ops import Add, Const, Log, Mul, Neg, Pow, Sin, Var
+from calcora.core.constants import PI, Zero, One, Two, Three
+from calcora.core.numeric import Numeric
+from calcora.core.registry import Dispatcher as d
+from calcora.globals import BaseOps
+
+x = Var('x')
+
+class TestCallbackPipeline(unittest.TestCase):
+  def test_order_and_filter(self) -> None:
+    calls = []
+    pipeline = CallbackPipeline([
+      Callback('first', lambda e: calls.append('first') or e),
+      Callback('only_add', lambda e: calls.append('only_add') or e, ops=(BaseOps.Add,)),
+      Callback('last', lambda e: calls.append('last') or e),
+    ])
+    pipeline(Mul(x, x))
+    self.assertEqual(calls, ['first', 'last'])
+    calls.clear()
+    pipeline(Add(x, x))
+    self.assertEqual(calls, ['first', 'only_add', 'last'])
+
+  def test_enable_disable(self) -> None:
+    pipeline = CallbackPipeline([Callback('neg', lambda e: Neg(e))])
+    self.assertEqual(pipeline(x), Neg(x))
+    pipeline.disable('neg')
+    self.assertIs(pipeline(x), x)
+    with self.assertRaises(KeyError): pipeline.enable('missing')
+    with self.assertRaises(ValueError): pipeline.register(Callback('neg', lambda e: e))
+
+  def test_stats(self) -> None:
+    pipeline = CallbackPipeline([Callback('neg', lambda e: Neg(e) if e.fxn == BaseOps.Var else e)])
+    pipeline(x)
+    pipeline(Sin(x))
+    stats = pipeline.stats()['neg']
+    self.assertEqual((stats['calls'], stats['rewrites']), (2, 1))
+    pipeline.reset_stats()
+    self.assertEqual(pipeline.stats()['neg']['calls'], 0)
+
+class TestCanonicalizers(unittest.TestCase):
+  def setUp(self) -> None: Callbacks.enable()
+  def tearDown(self) -> None: 
+    Callbacks.disable()
+    Callbacks.reset_stats()
+
+  def test_disabled_by_default(self) -> None:
+    Callbacks.disable()
+    self.assertEqual(x + 0, Add(x, Zero))
+
+  def test_constant_folding(self) -> None:
+    self.assertEqual(d.add(2, 3), Const(Numeric(5)))
+    self.assertEqual(d.sub(2, 3), Neg(One))
+    self.assertEqual(x * (d.const(2) + 1), Mul(x, Three))
+    self.assertEqual(PI * 2, Mul(PI, Two))
+    self.assertGreater(Callbacks.stats()['fold_constants']['rewrites'], 0)
+
+  def test_invalid_constants_are_not_folded(self) -> None:
+    self.assertEqual(d.div(1, 0), Pow(Zero, Neg(One)))
+    self.assertEqual(d.pow(0, -1), Pow(Zero, Neg(One)))
+    self.assertEqual(x / (d.const(2) - 2), Mul(x, Pow(Zero, Neg(One))))
+    self.assertEqual(d.log(0, 2), Log(Zero, Two))
+
+  def test_identities(self) -> None:
+    self.assertIs(x + 0, x)
+    self.assertIs(1 * x, x)
+    self.assertEqual(Sin(x) * 0, Zero)
+    self.assertIs(x ** 1, x)
+
+  def test_signs(self) -> None:
+    self.assertIs(-(-x), x)
+    self.assertEqual(x * -1, Neg(x))
+    self.assertEqual((-x) * (-Sin(x)), Mul(x, Sin(x)))
+
+  def test_derivative(self) -> None:
+    self.assertEqual((2*x + 3).differentiate(x), Two)
+    self.assertEqual((x**3).differentiate(x), Mul(Three, Mul(Pow(x, Three), Pow(x, Neg(One)))))
+
+if __name__ == '__main__':
+  unittest.main()
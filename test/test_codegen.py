@@ -1,17 +1,36 @@
 from __future__ import annotations
 
-from typing import Type
+from typing import Any, Callable, List, Tuple, Type
 from typing import TYPE_CHECKING
 
+import cmath
 import math
+import mpmath
+import os
+import pathlib
 import random
+import shutil
+import tempfile
 import string
 import unittest
-
-from calcora.codegen.lambdify import lambdify, find_expression_vars, string_lambda
-
-from calcora.core.ops import Add, Complex, Const, Cos, Log, Mul, Neg, Pow, Sin, Var
-from calcora.core.constants import E, PI, One, Two
+import unittest.mock
+
+from calcora.codegen.ccode import generate_expression_string, C_DOUBLE_FUNCTIONS_MAP
+from calcora.codegen.autotune import autotune, cpu_model, Tuning, TuningStore
+from calcora.codegen.bytecode import BytecodeProgram, bytecode_compile
+from calcora.codegen.cache import LambdifyCache, SharedObjectCache
+from calcora.codegen.ccompiler import AsyncClangProgram, c_compiler, ClangModule, ClangProgram, CompilationError, LongDoubleComplex
+from calcora.codegen.export import build_extension, extension_source, load_extension
+from calcora.codegen.gradient import ClangGradientProgram, lambdify_gradient
+from calcora.codegen.multidouble import combine, MultiDoubleProgram, precision_terms, split
+from calcora.codegen.lambdify import arena_key, lambdify, find_expression_vars, string_lambda
+from calcora.codegen.optimize import optimize_expression
+from calcora.codegen.specialize import fold_parameters, specialize
+from calcora.core.differentiate import diff
+from calcora.core.domain import Domain, infer_domains
+
+from calcora.core.ops import Add, AnyOp, Complex, Const, Cos, Log, Mul, Neg, Pow, Sin, Var
+from calcora.core.constants import E, PI, One, Two, Three, Zero
 from calcora.core.registry import Dispatcher as d
 from calcora.core.numeric import Numeric
 from calcora.globals import ec
@@ -181,5 +200,667 @@ class TestLambdify(unittest.TestCase):
       self.assertAlmostEqual(np.float64(float(expr.evalf(**{k:d.typecast(v) for k,v in args.items()}))), 
                        lambda_expr(**args), delta=1e-7)
 
+class TestBytecode(unittest.TestCase):
+  def test_modes(self) -> None:
+    x, y = Var('x'), Var('y')
+    expression = Add(Mul(Sin(x), Cos(y)), Log(Pow(x, Two), E))
+    self.assertAlmostEqual(bytecode_compile(expression, 'float')(0.5, 2.0), math.sin(0.5) * math.cos(2) + math.log(0.25))
+    self.assertAlmostEqual(bytecode_compile(expression, 'complex')(-0.5, 2.0), cmath.sin(-0.5) * cmath.cos(2) + cmath.log(0.25))
+    with mpmath.workdps(40):
+      res = bytecode_compile(expression, 'mpmath')(mpmath.mpf('0.5'), 2)
+      self.assertTrue(mpmath.almosteq(res, mpmath.sin(mpmath.mpf('0.5')) * mpmath.cos(2) + mpmath.log(mpmath.mpf('0.25')), rel_eps=mpmath.mpf(10)**-38))
+      constant = bytecode_compile(PI, 'mpmath')()
+      self.assertIsInstance(constant, mpmath.mpf)
+      self.assertEqual(constant, +mpmath.pi)
+      self.assertIsInstance(bytecode_compile([E, x], 'mpmath')(1)[0], mpmath.mpf)
+    self.assertAlmostEqual(bytecode_compile(Mul(x, Complex(One, Two)))(2), 2 + 4j)
+    self.assertAlmostEqual(bytecode_compile(Log(x, Two), 'float')(8), 3)
+    self.assertRaises(ValueError, bytecode_compile, x, 'numpy')
+
+  def test_program(self) -> None:
+    x, y = Var('x'), Var('y')
+    shared = Sin(Mul(x, y))
+    program = BytecodeProgram([Add(shared, Pow(x, Neg(One))), Mul(shared, Mul(Two, Three))], 'float')
+    self.assertEqual(sum(op == 5 for op, *_ in program.code), 1) # Note: SIN is computed once
+    self.assertIn('6.0', program.disassemble()) # Note: Constant subexpressions are folded
+    self.assertEqual(program(2.0, 0.25), (math.sin(0.5) + 0.5, 6 * math.sin(0.5)))
+    self.assertEqual(program(y=0.25, x=2.0), program(2.0, 0.25))
+    self.assertRaises(TypeError, program, 1.0)
+    self.assertRaises(TypeError, program, x=1.0)
+    self.assertEqual(bytecode_compile(Add(x, Two), vars=['y', 'x'])(5, 1), 3)
+    self.assertRaises(ValueError, bytecode_compile, Add(x, y), vars=['x'])
+
+  def test_untrusted_names(self) -> None:
+    # Note: Variable names are only dictionary keys so names that are not identifiers are fine
+    program = bytecode_compile(Add(Var('__import__("os")'), Var('a b')), 'float')
+    self.assertEqual(program(1, 2), 3)
+
+  def test_random(self) -> None:
+    for _ in range(300):
+      num_vars = random.randint(1, 3)
+      expr = generate_random_expression(random.randint(1, 5), num_vars)
+      args = {name: random.uniform(0, 100) for name in find_expression_vars(expr)}
+      self.assertAlmostEqual(float(expr.evalf(**{k: d.typecast(v) for k, v in args.items()})), bytecode_compile(expr, 'float')(**args), delta=1e-3)
+
+class TestLambdifySource(unittest.TestCase):
+  def test_shared_subexpressions(self) -> None:
+    x, y = Var('x'), Var('y')
+    expression = Add(Mul(Pow(x, y), Two), Log(Pow(x, y), E))
+    fxn = lambdify(expression, 'python')
+    self.assertEqual(fxn.source.count('**'), 1) # type: ignore[attr-defined]
+    self.assertEqual(fxn(2, 3), eval(string_lambda(expression, 'python'), {'math': math})(2, 3))
+
+  def test_multiple_outputs(self) -> None:
+    import numpy as np
+    x, y = Var('x'), Var('y')
+    shared = Pow(Add(x, y), Two)
+    expressions = [Mul(shared, Sin(x)), Add(shared, Cos(y)), Log(shared, E), Two]
+    fxn = lambdify(expressions, 'python')
+    self.assertEqual(fxn.source.count('**'), 1) # type: ignore[attr-defined]
+    res = fxn(0.5, 1.5)
+    self.assertIsInstance(res, tuple)
+    for value, expression in zip(res, expressions): self.assertAlmostEqual(value, lambdify(expression, 'python', vars=['x', 'y'], automatic_vars=False)(0.5, 1.5))
+    self.assertAlmostEqual(lambdify(expressions, 'mpmath')(0.5, 1.5)[2], math.log(4))
+    xs, ys = np.linspace(0, 1, 5), np.linspace(1, 2, 5)
+    outputs = lambdify(expressions, 'numpy')(xs, ys)
+    np.testing.assert_allclose(outputs[1], (xs + ys)**2 + np.cos(ys))
+    stacked = lambdify(expressions, 'numpy', stack=True)(xs, ys)
+    self.assertEqual(stacked.shape, (4, 5))
+    np.testing.assert_allclose(stacked[3], [2] * 5)
+    np.testing.assert_allclose(stacked[0], outputs[0])
+    self.assertEqual(lambdify([Sin(x)], 'python')(0.0), (0.0,))
+    self.assertRaises(ValueError, lambdify, [], 'python')
+    self.assertEqual(lambdify([Add(x, y), Mul(x, y)], 'python', assumptions={'x': Domain.Real, 'y': Domain.Real})(2.0, 3.0), (5.0, 6.0))
+    self.assertRaises(ValueError, lambdify, expressions, 'python', stack=True)
+    self.assertRaises(ValueError, lambdify, Sin(x), 'numpy', stack=True)
+
+  def test_hoisted_constants(self) -> None:
+    fxn = lambdify(Add(Mul(Var('x'), Two), Neg(One)), 'mpmath')
+    self.assertNotIn('mpf', fxn.source) # type: ignore[attr-defined]
+    self.assertEqual(fxn(3), 5)
+
+  def test_type_conversion(self) -> None:
+    self.assertEqual(lambdify(Add(Var('x'), Complex(One, Two)), 'python', type_conversion=True)('1+2i'), 2+4j)
+
+  def test_deep_expression(self) -> None:
+    expression : Expr = Var('x')
+    for _ in range(1000): expression = Add(Sin(expression), One)
+    value = 0.5
+    for _ in range(1000): value = math.sin(value) + 1
+    self.assertEqual(lambdify(expression, 'python')(0.5), value)
+
+  def test_invalid_vars(self) -> None:
+    self.assertRaises(ValueError, lambdify, Var('math'), 'python')
+    self.assertRaises(ValueError, lambdify, Var('x'), 'python', automatic_vars=False, vars=['not valid'])
+
+class TestSpecialize(unittest.TestCase):
+  def setUp(self) -> None:
+    self.a, self.b, self.x = Var('a'), Var('b'), Var('x')
+    self.expression = Add(Mul(Sin(Mul(PI, self.a)), self.x), Pow(Add(self.a, self.b), Two))
+    self.value = lambda x: math.sin(math.pi / 4) * x + 1.25**2
+
+  def test_fold(self) -> None:
+    folded = fold_parameters([self.expression], {'a': 0.25, 'b': 1})[0]
+    self.assertEqual(find_expression_vars(folded), {'x'})
+    self.assertEqual(folded.fxn, Add(self.x, self.x).fxn)
+    self.assertIsInstance(folded.args[0].args[0], Const)
+    self.assertRaises(ValueError, fold_parameters, [self.expression], {'y': 1})
+
+  def test_fold_not_finite(self) -> None:
+    # Note: log(0) and 1/0 are left as ops instead of being folded into numbers the generated code cannot spell
+    y = Var('y')
+    expression = Add(self.x, Log(y, E))
+    folded = fold_parameters([expression], {'y': 0})[0]
+    self.assertEqual(folded.args[1].fxn, Log(y, E).fxn)
+    self.assertRaises(ValueError, specialize(lambdify(expression, 'python'), {'y': 0}), 1.0) # Note: The same math domain error as calling it with y=0
+    self.assertEqual(specialize(expression, {'y': 0}, 'mpmath')(1.0), -mpmath.inf)
+    folded = fold_parameters([Mul(self.x, Pow(y, Neg(One)))], {'y': 0})[0]
+    self.assertEqual(folded.args[1].fxn, Pow(y, Two).fxn)
+
+  def test_expression(self) -> None:
+    fxn = specialize(self.expression, {'a': 0.25, 'b': 1})
+    self.assertNotIn('sin', fxn.source) # type: ignore[attr-defined]
+    self.assertNotIn('**', fxn.source) # type: ignore[attr-defined]
+    self.assertAlmostEqual(fxn(2.0), self.value(2.0))
+    self.assertAlmostEqual(specialize(self.expression, {'a': 0.25, 'b': 1}, 'mpmath')(x=2.0), self.value(2.0))
+    res = specialize([self.expression, Mul(self.a, self.x)], {'a': 0.25, 'b': 1})(2.0)
+    self.assertAlmostEqual(res[0], self.value(2.0))
+    self.assertAlmostEqual(res[1], 0.5)
+    self.assertAlmostEqual(specialize(self.expression, {'a': Mul(Two, Var('y'))})(1.0, 2.0, 0.125), self.value(2.0))
+    self.assertRaises(TypeError, specialize, object(), {'a': 1})
+
+  def test_lambdified(self) -> None:
+    fxn = lambdify(self.expression, 'mpmath', assumptions={'a': Domain.Real, 'x': Domain.Real})
+    res = specialize(fxn, {'a': 0.25, 'b': 1})
+    self.assertEqual(res.fxn_vars, ['x']) # type: ignore[attr-defined]
+    self.assertEqual(res.options['assumptions'], {'x': Domain.Real}) # type: ignore[attr-defined]
+    self.assertIsInstance(res(2.0), mpmath.mpf)
+    self.assertAlmostEqual(float(res(2.0)), float(fxn(0.25, 1, 2.0)))
+    self.assertAlmostEqual(specialize(lambdify([self.expression], 'python'), {'b': 1})(0.25, 2.0)[0], self.value(2.0))
+
+  def test_bytecode(self) -> None:
+    program = BytecodeProgram(self.expression, 'float')
+    res = specialize(program, {'a': 0.25, 'b': 1})
+    self.assertEqual((res.mode, res.fxn_vars), ('float', ['x']))
+    self.assertLess(len(res.code), len(program.code))
+    self.assertAlmostEqual(res(2.0), self.value(2.0))
+
+  def test_numpy(self) -> None:
+    import numpy as np
+    from calcora.codegen.numpy_eval import NumpyProgram
+    xs = np.linspace(0, 1, 7)
+    res = specialize(NumpyProgram(self.expression, dtype='float64'), {'a': 0.25, 'b': 1})
+    self.assertEqual(res.fxn_vars, ['x'])
+    np.testing.assert_allclose(res(xs), self.value(xs))
+
+  @unittest.skipUnless(shutil.which(c_compiler()), "No C compiler available")
+  def test_clang(self) -> None:
+    program = ClangProgram(self.expression, assumptions={'a': Domain.Real, 'b': Domain.Real, 'x': Domain.Real}, cache=False)
+    res = specialize(program, {'a': 0.25, 'b': 1})
+    self.assertTrue(res.real)
+    self.assertEqual(res.fxn_vars, ['x'])
+    self.assertAlmostEqual(res(2.0), self.value(2.0))
+
+class TestDomainCodegen(unittest.TestCase):
+  def test_lambdify_python_assumptions(self) -> None:
+    x, y = Var('x'), Var('y')
+    expression = Add(Log(x, E), Mul(Sin(y), Pow(y, Const(Numeric(0.5)))))
+    fxn = lambdify(expression, 'python', assumptions={'x': Domain.Positive, 'y': Domain.Real})
+    self.assertIn('math.log', fxn.source) # type: ignore[attr-defined]
+    self.assertAlmostEqual(fxn(2.0, -1.0), math.log(2) + math.sin(-1) * 1j)
+    self.assertIn('cmath.log', lambdify(Log(x, E), 'python', assumptions={}).source) # type: ignore[attr-defined]
+    self.assertAlmostEqual(lambdify(Log(x, E), 'python', assumptions={})(-1.0), math.pi * 1j)
+
+  def test_lambdify_numpy_assumptions(self) -> None:
+    import numpy as np
+    x = Var('x')
+    fxn = lambdify(Log(x, E), 'numpy', assumptions={'x': Domain.Positive})
+    self.assertNotIn('emath', fxn.source) # type: ignore[attr-defined]
+    values = np.linspace(0.5, 3, 10)
+    np.testing.assert_allclose(fxn(values), np.log(values))
+    np.testing.assert_allclose(lambdify(Pow(x, Const(Numeric(0.5))), 'numpy', assumptions={})(np.array([-4.0])), [2j])
+
+  def test_ccode_real(self) -> None:
+    x, y = Var('x'), Var('y')
+    expression = Add(Pow(x, y), Sin(y))
+    domains = infer_domains([expression], {'x': Domain.Positive, 'y': Domain.Real})
+    self.assertEqual(generate_expression_string(expression, domains, C_DOUBLE_FUNCTIONS_MAP), '(pow(x, y)+sin(y))')
+    self.assertEqual(generate_expression_string(expression, infer_domains([expression], {'y': Domain.Real})), '(cpow(x, y)+sinl(y))')
+    self.assertEqual(generate_expression_string(expression), '(cpow(x, y)+csin(y))')
+
+class TestOptimize(unittest.TestCase):
+  def test_power_chain(self) -> None:
+    x = Var('x')
+    self.assertEqual(optimize_expression(Pow(x, Const(Numeric(4)))), Mul(Mul(x, x), Mul(x, x)))
+    self.assertEqual(optimize_expression(Pow(x, d.typecast(-2))), Pow(Mul(x, x), Neg(One)))
+    self.assertEqual(optimize_expression(Pow(x, Const(Numeric(0.5)))), Pow(x, Const(Numeric(0.5))))
+
+  def test_horner(self) -> None:
+    x, y = Var('x'), Var('y')
+    polynomial = Add(Add(Mul(Const(Numeric(3)), Pow(x, Const(Numeric(3)))), Mul(Two, Pow(x, Two))), Add(Mul(y, x), Const(Numeric(5))))
+    self.assertEqual(optimize_expression(polynomial), Add(Mul(Add(Mul(Add(Mul(Const(Numeric(3)), x), Two), x), y), x), Const(Numeric(5))))
+
+  def test_deep_expression(self) -> None:
+    # Note: Deeper than the recursion limit, every level is a sum without a Horner form
+    x = Var('x')
+    expression : Expr = x
+    for i in range(5000): expression = Add(Mul(expression, Const(Numeric(i % 3 + 1))), Sin(x))
+    self.assertEqual(optimize_expression(expression), expression)
+    inner = Add(Mul(Two, Pow(x, Two)), x)
+    shared = Add(Sin(inner), Add(inner, One))
+    self.assertEqual(optimize_expression(shared), Add(Sin(Mul(Add(Mul(Two, x), One), x)), Add(Mul(Add(Mul(Two, x), One), x), One)))
+
+  def test_special_powers(self) -> None:
+    x = Var('x')
+    expression = Add(Pow(x, Const(Numeric(0.5))), Pow(x, Neg(One)))
+    self.assertEqual(lambdify(expression, 'python', optimize=True, assumptions={'x': Domain.Positive}).source.splitlines()[-1], '  return (math.sqrt(x)+(1/x))') # type: ignore[attr-defined]
+    self.assertEqual(lambdify(expression, 'python', optimize=True).source.splitlines()[-1], '  return ((x**_c0)+(1/x))') # type: ignore[attr-defined]
+    domains = infer_domains([expression], {'x': Domain.Positive})
+    self.assertEqual(generate_expression_string(expression, domains, C_DOUBLE_FUNCTIONS_MAP, optimized=True), '(sqrt(x)+(1.0/x))')
+    self.assertEqual(generate_expression_string(expression, optimized=True), '(csqrt(x)+(1.0/x))')
+
+  def test_opt_in(self) -> None:
+    # Note: Rewrites change the rounding of results, so compiled programs only optimize when asked to like lambdify
+    x = Var('x')
+    polynomial = Add(Mul(Two, Pow(x, Two)), x)
+    self.assertEqual(ClangProgram(polynomial, cache=False).expression_code, generate_expression_string(polynomial))
+    self.assertNotEqual(ClangProgram(polynomial, optimize=True, cache=False).expression_code, generate_expression_string(polynomial))
+    self.assertFalse(ClangModule({'f': polynomial}, cache=False).programs['f'].optimize)
+
+  def test_derivatives(self) -> None:
+    x, y = Var('x'), Var('y')
+    for expression in [Mul(Pow(Add(x, y), Const(Numeric(5))), Pow(x, d.typecast(-3))), Add(Mul(Two, Pow(x, Const(Numeric(7)))), Pow(Sin(y), Three))]:
+      derivative = expression.differentiate(x)
+      for backend in ['python', 'mpmath', 'numpy']:
+        for _ in range(10):
+          args = {'x': random.uniform(0.5, 2), 'y': random.uniform(0.5, 2)}
+          expected = lambdify(derivative, backend, automatic_vars=False, vars=['x', 'y'])(**args) # type: ignore[call-overload]
+          self.assertAlmostEqual(complex(lambdify(derivative, backend, automatic_vars=False, vars=['x', 'y'], optimize=True)(**args)), complex(expected), delta=1e-9 * abs(expected)) # type: ignore[call-overload]
+
+class TestGradient(unittest.TestCase):
+  def setUp(self) -> None:
+    x, y = Var('x'), Var('y')
+    self.expressions = [Add(Mul(Sin(Mul(x, y)), Pow(x, Three)), Log(Add(Mul(x, x), One), E)), Mul(Cos(Add(x, y)), Pow(y, x)), Log(Mul(x, y), Add(y, Two))]
+
+  def test_lambdify_gradient(self) -> None:
+    for expression in self.expressions:
+      value_and_gradient = lambdify_gradient(expression)
+      value, gradient = value_and_gradient(0.7, 1.3)
+      self.assertAlmostEqual(value, lambdify(expression, 'python')(0.7, 1.3))
+      for var, partial in zip('xy', gradient): self.assertAlmostEqual(partial, lambdify(diff(expression, Var(var)), 'python')(0.7, 1.3))
+      grad = [0.0, 0.0]
+      self.assertIs(value_and_gradient(0.7, 1.3, grad=grad)[1], grad)
+      self.assertEqual(grad, list(gradient))
+
+  def test_shared_intermediates(self) -> None:
+    x, y = Var('x'), Var('y')
+    source = lambdify_gradient(Sin(Mul(x, y))).source # type: ignore[attr-defined]
+    self.assertEqual(source.count('(x*y)'), 1)
+    self.assertEqual(source.count('math.cos'), 1)
+
+  def test_zero_exponent(self) -> None:
+    x, y = Var('x'), Var('y')
+    value, gradient = lambdify_gradient(Add(Pow(x, Zero), Mul(x, y)))(0.0, 2.0)
+    self.assertEqual((value, tuple(gradient)), (1.0, (2.0, 0.0)))
+    self.assertEqual(tuple(lambdify_gradient(Pow(x, Zero))(0.0)[1]), (0.0,))
+
+  def test_wrt(self) -> None:
+    x, y = Var('x'), Var('y')
+    value, gradient = lambdify_gradient(Mul(x, y), wrt=['y', 'z'])(2.0, 3.0)
+    self.assertEqual(gradient, (2.0, 0.0))
+
+  @unittest.skipUnless(shutil.which(c_compiler()), "No C compiler available")
+  def test_clang_gradient(self) -> None:
+    import numpy as np
+    for expression in self.expressions:
+      real = ClangGradientProgram(expression, assumptions={'x': Domain.Positive, 'y': Domain.Positive}, cache=False)
+      complex_program = ClangGradientProgram(expression, cache=False)
+      self.assertTrue(real.real)
+      self.assertFalse(complex_program.real)
+      expected_value, expected_gradient = lambdify_gradient(expression)(0.7, 1.3)
+      grad = np.zeros(2)
+      value, gradient = real(0.7, 1.3, grad=grad)
+      self.assertIs(gradient, grad)
+      self.assertAlmostEqual(value, expected_value)
+      np.testing.assert_allclose(gradient, expected_gradient)
+      value, gradient = complex_program(0.7, 1.3)
+      self.assertAlmostEqual(value, expected_value)
+      np.testing.assert_allclose(gradient, expected_gradient)
+    grad, value, result = Var('grad'), Var('value'), Var('result')
+    for assumptions in ({'grad': Domain.Real, 'value': Domain.Real, 'result': Domain.Real}, None):
+      value_and_gradient = ClangGradientProgram(Add(Mul(grad, value), result), assumptions=assumptions, cache=False)(2.0, 3.0, 4.0)
+      self.assertAlmostEqual(value_and_gradient[0], 11)
+      np.testing.assert_allclose(value_and_gradient[1], [4, 1, 2])
+    program = ClangGradientProgram(Pow(Var('x'), Var('y')), wrt=['y'], assumptions={'y': Domain.Real}, cache=False)
+    value, gradient = program(-2.0, 1.5, grad=np.zeros(1, dtype=complex))
+    self.assertAlmostEqual(gradient[0], cmath.log(-2) * (-2) ** 1.5)
+
+class TestMultiDouble(unittest.TestCase):
+  def test_precision_terms(self) -> None:
+    self.assertEqual(precision_terms(16), 2)
+    self.assertEqual(precision_terms(30), 2)
+    self.assertEqual(precision_terms(45), 4)
+    self.assertRaises(ValueError, precision_terms, 100)
+    with mpmath.workprec(300): self.assertLess(abs(combine(split('0.1', 4)) - mpmath.mpf('0.1')), mpmath.mpf(10) ** -63)
+    self.assertEqual(split(0.5, 2), [0.5, 0.0])
+
+  @unittest.skipUnless(shutil.which(c_compiler()), "No C compiler available")
+  def test_accuracy(self) -> None:
+    x, y = Var('x'), Var('y')
+    tests : List[Tuple[Expr, Callable[[Any, Any], Any]]] = [
+      (Add(Mul(Sin(Mul(x, y)), Pow(x, Three)), Log(Add(Mul(x, x), One), E)), lambda a, b: mpmath.sin(a * b) * a ** 3 + mpmath.log(a * a + 1)),
+      (Mul(Cos(x), Pow(y, Neg(Two))), lambda a, b: mpmath.cos(a) / b ** 2),
+      (Pow(Mul(PI, x), Add(y, Const(Numeric(0.5)))), lambda a, b: (mpmath.pi * a) ** (b + mpmath.mpf(0.5))),
+      (Log(x, Add(y, Two)), lambda a, b: mpmath.log(a) / mpmath.log(b + 2)),
+    ]
+    for terms, digits in ((2, 28), (4, 58)):
+      for expression, reference in tests:
+        program = MultiDoubleProgram(expression, terms=terms, cache=False)
+        for a, b in (('0.7', '1.3'), ('2.5', '0.25')):
+          with mpmath.workprec(53 * terms + 64):
+            expected = reference(combine(split(a, terms)), combine(split(b, terms)))
+            self.assertLess(abs(program(a, b) - expected) / abs(expected), mpmath.mpf(10) ** -digits)
+
+  @unittest.skipUnless(shutil.which(c_compiler()), "No C compiler available")
+  def test_batch(self) -> None:
+    import numpy as np
+    x = Var('x')
+    program = MultiDoubleProgram(Sin(x), terms=2, cache=False)
+    out = program.batch(np.array([0.5, 1.0, 2.0]))
+    self.assertEqual(out.shape, (3, 2))
+    with mpmath.workprec(200):
+      for value, row in zip((0.5, 1.0, 2.0), out): self.assertLess(abs(combine(row) - mpmath.sin(mpmath.mpf(value))), mpmath.mpf(10) ** -30)
+    np.testing.assert_array_equal(program.batch(out, terms_axis=True), MultiDoubleProgram(Sin(Sin(x)), terms=2, cache=False).batch(np.array([0.5, 1.0, 2.0])))
+    # Note: Two plain values are not mistaken for the terms of one
+    np.testing.assert_array_equal(MultiDoubleProgram(Add(x, One), terms=2, cache=False).batch(np.array([1.0, 2.0])), [[2.0, 0.0], [3.0, 0.0]])
+    self.assertRaises(ValueError, program.batch, np.array([0.5, 1.0, 2.0]), terms_axis=True)
+    k, i, n = Var('k'), Var('i'), Var('n')
+    program = MultiDoubleProgram(Add(Mul(k, i), n), terms=2, cache=False)
+    self.assertEqual(program(2, 3, 4), 10)
+    np.testing.assert_array_equal(program.batch(np.array([1.0, 2.0]), 3.0, 4.0), [[7.0, 0.0], [10.0, 0.0]])
+
+  @unittest.skipUnless(shutil.which(c_compiler()), "No C compiler available")
+  def test_large_arguments(self) -> None:
+    x = Var('x')
+    for terms, digits in ((2, 30), (4, 60)):
+      sin, cos = MultiDoubleProgram(Sin(x), terms=terms, cache=False), MultiDoubleProgram(Cos(x), terms=terms, cache=False)
+      for a in ('1e7', '1e10', '-3.7e15', '1e22', '1e40'):
+        with mpmath.workprec(2000): value = combine(split(a, terms))
+        with mpmath.workprec(2000):
+          self.assertLess(abs(sin(a) - mpmath.sin(value)), mpmath.mpf(10) ** -digits)
+          self.assertLess(abs(cos(a) - mpmath.cos(value)), mpmath.mpf(10) ** -digits)
+      self.assertTrue(mpmath.isnan(sin('1e50')))
+
+  def test_automatic_terms(self) -> None:
+    precision = ec.precision
+    try:
+      ec.precision = 50
+      self.assertEqual(MultiDoubleProgram(Sin(Var('x')), cache=False).terms, 4)
+    finally: ec.precision = precision
+    self.assertRaises(ValueError, MultiDoubleProgram, Add(Var('x'), Complex(One, Two)), 2, None, False)
+
+@unittest.skipUnless(shutil.which(c_compiler()), "No C compiler available")
+class TestClangScalar(unittest.TestCase):
+  def test_real_scalar(self) -> None:
+    x, y = Var('x'), Var('y')
+    program = ClangProgram(Add(Mul(Sin(x), Two), Pow(y, Two)), assumptions={'x': Domain.Real, 'y': Domain.Real}, cache=False)
+    self.assertAlmostEqual(program(0.5, 3), 2 * math.sin(0.5) + 9)
+    self.assertIs(program.scalar, getattr(program.function, program.fxn_name))
+    self.assertAlmostEqual(program(One, Two), 2 * math.sin(1) + 4)
+    self.assertRaises(TypeError, program, 1j, 2.0)
+    self.assertRaises(TypeError, program, 1.0)
+
+  def test_complex_scalar(self) -> None:
+    x, y = Var('x'), Var('y')
+    program = ClangProgram(Mul(Log(x, E), y), assumptions={'y': Domain.Real}, cache=False)
+    self.assertFalse(program.real)
+    self.assertAlmostEqual(program(-1, 2), 2j * math.pi)
+    self.assertAlmostEqual(program(1j, Two), 1j * math.pi)
+    self.assertRaises(TypeError, program, LongDoubleComplex(-1, 0), 2 + 5j)
+    self.assertRaises(TypeError, program, -1, Complex(Two, One))
+    self.assertAlmostEqual(program(LongDoubleComplex(-1, 0), 2 + 0j), 2j * math.pi)
+    self.assertIsInstance(program(E, 1.0), complex)
+
+@unittest.skipUnless(shutil.which(c_compiler()), "No C compiler available")
+class TestClangBatch(unittest.TestCase):
+  def test_real_batch(self) -> None:
+    import numpy as np
+    x, y = Var('x'), Var('y')
+    expression = Add(Log(x, E), Mul(Sin(y), Pow(x, Const(Numeric(3)))))
+    program = ClangProgram(expression, assumptions={'x': Domain.Positive, 'y': Domain.Real}, openmp=True, cache=False)
+    xs, ys = np.random.uniform(0.5, 2, 50000), np.random.uniform(-1, 1, 50000)
+    out = np.empty(50000)
+    self.assertIs(program.batch(xs, ys, out=out), out)
+    np.testing.assert_allclose(out, lambdify(expression, 'numpy')(xs, ys))
+    np.testing.assert_allclose(program.batch(2.0, np.array([0.0, 1.0])), [math.log(2), math.log(2) + 8 * math.sin(1)])
+
+  def test_complex_batch(self) -> None:
+    import numpy as np
+    x = Var('x')
+    program = ClangProgram(Add(Log(x, E), Complex(One, Two)), cache=False)
+    xs = np.array([-1.0, 2.0, 1j])
+    np.testing.assert_allclose(program.batch(xs), np.log(xs) + 1 + 2j)
+    self.assertRaises(ValueError, program.batch, xs, out=np.empty(3))
+    program = ClangProgram(Mul(x, Var('y')), assumptions={'y': Domain.Real}, cache=False)
+    np.testing.assert_allclose(program.batch(xs, np.array([1, 2, 3], dtype=complex)), xs * [1, 2, 3])
+    self.assertRaises(TypeError, program.batch, xs, np.array([1, 2, 3j]))
+
+  def test_kernel_names(self) -> None:
+    # Note: Variables named like the kernel's own identifiers used to shadow them
+    import numpy as np
+    i, n, out, res = Var('i'), Var('n'), Var('out'), Var('res')
+    expression = Add(Mul(i, i), Add(n, Mul(out, res)))
+    for assumptions in ({'i': Domain.Real, 'n': Domain.Real, 'out': Domain.Real, 'res': Domain.Real}, {'res': Domain.Real}, None):
+      program = ClangProgram(expression, assumptions=assumptions, cache=False)
+      self.assertAlmostEqual(program(2.0, 3.0, 4.0, 5.0), 4 + 3 + 20)
+      np.testing.assert_allclose(program.batch(np.array([1.0, 2.0]), 3.0, 4.0, 5.0), [24, 27])
+
+@unittest.skipUnless(shutil.which(c_compiler()), "No C compiler available")
+class TestClangModule(unittest.TestCase):
+  def test_module(self) -> None:
+    import numpy as np
+    x, y = Var('x'), Var('y')
+    expressions = {f'f{i}': Add(Mul(Sin(x), Const(Numeric(i))), Pow(y, Two)) for i in range(1, 20)}
+    expressions['log'] = Log(x, E)
+    expressions['complex'] = Mul(x, Complex(One, Two))
+    module = ClangModule(expressions, assumptions={'x': Domain.Positive, 'y': Domain.Real}, cache=False)
+    self.assertEqual(module.fxn_code.count('#include <math.h>'), 1)
+    self.assertAlmostEqual(module.f3(1.0, 2.0), 3 * math.sin(1) + 4)
+    self.assertAlmostEqual(module['f7'](0.5, -1.0), 7 * math.sin(0.5) + 1)
+    np.testing.assert_allclose(module['log'].batch([1.0, math.e]), [0, 1])
+    self.assertAlmostEqual(module['complex'](2.0), 2 + 4j)
+    self.assertEqual(len(module), 21)
+    self.assertIs(module['f1'].function, module['log'].function)
+
+  def test_invalid_name(self) -> None:
+    self.assertRaises(ValueError, ClangModule, {'not valid': Var('x')}, cache=False)
+
+class TestExtensionExport(unittest.TestCase):
+  @unittest.skipUnless(shutil.which(c_compiler()), "No C compiler available")
+  def test_extension(self) -> None:
+    import array
+    import numpy as np
+    x, y, z = Var('x'), Var('y'), Var('z')
+    expressions = {'f': Add(Mul(Sin(x), Three), Pow(y, Two)), 'g': Mul(z, Complex(One, Two)), 'pi': Mul(PI, Two)}
+    with tempfile.TemporaryDirectory() as directory:
+      path = build_extension(expressions, 'calcora_test_export', directory, assumptions={'x': Domain.Real, 'y': Domain.Real})
+      module = load_extension(path)
+    self.assertEqual(module.variables, {'f': ('x', 'y'), 'g': ('z',), 'pi': ()})
+    self.assertAlmostEqual(module.f(1.0, 2), 3 * math.sin(1) + 4)
+    self.assertAlmostEqual(module.g(1 + 1j), (1 + 1j) * (1 + 2j))
+    self.assertAlmostEqual(module.pi(), 2 * math.pi)
+    self.assertRaises(TypeError, module.f, 1.0)
+    self.assertRaises(TypeError, module.f, 1j, 2.0)
+    xs, ys = np.linspace(0, 1, 101), np.linspace(-1, 1, 101)
+    np.testing.assert_allclose(module.f_batch(xs, ys), 3 * np.sin(xs) + ys**2)
+    np.testing.assert_allclose(module.f_batch(array.array('d', [0.5]), array.array('d', [2.0])), [3 * math.sin(0.5) + 4])
+    out = np.empty(101)
+    self.assertIs(module.f_batch(xs, ys, out), out)
+    np.testing.assert_allclose(out, 3 * np.sin(xs) + ys**2)
+    zs = xs + 1j * ys
+    np.testing.assert_allclose(np.frombuffer(module.g_batch(zs), dtype=np.complex128), zs * (1 + 2j))
+    self.assertRaises(ValueError, module.f_batch, xs, ys[:10])
+    self.assertRaises(TypeError, module.f_batch, xs.astype(np.float32), ys)
+    self.assertRaises((BufferError, ValueError), module.f_batch, xs[::2], ys[::2])
+    self.assertRaises(TypeError, module.pi_batch)
+    np.testing.assert_allclose(module.pi_batch(np.empty(3)), [2 * math.pi] * 3)
+
+  def test_invalid_names(self) -> None:
+    self.assertRaises(ValueError, extension_source, {'f': Var('x')}, 'not-valid')
+    self.assertRaises(ValueError, extension_source, {'f': Var('x'), 'f_batch': Var('x')}, 'module')
+    self.assertRaises(ValueError, extension_source, {'variables': Var('x')}, 'module')
+
+class TestAsyncClangProgram(unittest.TestCase):
+  @unittest.skipUnless(shutil.which(c_compiler()), "No C compiler available")
+  def test_switch_over(self) -> None:
+    import numpy as np
+    x = Var('x')
+    program = AsyncClangProgram(Mul(Sin(x), Two), assumptions={'x': Domain.Real}, cache=False)
+    self.assertAlmostEqual(program(1.0), 2 * math.sin(1))
+    np.testing.assert_allclose(program.batch(np.array([0.0, 1.0])), [0, 2 * math.sin(1)])
+    program.result(timeout=60)
+    self.assertTrue(program.ready)
+    self.assertIs(program._call, program.program)
+    self.assertAlmostEqual(program(1.0), 2 * math.sin(1))
+    np.testing.assert_allclose(program.batch(np.array([0.0, 1.0])), [0, 2 * math.sin(1)])
+
+  @unittest.skipUnless(shutil.which(c_compiler()), "No C compiler available")
+  def test_result_types(self) -> None:
+    # Note: The compile is held back behind a blocked task so the first calls are answered by the fallback
+    import concurrent.futures
+    import threading
+    x = Var('x')
+    for expression, assumptions, value_type in ((Mul(Sin(x), Two), {'x': Domain.Real}, float), (Add(Log(x, E), One), None, complex), (Mul(x, Two), None, complex)):
+      with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        release = threading.Event()
+        executor.submit(release.wait)
+        program = AsyncClangProgram(expression, assumptions=assumptions, cache=False, executor=executor)
+        before = program(1.0)
+        self.assertFalse(program.ready)
+        release.set()
+        program.result(timeout=60)
+        after = program(1.0)
+        self.assertIs(type(before), value_type)
+        self.assertIs(type(after), value_type)
+        self.assertAlmostEqual(before, after)
+
+  def test_compilation_error(self) -> None:
+    environment = os.environ.get('CC')
+    os.environ['CC'] = 'calcora-missing-compiler'
+    try:
+      program = AsyncClangProgram(Log(Var('x'), E), cache=False)
+      self.assertRaises(CompilationError, program.result, 60)
+      self.assertIsInstance(program.error, CompilationError)
+      self.assertFalse(program.ready)
+      self.assertAlmostEqual(program(-1.0), math.pi * 1j)
+    finally:
+      if environment is None: del os.environ['CC']
+      else: os.environ['CC'] = environment
+
+@unittest.skipUnless(shutil.which(c_compiler()), "No C compiler available")
+class TestAutotune(unittest.TestCase):
+  def test_blocked_batch(self) -> None:
+    import numpy as np
+    x, y = Var('x'), Var('y')
+    program = ClangProgram(Add(Mul(Sin(x), y), Cos(y)), assumptions={'x': Domain.Real, 'y': Domain.Real}, cache=False)
+    xs, ys = np.linspace(0, 1, 1001), np.linspace(-1, 1, 1001)
+    expected = program.batch(xs, ys)
+    for block, threads in [(7, 1), (100, 3), (5000, 2), (None, 4)]: np.testing.assert_array_equal(program.batch(xs, ys, block=block, threads=threads), expected)
+    zs = xs + 1j * ys
+    program = ClangProgram(Mul(Var('z'), Complex(One, Two)), cache=False)
+    np.testing.assert_allclose(program.batch(zs, block=64, threads=2), zs * (1 + 2j))
+    self.assertRaises(ValueError, program.batch, zs, block=0)
+
+  def test_autotune(self) -> None:
+    import numpy as np
+    x = Var('x')
+    with tempfile.TemporaryDirectory() as directory:
+      store = TuningStore(pathlib.Path(directory) / 'autotune.json')
+      program = ClangProgram(Mul(Sin(x), Cos(x)), assumptions={'x': Domain.Real}, cache=False)
+      tuning = autotune(program, blocks=(256, 4096), threads=(1, 2), sample_size=1 << 13, repeat=1, store=store)
+      self.assertIn((tuning.block, tuning.threads), [(256, 1), (256, 2), (4096, 1), (4096, 2)])
+      self.assertEqual(len(tuning.measurements), 4)
+      self.assertGreater(tuning.throughput, 0)
+      self.assertIs(program.tuning, tuning)
+      # Note: An identical program on the same cpu reuses the stored configuration without measuring
+      program = ClangProgram(Mul(Sin(x), Cos(x)), assumptions={'x': Domain.Real}, cache=False)
+      stored = autotune(program, store=store)
+      self.assertEqual((stored.block, stored.threads), (tuning.block, tuning.threads))
+      self.assertEqual(stored.measurements, [])
+      self.assertIn(cpu_model(), next(iter(store.load())))
+      xs = np.linspace(0, 1, 10000)
+      np.testing.assert_allclose(program.batch(xs), np.sin(xs) * np.cos(xs))
+      store.put(program, Tuning(3, 2, 1.0))
+      self.assertEqual(store.get(program).block, 3) # type: ignore[union-attr]
+      store.clear()
+      self.assertIsNone(store.get(program))
+      constant = ClangProgram(Sin(Two), autotune=True, cache=False)
+      self.assertAlmostEqual(complex(constant.batch()), math.sin(2))
+      self.assertIsNone(constant.tuning)
+      self.assertRaises(ValueError, autotune, constant, store=store)
+
+@unittest.skipUnless(shutil.which(c_compiler()), "No C compiler available")
+class TestSharedObjectCache(unittest.TestCase):
+  def setUp(self) -> None:
+    self.directory = tempfile.TemporaryDirectory()
+    self.cache = SharedObjectCache(pathlib.Path(self.directory.name))
+
+  def tearDown(self) -> None: self.directory.cleanup()
+
+  def test_reuse(self) -> None:
+    x = Var('x')
+    first = ClangProgram(Mul(Sin(x), Two), cache=self.cache)
+    self.assertEqual(first(1.0), 2 * math.sin(1))
+    second = ClangProgram(Mul(Sin(x), Two), cache=self.cache)
+    self.assertEqual(second.fxn_name, first.fxn_name)
+    self.assertEqual(second(1.0), 2 * math.sin(1))
+    stats = self.cache.stats()
+    self.assertEqual((stats['hits'], stats['misses'], stats['writes'], stats['entries']), (1, 1, 1, 1))
+
+  def test_key(self) -> None:
+    self.assertNotEqual(SharedObjectCache.key('int f;', ['-O2'], c_compiler()), SharedObjectCache.key('int f;', ['-O3'], c_compiler()))
+    self.assertNotEqual(SharedObjectCache.key('int f;', ['-O2'], c_compiler()), SharedObjectCache.key('int g;', ['-O2'], c_compiler()))
+
+  def test_unwritable_directory(self) -> None:
+    self.cache.put('entry', bytes(10))
+    with unittest.mock.patch('os.utime', side_effect=PermissionError):
+      self.assertEqual(self.cache.get('entry'), self.cache.path('entry'))
+      self.assertIsNone(self.cache.get('missing'))
+    self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+  @unittest.skipUnless(shutil.which(c_compiler()), "No C compiler available")
+  def test_unwritable_compile(self) -> None:
+    with unittest.mock.patch.object(self.cache, 'put', side_effect=PermissionError):
+      self.assertEqual(ClangProgram(Sin(Var('x')), cache=self.cache)(1.0), math.sin(1))
+
+  def test_eviction(self) -> None:
+    for i in range(5):
+      self.cache.put(f'{i}', bytes(100))
+      os.utime(self.cache.path(f'{i}'), (i, i))
+    self.cache.get('0')
+    self.cache.max_size = 250
+    self.cache.evict()
+    self.assertEqual(sorted(path.stem for path in self.cache.entries()), ['0', '4'])
+    self.assertEqual(self.cache.stats()['evictions'], 3)
+
+class TestLambdifyCache(unittest.TestCase):
+  def setUp(self) -> None:
+    self.directory = tempfile.TemporaryDirectory()
+    self.x, self.y = Var('x'), Var('y')
+    self.expression = Add(Mul(Sin(self.x), Const(Numeric('0.1'))), Pow(self.y, Two))
+
+  def tearDown(self) -> None: self.directory.cleanup()
+
+  def test_hit(self) -> None:
+    cache = LambdifyCache()
+    fxn = lambdify(self.expression, 'python', cache=cache)
+    # Note: A hit shares the generated code but is a separate function carrying the expression it was asked for
+    expression = Add(Mul(Sin(Var('x')), Const(Numeric('0.1'))), Pow(Var('y'), Two))
+    hit = lambdify(expression, 'python', cache=cache)
+    self.assertIsNot(hit, fxn)
+    self.assertIs(hit.__code__, fxn.__code__)
+    self.assertIs(getattr(hit, 'expression'), expression)
+    self.assertIs(getattr(fxn, 'expression'), self.expression)
+    self.assertEqual((cache.hits, cache.misses), (1, 1))
+    self.assertIsNot(lambdify(self.expression, 'mpmath', cache=cache).__code__, fxn.__code__)
+    self.assertIsNot(lambdify(self.expression, 'python', type_conversion=True, cache=cache).__code__, fxn.__code__)
+    self.assertIsNot(lambdify(self.expression, 'python', automatic_vars=False, vars=['x', 'y', 'z'], cache=cache).__code__, fxn.__code__)
+    self.assertEqual(cache.stats()['entries'], 4)
+    cache.clear()
+    self.assertIsNot(lambdify(self.expression, 'python', cache=cache).__code__, fxn.__code__)
+    self.assertIsNot(lambdify(self.expression, 'python', cache=False), lambdify(self.expression, 'python', cache=False))
+
+  def test_eviction(self) -> None:
+    cache = LambdifyCache(max_entries=2)
+    first = lambdify(Sin(self.x), 'python', cache=cache)
+    lambdify(Cos(self.x), 'python', cache=cache)
+    lambdify(Sin(self.x), 'python', cache=cache)
+    lambdify(Log(self.x, E), 'python', cache=cache)
+    self.assertEqual(cache.evictions, 1)
+    self.assertIs(lambdify(Sin(self.x), 'python', cache=cache).__code__, first.__code__)
+    self.assertEqual(cache.stats()['entries'], 2)
+
+  def test_uncacheable(self) -> None:
+    # Note: AnyOp has no arena form, such expressions bypass the cache and fail the same way as without it
+    cache = LambdifyCache()
+    expression = Add(self.x, AnyOp())
+    self.assertIsNone(arena_key([expression]))
+    self.assertRaises(TypeError, lambdify, expression, 'python', cache=cache)
+    self.assertEqual((cache.hits, cache.misses, cache.stats()['entries']), (0, 0, 0))
+
+  def test_disk(self) -> None:
+    directory = pathlib.Path(self.directory.name)
+    cache = LambdifyCache(directory=directory)
+    with mpmath.workdps(30):
+      reference = lambdify(self.expression, 'mpmath', cache=cache)(0.5, 2)
+      self.assertEqual(cache.disk_writes, 1)
+      fresh = LambdifyCache(directory=directory)
+      fxn = lambdify(self.expression, 'mpmath', cache=fresh)
+      self.assertEqual((fresh.disk_hits, fresh.disk_writes), (1, 0))
+      self.assertEqual(fxn(0.5, 2), reference)
+      self.assertEqual(fxn.source, lambdify(self.expression, 'mpmath', cache=False).source) # type: ignore[attr-defined]
+    fresh.clear(disk=True)
+    self.assertEqual(list(directory.glob('*.lambdify')), [])
+
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
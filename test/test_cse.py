@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import random
+import unittest
+
+from typing import List, Tuple
+from typing import TYPE_CHECKING
+
+from calcora.core.cse import ExprDAG, cse
+from calcora.core.ops import Add, Constant, Cos, Log, Mul, Pow, Sin, Var
+from calcora.core.constants import E, Two
+from calcora.core.registry import Dispatcher as d
+
+if TYPE_CHECKING:
+  from calcora.core.expression import Expr
+
+x = Var('x')
+y = Var('y')
+
+def substitute_back(replacements: List[Tuple[Var, Expr]], expression: Expr, **values: float) -> float:
+  env = {k: d.typecast(v) for k, v in values.items()}
+  for symbol, sub in replacements: env[symbol.name] = d.typecast(sub.evalf(**env).value)
+  return float(expression.evalf(**env))
+
+class TestExprDAG(unittest.TestCase):
+  def test_structural_sharing(self) -> None:
+    dag = ExprDAG([Add(Sin(x), Sin(x))])
+    self.assertEqual(len(dag), 3)
+    self.assertEqual(dag.uses[1], 2)
+
+  def test_commutative_merge(self) -> None:
+    dag = ExprDAG([Mul(Add(x, y), Add(y, x))])
+    self.assertEqual(len(dag), 4)
+
+  def test_constants(self) -> None:
+    # Note: Constants are merged by name and value, two constants with the same value but different names stay apart
+    dag = ExprDAG([Add(Mul(E, x), Mul(E, y)), Add(E, Constant(E.x, name='euler'))])
+    self.assertEqual(sum(node.fxn == E.fxn for node in dag.nodes), 2)
+
+class TestCSE(unittest.TestCase):
+  def test_no_repeats(self) -> None:
+    expression = Add(x, Sin(y))
+    replacements, reduced = cse(expression)
+    self.assertEqual(replacements, [])
+    self.assertIs(reduced[0], expression)
+
+  def test_single_expression(self) -> None:
+    replacements, reduced = cse(Add(Pow(x, y), Mul(Two, Pow(x, y))))
+    self.assertEqual(replacements, [(Var('x0'), Pow(x, y))])
+    self.assertEqual(reduced, [Add(Var('x0'), Mul(Two, Var('x0')))])
+
+  def test_multiple_expressions(self) -> None:
+    replacements, reduced = cse([Sin(Log(x, E)), Cos(Log(x, E))])
+    self.assertEqual(replacements, [(Var('x0'), Log(x, E))])
+    self.assertEqual(reduced, [Sin(Var('x0')), Cos(Var('x0'))])
+
+  def test_symbol_collisions(self) -> None:
+    x0 = Var('x0')
+    replacements, _ = cse(Add(Sin(x0), Sin(x0)))
+    self.assertEqual(replacements[0][0], Var('x1'))
+
+  def test_min_cost(self) -> None:
+    expression = Add(Sin(x), Sin(x))
+    self.assertEqual(len(cse(expression)[0]), 1)
+    self.assertEqual(len(cse(expression, min_cost=2)[0]), 0)
+
+  def test_literals_not_extracted(self) -> None:
+    self.assertEqual(cse(Add(Pow(x, d.typecast(-1)), Pow(y, d.typecast(-1))))[0], [])
+
+  def test_derivative_roundtrip(self) -> None:
+    for expression in [Pow(x, y), Mul(Sin(x), Pow(x, x)), Log(Pow(x, y), Add(x, Two))]:
+      derivatives = [expression.differentiate(x), expression.differentiate(y)]
+      replacements, reduced = cse(derivatives)
+      self.assertTrue(replacements)
+      for _ in range(10):
+        values = {'x': random.uniform(1, 3), 'y': random.uniform(1, 3)}
+        for original, new in zip(derivatives, reduced):
+          self.assertAlmostEqual(float(original.evalf(**{k: d.typecast(v) for k, v in values.items()})), substitute_back(replacements, new, **values), delta=1e-9)
+
+if __name__ == '__main__':
+  unittest.main()
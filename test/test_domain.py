@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+import unittest
+
+from calcora.core.domain import Domain, infer_domain
+from calcora.core.ops import Add, Complex, Const, Cos, Log, Mul, Neg, Pow, Sin, Var
+from calcora.core.constants import E, PI, One, Two, OneHalf
+from calcora.core.numeric import Numeric
+
+x = Var('x')
+y = Var('y')
+z = Var('z')
+assumptions = {'x': Domain.Positive, 'y': Domain.Real, 'n': Domain.Integer}
+
+class TestDomain(unittest.TestCase):
+  def test_leaves(self) -> None:
+    self.assertIn(Domain.Positive, infer_domain(x, assumptions))
+    self.assertIn(Domain.Real, infer_domain(Var('n'), assumptions))
+    self.assertEqual(infer_domain(z, assumptions), Domain.Complex)
+    self.assertIn(Domain.Positive, infer_domain(PI))
+    self.assertIn(Domain.Integer, infer_domain(Neg(One)))
+    self.assertNotIn(Domain.NonNegative, infer_domain(Neg(One)))
+
+  def test_arithmetic(self) -> None:
+    self.assertIn(Domain.Positive, infer_domain(Add(x, Mul(x, Two)), assumptions))
+    self.assertEqual(infer_domain(Add(x, y), assumptions), Domain.Real)
+    self.assertEqual(infer_domain(Add(x, z), assumptions), Domain.Complex)
+    self.assertIn(Domain.Integer, infer_domain(Mul(Var('n'), Two), assumptions))
+
+  def test_pow(self) -> None:
+    self.assertIn(Domain.Positive, infer_domain(Pow(x, y), assumptions))
+    self.assertIn(Domain.NonNegative, infer_domain(Pow(y, Two), assumptions))
+    self.assertIn(Domain.Real, infer_domain(Pow(y, Neg(One)), assumptions))
+    self.assertEqual(infer_domain(Pow(y, OneHalf), assumptions), Domain.Complex)
+
+  def test_functions(self) -> None:
+    self.assertIn(Domain.Real, infer_domain(Log(x, E), assumptions))
+    self.assertEqual(infer_domain(Log(y, E), assumptions), Domain.Complex)
+    self.assertIn(Domain.Real, infer_domain(Sin(Cos(y)), assumptions))
+    self.assertEqual(infer_domain(Sin(z), assumptions), Domain.Complex)
+
+  def test_complex(self) -> None:
+    self.assertIn(Domain.Real, infer_domain(Complex(y, Const(Numeric(0))), assumptions))
+    self.assertEqual(infer_domain(Mul(y, Complex(One, One)), assumptions), Domain.Complex)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import math
+import os
+import shutil
+import time
+import unittest
+
+from calcora.codegen.ccompiler import c_compiler
+from calcora.codegen.jit import CrossCheckError, JitEvaluator, JitFunction, Tier
+from calcora.core.domain import Domain
+from calcora.core.ops import Add, Log, Mul, Pow, Sin, Var
+from calcora.core.constants import E, Two
+
+x = Var('x')
+y = Var('y')
+expression = Add(Mul(Sin(x), Two), Pow(y, Two))
+reference = lambda x, y: 2 * math.sin(x) + y ** 2
+
+class TestJitFunction(unittest.TestCase):
+  def test_tree_walk_to_lambdify(self) -> None:
+    fxn = JitFunction(expression, lambdify_calls=3, lambdify_time_ns=None, native_calls=None, native_time_ns=None)
+    for i in range(10): self.assertAlmostEqual(fxn(0.5, float(i)), reference(0.5, i))
+    self.assertEqual(fxn.tier, Tier.Lambdify)
+    self.assertEqual(fxn.calls[Tier.TreeWalk], 3)
+    self.assertEqual(fxn.calls[Tier.Lambdify], 7)
+    self.assertEqual(fxn.stats()['promotions'], [('Lambdify', 3)])
+
+  def test_time_threshold(self) -> None:
+    fxn = JitFunction(expression, lambdify_calls=None, lambdify_time_ns=1, native_calls=None, native_time_ns=None)
+    fxn(1.0, 2.0)
+    self.assertEqual(fxn.tier, Tier.Lambdify)
+
+  def test_disabled_tiers(self) -> None:
+    fxn = JitFunction(expression, lambdify_calls=None, lambdify_time_ns=None)
+    for _ in range(20): fxn(1.0, 2.0)
+    self.assertEqual(fxn.tier, Tier.TreeWalk)
+
+  def test_arguments(self) -> None:
+    fxn = JitFunction(expression)
+    self.assertAlmostEqual(fxn(y=2.0, x=1.0), reference(1, 2))
+    self.assertAlmostEqual(fxn(1.0, y=2.0), reference(1, 2))
+    self.assertRaises(TypeError, fxn, 1.0)
+    self.assertRaises(TypeError, fxn, 1.0, z=2.0)
+
+  def test_complex_results(self) -> None:
+    fxn = JitFunction(Log(x, E), lambdify_calls=2, native_calls=None, native_time_ns=None)
+    for _ in range(4): self.assertAlmostEqual(fxn(-1.0), math.pi * 1j)
+    self.assertIsInstance(fxn(2.0), float)
+
+  def test_cross_check(self) -> None:
+    fxn = JitFunction(expression, lambdify_calls=1, native_calls=None, native_time_ns=None, cross_check=1.0)
+    for i in range(5): fxn(0.5, float(i))
+    self.assertEqual(fxn.checks, 4)
+    self.assertEqual(fxn.mismatches, [])
+    fxn._lambdified = lambda x, y: 0.0
+    fxn(0.5, 1.0)
+    self.assertEqual(len(fxn.mismatches), 1)
+    self.assertEqual(fxn.mismatches[0]['tier'], Tier.Lambdify)
+    fxn.strict = True
+    self.assertRaises(CrossCheckError, fxn, 0.5, 1.0)
+
+  @unittest.skipUnless(shutil.which(c_compiler()), "No C compiler available")
+  def test_native(self) -> None:
+    fxn = JitFunction(expression, lambdify_calls=1, native_calls=2, assumptions={'x': Domain.Real, 'y': Domain.Real}, cache=False, cross_check=1.0)
+    for _ in range(3): fxn(0.5, 1.0)
+    assert fxn._native is not None
+    fxn._native.result(timeout=60)
+    for _ in range(3): self.assertAlmostEqual(fxn(0.5, 1.0), reference(0.5, 1))
+    self.assertEqual(fxn.tier, Tier.Native)
+    self.assertGreater(fxn.calls[Tier.Native], 0)
+    self.assertEqual(fxn.mismatches, [])
+
+  def test_native_failure(self) -> None:
+    environment = os.environ.get('CC')
+    os.environ['CC'] = 'calcora-missing-compiler'
+    try:
+      fxn = JitFunction(expression, lambdify_calls=1, native_calls=2, cache=False)
+      for _ in range(3): fxn(0.5, 1.0)
+      assert fxn._native is not None
+      fxn._native.future.exception(timeout=60)
+      for _ in range(3): self.assertAlmostEqual(fxn(0.5, 1.0), reference(0.5, 1))
+      self.assertEqual(fxn.tier, Tier.Lambdify)
+      self.assertIsNotNone(fxn.error)
+    finally:
+      if environment is None: del os.environ['CC']
+      else: os.environ['CC'] = environment
+
+class TestJitEvaluator(unittest.TestCase):
+  def test_evaluator(self) -> None:
+    evaluator = JitEvaluator(lambdify_calls=2, native_calls=None, native_time_ns=None)
+    for i in range(4):
+      self.assertAlmostEqual(evaluator(expression, 0.5, float(i)), reference(0.5, i))
+      self.assertAlmostEqual(evaluator(Mul(x, Two), x=float(i)), 2 * i)
+    stats = evaluator.stats()
+    self.assertEqual(stats['expressions'], 2)
+    self.assertEqual(stats['calls'], {'TreeWalk': 4, 'Lambdify': 4, 'Native': 0})
+    self.assertEqual(stats['current']['Lambdify'], 2)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import random
+import unittest
+
+import numpy as np
+
+from calcora.codegen.lambdify import lambdify
+from calcora.codegen.numpy_eval import NumpyProgram
+from calcora.core.ops import Add, Complex, Const, Cos, Log, Mul, Neg, Pow, Sin, Var
+from calcora.core.constants import E, One, OneHalf, Two
+from calcora.core.domain import Domain
+from calcora.core.numeric import Numeric
+
+if TYPE_CHECKING:
+  from calcora.core.expression import Expr
+
+x = Var('x')
+y = Var('y')
+
+def generate_random_expression(depth: int) -> Expr:
+  if depth == 1: return random.choice([x, y, Const(Numeric(random.uniform(1, 7)))])
+  operation = random.choice([Add, Mul, Neg, Sin])
+  if operation is Add or operation is Mul: return operation(generate_random_expression(depth - 1), generate_random_expression(depth - 1))
+  return operation(generate_random_expression(depth - 1))
+
+class TestNumpyProgram(unittest.TestCase):
+  def test_random(self) -> None:
+    for _ in range(200):
+      expression = generate_random_expression(random.randint(1, 6))
+      program = NumpyProgram(expression, block_size=7)
+      args = {name: np.random.uniform(0, 3, 50) for name in program.fxn_vars}
+      np.testing.assert_allclose(program(**args), lambdify(expression, 'numpy')(**args))
+
+  def test_log_and_broadcasting(self) -> None:
+    expression = Add(Log(x, E), Mul(Sin(Mul(x, y)), Log(y, Add(x, Two))))
+    program = NumpyProgram(expression, block_size=5)
+    xs, ys = np.random.uniform(1, 3, (4, 6)), np.random.uniform(1, 3, 6)
+    np.testing.assert_allclose(program(xs, ys), lambdify(expression, 'numpy')(xs, ys))
+    np.testing.assert_allclose(program(xs, 2.0), lambdify(expression, 'numpy')(xs, 2.0))
+
+  def test_out(self) -> None:
+    xs = np.linspace(0, 1, 100)
+    out = np.empty(100)
+    self.assertIs(NumpyProgram(Cos(x), block_size=16)(xs, out=out), out)
+    np.testing.assert_allclose(out, np.cos(xs))
+    self.assertRaises(ValueError, NumpyProgram(Cos(x)), xs, out=np.empty(10))
+
+  def test_complex(self) -> None:
+    np.testing.assert_allclose(NumpyProgram(Add(x, Complex(One, Two)))(np.arange(3.0)), np.arange(3.0) + 1 + 2j)
+    np.testing.assert_allclose(NumpyProgram(Complex(x, y))(np.arange(3.0), 1.0), np.arange(3.0) + 1j)
+
+  def test_register_reuse(self) -> None:
+    expression = x
+    for _ in range(50): expression = Add(Sin(expression), One)
+    self.assertEqual(NumpyProgram(expression).registers, 1)
+
+  def test_leaf(self) -> None:
+    np.testing.assert_allclose(NumpyProgram(x)(np.arange(3.0)), np.arange(3.0))
+    self.assertEqual(NumpyProgram(Two)(), 2)
+
+  def test_dtypes(self) -> None:
+    expression = Add(Mul(Sin(x), Cos(y)), Log(x, Two))
+    xs, ys = np.random.uniform(1, 3, 100), np.random.uniform(1, 3, 100)
+    reference = lambdify(expression, 'numpy')(xs, ys)
+    for dtype, rtol in (('float32', 1e-5), ('float64', 1e-12), ('complex64', 1e-5), ('complex128', 1e-12)):
+      res = NumpyProgram(expression, block_size=16, dtype=dtype, assumptions={'x': Domain.Positive})(xs, ys)
+      self.assertEqual(res.dtype, np.dtype(dtype))
+      np.testing.assert_allclose(res, reference, rtol=rtol, atol=rtol)
+    self.assertEqual(NumpyProgram(expression, assumptions={'x': Domain.Positive})(xs.astype(np.float32), ys).dtype, np.float64)
+    self.assertEqual(NumpyProgram(expression, dtype='float32')(xs, ys).dtype, np.complex64)
+    self.assertRaises(ValueError, NumpyProgram, expression, dtype=np.int32)
+
+  def test_complex_promotion(self) -> None:
+    # Note: Only the Complex node and its parents are complex, sin(x)*cos(y) stays in float32 registers
+    expression = Add(Mul(Sin(x), Cos(y)), Complex(x, One))
+    program = NumpyProgram(expression, dtype='float32')
+    plan = program.plan((False, False))
+    self.assertEqual((plan.real_registers, plan.complex_registers), (2, 1))
+    res = program(np.arange(3.0), 2.0)
+    self.assertEqual(res.dtype, np.complex64)
+    np.testing.assert_allclose(res, np.sin(np.arange(3.0)) * np.cos(2.0) + np.arange(3.0) + 1j, rtol=1e-6)
+    res = NumpyProgram(Mul(Sin(x), y), dtype='float32')(np.arange(3.0), np.array([1j, 2j, 3j]))
+    self.assertEqual(res.dtype, np.complex64)
+    np.testing.assert_allclose(res, np.sin(np.arange(3.0)) * np.array([1j, 2j, 3j]), rtol=1e-6)
+
+  def test_negative_inputs(self) -> None:
+    # Note: Logs and fractional powers of values that are not provably nonnegative are complex, like the numpy.emath functions lambdify uses
+    xs, ys = np.linspace(-3, 3, 50), np.linspace(-2, 2.5, 50)
+    for expression in (Log(x, E), Log(Two, Neg(Two)), Log(x, y), Add(Log(Neg(x), Two), Mul(Sin(y), Pow(x, Two)))):
+      program = NumpyProgram(expression, block_size=16)
+      args = {name: value for name, value in (('x', xs), ('y', ys)) if name in program.fxn_vars}
+      np.testing.assert_allclose(program(**args), lambdify(expression, 'numpy')(**args))
+    np.testing.assert_allclose(NumpyProgram(Pow(x, OneHalf))(xs), np.emath.sqrt(xs))
+    np.testing.assert_allclose(NumpyProgram(Pow(x, y), block_size=16)(xs, ys), np.emath.power(xs.astype(complex), ys))
+    plan = NumpyProgram(Add(Log(x, E), Pow(y, Two)), assumptions={'x': Domain.Positive}).plan((False, False))
+    self.assertEqual(plan.complex_registers, 0)
+    self.assertEqual(NumpyProgram(Pow(x, OneHalf))(np.array([4.0])).dtype, np.complex128)
+
+  def test_grid(self) -> None:
+    expression = Add(Sin(Mul(x, y)), Log(y, E))
+    program = NumpyProgram(expression, block_size=64, dtype='float32')
+    xs, ys = np.linspace(0, 1, 101), np.linspace(1, 2, 37)
+    X, Y = np.meshgrid(xs, ys, indexing='ij')
+    reference = np.sin(X * Y) + np.log(Y)
+    np.testing.assert_allclose(program.grid(xs, ys), reference, rtol=1e-5)
+    np.testing.assert_allclose(program.grid(y=ys, x=xs).T, reference, rtol=1e-5)
+    np.testing.assert_allclose(program(xs[:, None], ys[None, :]), reference, rtol=1e-5)
+    np.testing.assert_allclose(NumpyProgram(expression, block_size=5)(xs[:, None, None], ys[None, :, None] * np.ones(4)), np.broadcast_to(reference[:, :, None], (101, 37, 4)))
+    self.assertEqual(program(np.empty(0), 1.0).shape, (0,))
+
+if __name__ == '__main__':
+  unittest.main()
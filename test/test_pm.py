@@ -7,11 +7,13 @@ import unittest
 from typing import List, Type
 from typing import TYPE_CHECKING
 
-from calcora.core.ops import Add, Complex, Const, Log, Mul, Neg, Pow, Var
+from calcora.core.ops import Add, AnyOp, Complex, Const, Cos, Log, Mul, Neg, Pow, Sin, Var
 from calcora.core.numeric import Numeric
-from calcora.core.constants import Zero, One, Two, Three, Five
+from calcora.core.constants import NegOne, Zero, One, Two, Three, Five
 from calcora.globals import ec
-from calcora.match.match import SymbolicPatternMatcher
+from calcora.match.match import PatternMatcher, SymbolicPatternMatcher
+from calcora.match.pattern import Pattern
+from calcora.match.simplify import is_simplified, simplify
 
 if TYPE_CHECKING:
   from calcora.core.expression import Expr
@@ -140,5 +142,50 @@ class TestSymbolicPatternMatcher(unittest.TestCase):
       matched_expr = self.pm.match(expr)
       self.assertEqual(matched_expr._eval(), expr._eval())
 
+class TestIncrementalSimplify(unittest.TestCase):
+  def test_unchanged_ops_are_shared(self) -> None:
+    left = Mul(x, Var('y'))
+    expr = Add(left, Add(x, Zero))
+    matched = SymbolicPatternMatcher.match(expr)
+    self.assertIs(matched.args[0], left)
+
+  def test_simplified_is_marked(self) -> None:
+    expr = simplify(Add(Mul(x, One), Sin(Add(x, Zero))))
+    self.assertTrue(is_simplified(expr))
+    self.assertTrue(all(is_simplified(arg) for arg in expr.args))
+    self.assertIs(simplify(expr), expr)
+  
+  def test_resimplify_after_subs(self) -> None:
+    y, z = Var('y'), Var('z')
+    untouched = Sin(Mul(y, Three))
+    expr = simplify(Add(untouched, Mul(x, Two)))
+    self.assertIs(expr.args[0], untouched)
+    edited = expr.subs({x: Add(z, Zero)})
+    self.assertFalse(is_simplified(edited))
+    resimplified = simplify(edited)
+    self.assertEqual(resimplified, Add(untouched, Mul(z, Two)))
+    self.assertIs(resimplified.args[0], untouched)
+    self.assertEqual(resimplified, simplify(Add(Sin(Mul(y, Three)), Mul(Add(z, Zero), Two))))
+
+  def test_resimplify_division_after_subs(self) -> None:
+    # Note: 2^-1 is left alone as the divisor of x/2 but has to fold once the division is gone
+    expr = simplify(Mul(x, Pow(Two, NegOne)))
+    edited = expr.subs({x: One})
+    self.assertEqual(simplify(edited), simplify(Mul(One, Pow(Two, NegOne))))
+    expr = simplify(Add(x, Neg(Mul(Two, Three))))
+    self.assertEqual(simplify(expr.subs({x: Zero})), simplify(Add(Zero, Neg(Mul(Two, Three)))))
+
+  def test_marked_ops_are_skipped(self) -> None:
+    expr = simplify(Cos(x))
+    matcher = PatternMatcher([Pattern(Cos(AnyOp()), lambda x: Sin(x))])
+    self.assertEqual(matcher.match(Add(expr, Zero)), Add(Sin(x), Zero))
+    self.assertEqual(matcher.match(Add(expr, Zero), skip=SymbolicPatternMatcher.token), Add(Cos(x), Zero))
+
+  def test_new_rules_invalidate_marks(self) -> None:
+    matcher = PatternMatcher([Pattern(Add(AnyOp(), Zero), lambda x: x)])
+    token = matcher.token
+    matcher.add_rules([Pattern(Mul(AnyOp(), One), lambda x: x)])
+    self.assertIsNot(token, matcher.token)
+
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import unittest
+
+from calcora.core.ops import Const, Cos, Log, Mul, Pow, Sin, Var
+from calcora.core.constants import E, Two
+from calcora.core.numeric import Numeric
+from calcora.core.registry import Dispatcher as d
+from calcora.core.series import TruncatedSeries, series
+from calcora.globals import ec
+
+from mpmath import mp, mpf, almosteq, diff as mpdiff, sin, cos, log, factorial
+
+x = Var('x')
+y = Var('y')
+
+class TestTruncatedSeries(unittest.TestCase):
+  def test_arithmetic(self) -> None:
+    a = TruncatedSeries([1, 2, 3], 2)
+    b = TruncatedSeries([2, 1], 2)
+    self.assertEqual((a + b).coeffs, [3, 3, 3])
+    self.assertEqual((a - b).coeffs, [-1, 1, 3])
+    self.assertEqual((a * b).coeffs, [2, 5, 8])
+    self.assertEqual(((a * b) / b).coeffs, a.coeffs)
+    self.assertEqual((2 * a).coeffs, [2, 4, 6])
+
+  def test_truncation(self) -> None:
+    a = TruncatedSeries([0, 1], 3)
+    self.assertEqual((a ** 5).coeffs, [0, 0, 0, 0])
+    self.assertEqual((a ** 2).coeffs, [0, 0, 1, 0])
+
+  def test_mismatched_order(self) -> None:
+    with self.assertRaises(ValueError): TruncatedSeries([1], 2) + TruncatedSeries([1], 3)
+
+  def test_elementary_functions(self) -> None:
+    a = TruncatedSeries.variable(0, 8)
+    for k, c in enumerate(a.exp().coeffs): self.assertTrue(almosteq(c, 1 / factorial(k)))
+    self.assertTrue(all(almosteq(c, v) for c, v in zip(a.sin().coeffs, [0, 1, 0, mpf(-1)/6, 0, mpf(1)/120])))
+    self.assertTrue(all(almosteq(c, v) for c, v in zip((a + 1).log().coeffs, [0, 1, mpf(-1)/2, mpf(1)/3, mpf(-1)/4])))
+
+class TestSeries(unittest.TestCase):
+  def test_polynomial(self) -> None:
+    s = series(Pow(x, Const(Numeric(3))), x, 2, 4)
+    self.assertEqual([float(c) for c in s.derivatives()], [8, 12, 12, 6, 0])
+
+  def test_against_mpmath(self) -> None:
+    expression = Sin(x)*x**3 + d.ln(x)/(x + 1) + x**x + Cos(Mul(x, y))
+    f = lambda t: sin(t)*t**3 + log(t)/(t + 1) + t**t + cos(2*t)
+    s = series(expression, x, 1.5, 6, y=Two)
+    for n, value in enumerate(s.derivatives()): self.assertTrue(almosteq(value.value, mpdiff(f, 1.5, n), rel_eps=1e-10))
+
+  def test_log_base(self) -> None:
+    s = series(Log(x, Two), x, 3, 3)
+    self.assertTrue(almosteq(s.derivative(0).value, log(3, 2)))
+    self.assertTrue(almosteq(s.derivative(3).value, 2 / (27 * log(2))))
+
+  def test_high_order(self) -> None:
+    precision = ec.precision
+    try:
+      ec.precision = 30
+      s = series(E ** x, x, 1, 20)
+      self.assertTrue(almosteq(s.derivative(20).value, mp.e, rel_eps=mpf(10)**-25))
+    finally: ec.precision = precision
+
+  def test_missing_var(self) -> None:
+    with self.assertRaises(ValueError): series(x * y, x, 0, 2)
+
+  def test_evaluate(self) -> None:
+    s = series(Sin(x), x, 0, 15)
+    self.assertAlmostEqual(float(s(0.5)), float(sin(0.5)), delta=1e-12)
+
+if __name__ == '__main__':
+  unittest.main()
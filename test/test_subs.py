@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import math
+import unittest
+
+from calcora.core.ops import Add, Complex, Const, Cos, Log, Mul, Neg, Pow, Sin, Var
+from calcora.core.constants import PI, One, Two, Three
+from calcora.core.numeric import Numeric
+
+x = Var('x')
+y = Var('y')
+a = Var('a')
+
+class TestSubs(unittest.TestCase):
+  def test_var(self) -> None:
+    self.assertEqual(Add(x, y).subs({x: Two}), Add(Two, y))
+    self.assertEqual(Add(x, y).subs({x: 2}), Add(Two, y))
+
+  def test_many(self) -> None:
+    self.assertEqual(Mul(x, Sin(y)).subs({x: y, y: x}), Mul(y, Sin(x)))
+
+  def test_subexpression(self) -> None:
+    self.assertEqual(Add(Sin(Mul(x, a)), Cos(Mul(a, x))).subs({Mul(x, a): y}), Add(Sin(y), Cos(y)))
+
+  def test_replacement_is_not_revisited(self) -> None:
+    self.assertEqual(Sin(x).subs({x: Sin(x), Sin(x): y}), y)
+    self.assertEqual(Cos(x).subs({x: Sin(x), Sin(x): y}), Cos(Sin(x)))
+
+  def test_structural_sharing(self) -> None:
+    left, right = Sin(Mul(x, Two)), Cos(y)
+    expression = Add(left, right)
+    new = expression.subs({y: Three})
+    self.assertIs(new.args[0], left)
+    self.assertIsNot(new.args[1], right)
+    self.assertIs(expression.subs({Var('z'): One}), expression)
+
+  def test_fold(self) -> None:
+    expression = Add(Mul(Pow(a, Two), y), Sin(x))
+    self.assertEqual(expression.subs({a: 3}, fold=True), Add(Mul(Const(Numeric(9)), y), Sin(x)))
+    self.assertEqual(expression.subs({a: 3}), Add(Mul(Pow(Three, Two), y), Sin(x)))
+    self.assertEqual(Add(x, One).subs({x: -3}, fold=True), Neg(Two))
+    self.assertEqual(Mul(x, Complex(One, One)).subs({x: 2}, fold=True), Complex(Two, Two))
+
+  def test_fold_keeps_constants(self) -> None:
+    self.assertEqual(Mul(x, PI).subs({x: 2}, fold=True), Mul(Two, PI))
+
+  def test_fold_invalid(self) -> None:
+    # Note: 0^-1 raises and log(0) is not finite, both are kept as ops and only their substituted args are folded
+    self.assertEqual(Pow(x, Neg(One)).subs({x: 0}, fold=True), Pow(Const(Numeric(0)), Neg(One)))
+    self.assertEqual(Log(x, Const(Numeric(10))).subs({x: 0}, fold=True), Log(Const(Numeric(0)), Const(Numeric(10))))
+    self.assertEqual(Add(Log(x, Two), y).subs({x: 0, y: 1}, fold=True), Add(Log(Const(Numeric(0)), Two), One))
+
+  def test_deep(self) -> None:
+    expression = x
+    for _ in range(5000): expression = Add(Sin(expression), a)
+    new = expression.subs({a: 1, x: 0}, fold=True)
+    self.assertEqual(new.fxn, One.fxn)
+    value = 0.0
+    for _ in range(5000): value = math.sin(value) + 1
+    self.assertAlmostEqual(float(new), value, delta=1e-12)
+
+if __name__ == '__main__':
+  unittest.main()